@@ -1,82 +1,515 @@
+import argparse
 import fdb
 import random
-from time import sleep
-from datetime import datetime
-from tsfdb_server_v1.controllers.db import DBOperations
-from tsfdb_server_v1.controllers.queue import Queue
-from tsfdb_server_v1.controllers.helpers import error, config
+import socket
+import sys
+import threading
+import uuid
+from collections import deque
+from time import sleep, time
+from tsfdb_server_v1.controllers.db import get_db_operations, PartialWrite
+from tsfdb_server_v1.controllers.metric_catalog import metric_catalog
+from tsfdb_server_v1.controllers.queue import Queue, unpack_item, \
+    wait_for_watch, unpack_counter, parse_lease, LeaseLost, QUEUES_SIGNAL
+from tsfdb_server_v1.controllers.line_batch import LineBatch
+from tsfdb_server_v1.controllers.shard_map import shard_map, \
+    validate_queues
+from tsfdb_server_v1.controllers.helpers import error, config, \
+    estimate_mutation_bytes
+
+
+class BatchTooLarge(Exception):
+    pass
 
 
 class Consumer:
-    def __init__(self):
-        self.db_ops = DBOperations()
+    def __init__(self, max_in_flight=1):
+        self.db_ops = get_db_operations()
+        # Bounds the writes in flight of all the workers of the process
+        self.write_slots = threading.BoundedSemaphore(max_in_flight)
         self.available_queues_subspace = fdb.Subspace(('available_queues',))
-        self.consumer_lock_subspace = fdb.Subspace(('consumer_lock',))
+        # Queues leased by the workers of the process, {name: owner}
+        self.leases = {}
+        self.leases_lock = threading.Lock()
+        threading.Thread(target=self.heartbeat, daemon=True).start()
 
     @fdb.transactional
-    def acquire_queue(self, tr, queue_names):
-        for queue_name in queue_names:
-            consumer_lock = None
-            queue_names.remove(queue_name)
-            if not tr[self.available_queues_subspace.pack((queue_name,))].present():
+    def acquire_queue(self, tr, queue_names, owner):
+        """Lease the deepest of the queues which are free, whose lease
+        expired or whose owner made no progress for QUEUE_STEAL_SECONDS
+        while the queue has a backlog. When items are claimed and none of
+        the queues is free, join the consumers of the deepest queue with
+        at least QUEUE_SHARE_ITEMS items without leasing it. Returns the
+        name of the queue, or None, and whether it's shared."""
+        if len(queue_names) > config('QUEUE_ACQUIRE_CANDIDATES'):
+            queue_names = random.sample(
+                queue_names, config('QUEUE_ACQUIRE_CANDIDATES'))
+        # Leases are read as snapshot, so that the heartbeats of other
+        # consumers don't conflict with the acquisition, and all reads are
+        # issued before waiting for any of them
+        states = [(queue, tr.snapshot[queue.consumer_lock],
+                   tr.snapshot[queue.stats['items']])
+                  for queue in map(Queue, queue_names)]
+        now = time()
+        share = config('QUEUE_VISIBILITY_TIMEOUT') > 0
+        candidates = []
+        for queue, lease, items in states:
+            items = unpack_counter(items)
+            shared = False
+            if lease.present():
+                _, expires, progress = parse_lease(lease)
+                if expires > now and (items == 0 or now - progress <
+                                      config('QUEUE_STEAL_SECONDS')):
+                    if not share or items < config('QUEUE_SHARE_ITEMS'):
+                        continue
+                    shared = True
+            candidates.append((not shared, items, random.random(), queue))
+        if not candidates:
+            return None, False
+        leased, _, _, queue = max(candidates, key=lambda c: c[:3])
+        if not leased:
+            return queue.name, True
+        tr.add_read_conflict_key(queue.consumer_lock.key())
+        queue.set_lease(tr, owner, now)
+        return queue.name, False
+
+    def heartbeat(self):
+        """Renew the leases of the queues served by the workers."""
+        while True:
+            sleep(config('QUEUE_LEASE_SECONDS') / 3)
+            with self.leases_lock:
+                leases = list(self.leases.items())
+            for queue_name, owner in leases:
+                try:
+                    Queue(queue_name).renew_lease(self.db_ops.db, owner)
+                except (LeaseLost, fdb.FDBError):
+                    # The worker finds out on its next pop
+                    pass
+
+    def parse_item(self, item):
+        """Unpack an item into its org and LineBatch. Any error, whether
+        the item or the lines it carries are malformed, is raised as a
+        ValueError, since retrying the item can't fix it."""
+        try:
+            org, data = unpack_item(item)
+            return org, LineBatch.from_payload(
+                data, self.db_ops.time_series.series_type)
+        except Exception as err:
+            raise ValueError("%s: %s" % (type(err).__name__, str(err)))
+
+    def backoff(self, err):
+        """Wait up to CONSUMER_ERROR_BACKOFF seconds before retrying after
+        an error, with jitter so that the workers don't retry in
+        lockstep."""
+        print("Retrying after error: %s" % str(err))
+        sleep(random.uniform(0.5, 1) * config('CONSUMER_ERROR_BACKOFF'))
+
+    def merge_items(self, queue, items):
+        """Group the popped (item, retries) per org, so that they are
+        written with one write_lines call per org. Undecodable items are
+        moved to the dead letters."""
+        batches = {}
+        for item, retries in items:
+            try:
+                org, line_batch = self.parse_item(item)
+            except ValueError as err:
+                error(500, "Garbage data in queue: %s" % queue.name,
+                      traceback=err)
+                queue.dead_letter(self.db_ops.db, item,
+                                  "Garbage data: %s" % str(err),
+                                  retries, retry=False)
                 continue
-            if tr[self.consumer_lock_subspace.pack((queue_name,))].present():
-                consumer_lock = fdb.tuple.unpack(
-                    tr[self.consumer_lock_subspace.pack((queue_name,))])[0]
-            if consumer_lock is None or \
-                    int(datetime.now().timestamp()) - \
-                    consumer_lock > config('ACQUIRE_TIMEOUT'):
-                tr[self.consumer_lock_subspace.pack((queue_name,))] = \
-                    fdb.tuple.pack((int(datetime.now().timestamp()),))
-                return queue_name
-        return None
-
-
-    def consume_queue(self, acquired_queue):
-        queue = Queue(acquired_queue)
+            if not batches.get(org):
+                batches[org] = []
+            batches[org].append((item, retries, line_batch))
+        return batches
+
+    def write(self, org, line_batch):
+        """Write a batch, returns the reason it failed, if it did, and
+        whether some of its lines were committed nonetheless. After a
+        partial write, only the lines which weren't written are retried,
+        once, since rewriting the others would count them twice in the
+        aggregates."""
+        try:
+            with self.write_slots:
+                self.db_ops.write_lines(self.db_ops.db, org, line_batch)
+            return None, False
+        except PartialWrite as err:
+            remaining = LineBatch(self.db_ops.time_series.series_type)
+            for machine, metric, dt, fields in err.remaining:
+                remaining.add_datapoint(machine, metric, dt, fields)
+        except Exception as err:
+            return "%s: %s" % (type(err).__name__, str(err)), False
+        try:
+            with self.write_slots:
+                self.db_ops.write_lines(self.db_ops.db, org, remaining)
+            return None, True
+        except Exception as err:
+            return "%s: %s" % (type(err).__name__, str(err)), True
+
+    def consume_items(self, queue, items):
+        for org, entries in self.merge_items(queue, items).items():
+            line_batch = LineBatch(self.db_ops.time_series.series_type)
+            for _, _, item_batch in entries:
+                line_batch.extend(item_batch)
+            reason, committed = self.write(org, line_batch)
+            if reason is None:
+                continue
+            if len(entries) > 1 and not committed:
+                # Write the items one by one to find which ones fail
+                failed = []
+                for item, retries, item_batch in entries:
+                    item_reason, item_committed = self.write(org, item_batch)
+                    if item_reason is not None:
+                        failed.append(
+                            (item, retries, item_reason, item_committed))
+            else:
+                failed = [(item, retries, reason, committed)
+                          for item, retries, _ in entries]
+            for item, retries, reason, committed in failed:
+                print("Moving item of queue %s to dead letters: %s" % (
+                    queue.name, reason))
+                if committed:
+                    # Retrying an item which was partially written would
+                    # count its written lines twice
+                    reason = "Partially written: %s" % reason
+                queue.dead_letter(self.db_ops.db, item, reason, retries + 1,
+                                  retry=not committed)
+
+    @fdb.transactional
+    def consume_batch(self, tr, queue, owner, max_items, after=None):
+        """Pop a batch of items and write their datapoints and metrics in
+        the same transaction, so that every item is consumed exactly once.
+        Returns the popped items, the catalog entries to add once the
+        transaction is committed and, if the queue was empty, a watch."""
+        items, watch = queue.pop_batch_or_watch(
+            tr, config('CONSUME_TIMEOUT'), max_items=max_items, owner=owner,
+            after=after)
+        batches = {}
+        size = 0
+        for user_version, item in enumerate(items):
+            try:
+                org, line_batch = self.parse_item(item)
+            except ValueError as err:
+                queue.dead_letter(tr, item, "Garbage data: %s" % str(err),
+                                  retry=False, user_version=user_version)
+                continue
+            size += sum(estimate_mutation_bytes(metric, fields)
+                        for _, metric, _, fields in line_batch.items())
+            if size > config('TRANSACTION_MAX_BYTES'):
+                raise BatchTooLarge()
+            if org in batches:
+                batches[org].extend(line_batch)
+            else:
+                batches[org] = line_batch
+        catalog_entries = {}
+        for org, line_batch in batches.items():
+            _, entries = self.db_ops.write_lines_batch(
+                tr, org, list(line_batch.items()))
+            catalog_entries.update(entries)
+        return items, catalog_entries, watch
+
+    def finish_commit(self, in_flight):
+        """Wait for the oldest commit in flight, returns the transaction
+        and the error if it failed."""
+        tr, commit, catalog_entries = in_flight.popleft()
+        try:
+            commit.wait()
+            metric_catalog.update(catalog_entries)
+        except fdb.FDBError as err:
+            return tr, err
+        finally:
+            self.write_slots.release()
+
+    def finish_commits(self, in_flight):
+        """Wait for all the commits in flight, returns the transaction and
+        the error of the first one which failed, if any."""
+        failed = None
+        while in_flight:
+            commit_failed = self.finish_commit(in_flight)
+            failed = failed or commit_failed
+        return failed
+
+    def consume_exactly_once(self, queue, owner):
+        """Consume batches with consume_batch, committing up to
+        CONSUMER_PIPELINE_DEPTH of them at once: while a batch commits,
+        the next one is popped after its last key and parsed, so the two
+        transactions don't conflict. Batches too large for one transaction
+        are halved. Items which can't be written in one transaction on
+        their own, or whose write fails, are popped and written separately
+        instead, as are the items of batches which keep failing after
+        QUEUE_TRANSACTION_RETRY_LIMIT retries. Returns whether items were
+        consumed and, if the queue was empty, a watch."""
+        max_items = config('QUEUE_POP_ITEMS')
+        retries = 0
+        in_flight = deque()
+        after = None
+        consumed = False
         while True:
+            failed = None
+            while len(in_flight) >= config('CONSUMER_PIPELINE_DEPTH'):
+                commit_failed = self.finish_commit(in_flight)
+                failed = failed or commit_failed
+            # Never block waiting for a write slot while holding some
+            while failed is None and \
+                    not self.write_slots.acquire(blocking=not in_flight):
+                failed = self.finish_commit(in_flight)
+            if failed is None:
+                tr = self.db_ops.db.create_transaction()
+                try:
+                    items, catalog_entries, watch = self.consume_batch(
+                        tr, queue, owner, max_items, after)
+                except LeaseLost:
+                    self.write_slots.release()
+                    self.finish_commits(in_flight)
+                    raise
+                except fdb.FDBError as err:
+                    self.write_slots.release()
+                    failed = tr, err
+                except BatchTooLarge:
+                    self.write_slots.release()
+                    failed = tr, None
+                except Exception as err:
+                    self.write_slots.release()
+                    self.finish_commits(in_flight)
+                    print("Writing batch of queue %s in one " % queue.name +
+                          "transaction failed: %s" % str(err))
+                    break
+            if failed is None and items:
+                in_flight.append((tr, tr.commit(), catalog_entries))
+                consumed = True
+                after = queue.last_popped
+                continue
+            if failed is None and not in_flight:
+                # The queue is empty, commit to activate the watch
+                in_flight.append((tr, tr.commit(), catalog_entries))
+                failed = self.finish_commits(in_flight)
+                if failed is None:
+                    return consumed, watch
+            elif failed is None:
+                # Only the items after the batches in flight were read
+                self.write_slots.release()
+                failed = self.finish_commits(in_flight)
+                after = None
+                if failed is None:
+                    continue
+            # Start over from the head of the queue, the items of the
+            # batches which failed are still there
+            self.finish_commits(in_flight)
+            after = None
+            _, err = failed
+            if err is None or err.code in (1007, 2101):
+                # transaction_too_old or transaction_too_large
+                if max_items == 1:
+                    break
+                max_items //= 2
+            elif retries < config('QUEUE_TRANSACTION_RETRY_LIMIT'):
+                # Retry with a new transaction, on_error would rethrow
+                # right away once TRANSACTION_RETRY_LIMIT is reached
+                retries += 1
+                self.backoff(err)
+            else:
+                break
+        items, watch = queue.pop_batch_or_watch(
+            self.db_ops.db, config('CONSUME_TIMEOUT'), max_items=max_items,
+            owner=owner)
+        self.consume_items(queue, [(item, 0) for item in items])
+        return bool(items), watch
+
+    @fdb.transactional
+    def consume_claimed(self, tr, queue, owner, claimed):
+        """Ack the claimed items and write their datapoints and metrics in
+        the same transaction, only the items still claimed by owner are
+        written. Returns the catalog entries to add once the transaction
+        is committed."""
+        batches = {}
+        size = 0
+        acked = queue.ack(tr, owner, claimed)
+        for user_version, (_, item) in enumerate(acked):
             try:
-                item = queue.pop(self.db_ops.db)
-                if item:
-                    item = fdb.tuple.unpack(item)
-                    org, data = item
-                    self.db_ops.write_in_kv(org, data)
+                org, line_batch = self.parse_item(item)
+            except ValueError as err:
+                queue.dead_letter(tr, item, "Garbage data: %s" % str(err),
+                                  retry=False, user_version=user_version)
+                continue
+            size += sum(estimate_mutation_bytes(metric, fields)
+                        for _, metric, _, fields in line_batch.items())
+            if size > config('TRANSACTION_MAX_BYTES'):
+                raise BatchTooLarge()
+            if org in batches:
+                batches[org].extend(line_batch)
+            else:
+                batches[org] = line_batch
+        catalog_entries = {}
+        for org, line_batch in batches.items():
+            _, entries = self.db_ops.write_lines_batch(
+                tr, org, list(line_batch.items()))
+            catalog_entries.update(entries)
+        return catalog_entries
+
+    def consume_claims(self, queue, owner, shared=False):
+        """Claim a batch of items for QUEUE_VISIBILITY_TIMEOUT seconds and
+        consume it with consume_claimed, so that several consumers can
+        drain the same queue. Items whose claim expires before they're
+        acked, e.g. because their consumer died, are claimed again by the
+        next consumer. Batches which fail to be written in one transaction
+        are written one item at a time, items which can't be written in
+        one transaction on their own are acked and written separately.
+        Returns whether items were consumed and, if nothing could be
+        claimed, a watch."""
+        claimed, watch = queue.claim_batch_or_watch(
+            self.db_ops.db, owner, config('CONSUME_TIMEOUT'),
+            config('QUEUE_VISIBILITY_TIMEOUT'), lease=not shared)
+        if not claimed:
+            return False, watch
+        batches = [claimed]
+        while batches:
+            batch = batches.pop()
+            try:
+                with self.write_slots:
+                    metric_catalog.update(self.consume_claimed(
+                        self.db_ops.db, queue, owner, batch))
+                continue
+            except (fdb.FDBError, BatchTooLarge) as err:
+                reason = "Batch too large" if isinstance(
+                    err, BatchTooLarge) else str(err)
+            except Exception as err:
+                reason = "%s: %s" % (type(err).__name__, str(err))
+            if len(batch) > 1:
+                batches.extend([item] for item in reversed(batch))
+                continue
+            print("Writing item of queue %s in one " % queue.name +
+                  "transaction failed: %s" % reason)
+            acked = queue.ack(self.db_ops.db, owner, batch)
+            self.consume_items(queue, [(item, 0) for _, item in acked])
+        return True, None
+
+    def consume_queue(self, acquired_queue, owner, shared=False):
+        queue = Queue(acquired_queue)
+        if not shared:
+            with self.leases_lock:
+                self.leases[queue.name] = owner
+        try:
+            while shared:
+                # Leave the queue as soon as there's nothing left to claim
+                consumed, watch = self.consume_claims(queue, owner, shared)
+                if not consumed:
+                    watch.cancel()
+                    return
+            while True:
+                retried = queue.pop_due_dead_letters(self.db_ops.db)
+                if retried:
+                    self.consume_items(queue, retried)
+                if config('QUEUE_VISIBILITY_TIMEOUT') > 0:
+                    consumed, watch = self.consume_claims(queue, owner)
+                elif config('CONSUME_EXACTLY_ONCE'):
+                    consumed, watch = self.consume_exactly_once(queue, owner)
                 else:
-                    sleep(config('CONSUME_TIMEOUT'))
+                    items, watch = queue.pop_batch_or_watch(
+                        self.db_ops.db, config('CONSUME_TIMEOUT'),
+                        owner=owner)
+                    self.consume_items(queue, [(item, 0) for item in items])
+                    consumed = bool(items)
+                if consumed:
+                    continue
+                if retried:
+                    watch.cancel()
+                elif not wait_for_watch(watch, config('CONSUME_TIMEOUT')):
                     if queue.delete_if_empty(self.db_ops.db):
                         return
-            except fdb.FDBError as err:
-                if err.code != 1020:
-                    self.db_ops.db.on_error(err.code).wait()
-                return
-            except ValueError as err:
-                error(500, "Garbage data in queue: %s" % queue.name, traceback=err)
+        except fdb.FDBError as err:
+            # Conflicts are retried right away by acquiring a queue again
+            if err.code != 1020:
+                self.backoff(err)
+        except LeaseLost as err:
+            print(str(err))
+        finally:
+            if not shared:
+                with self.leases_lock:
+                    self.leases.pop(queue.name, None)
+                try:
+                    queue.release_lease(self.db_ops.db, owner)
+                except fdb.FDBError:
+                    pass
+
+    @fdb.transactional
+    def list_queues(self, tr, timeout):
+        """Return the available queues and a watch which fires when a
+        queue is created, deleted or released."""
+        queue_names = []
+        for k, _ in tr[self.available_queues_subspace.range()]:
+            queue_names.append(fdb.tuple.unpack(k)[1])
+        # Watches fail when the transaction which created them times out
+        tr.options.set_timeout(
+            config('TRANSACTION_TIMEOUT') + int(timeout * 1000))
+        return queue_names, tr.watch(QUEUES_SIGNAL)
 
     def run(self):
+        owner = "%s-%s" % (socket.gethostname(), uuid.uuid4().hex[:8])
         while True:
-            queue_names = []
-            for k, _ in self.db_ops.db[self.available_queues_subspace.range()]:
-                queue_names.append(fdb.tuple.unpack(k)[1])
-            random.shuffle(queue_names)
-            while queue_names:
-                try:
-                    acquired_queue = self.acquire_queue(
-                        self.db_ops.db, queue_names)
-                except fdb.FDBError as err:
-                    if err.code != 1020:
-                        self.db_ops.db.on_error(err.code).wait()
-                    acquired_queue = None
-                if acquired_queue:
-                    self.consume_queue(acquired_queue)
-                else:
-                    sleep_time = random.randint(1, config('QUEUE_RETRY_TIMEOUT'))
-                    print("Retrying to acquire a queue in %ds" %
-                        sleep_time)
-                    sleep(sleep_time)
+            timeout = random.randint(1, config('QUEUE_RETRY_TIMEOUT'))
+            try:
+                queue_names, watch = self.list_queues(
+                    self.db_ops.db, timeout)
+                acquired_queue, shared = self.acquire_queue(
+                    self.db_ops.db, queue_names, owner)
+            except fdb.FDBError as err:
+                if err.code != 1020:
+                    self.backoff(err)
+                continue
+            if acquired_queue:
+                watch.cancel()
+                self.consume_queue(acquired_queue, owner, shared)
+                continue
+            # All queues are served by other consumers, wait for a queue to
+            # be created or released, or for their leases to expire
+            print("Waiting at most %ds to acquire a queue" % timeout)
+            if wait_for_watch(watch, timeout):
+                # Don't race other idle consumers on every single signal
+                sleep(config('QUEUE_WAKEUP_INTERVAL'))
+
+    def run_workers(self, workers):
+        """Serve up to workers queues at once, one thread per queue."""
+        if workers <= 1:
+            return self.run()
+        threads = [threading.Thread(target=self.run, daemon=True,
+                                    name="consumer-%d" % i)
+                   for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        while all(thread.is_alive() for thread in threads):
+            sleep(1)
+        # A worker died, exit so that the process gets restarted
+        print("A consumer worker exited unexpectedly")
+        sys.exit(1)
+
+
+def queues_argument(value):
+    try:
+        return validate_queues(int(value))
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err))
 
 
 def main():
-    Consumer().run()
+    parser = argparse.ArgumentParser(description="Consume tsfdb queues")
+    parser.add_argument("--queues", type=int,
+                        default=config('CONSUMER_QUEUES'),
+                        help="Number of queues to consume concurrently")
+    parser.add_argument("--max-in-flight", type=int,
+                        default=config('CONSUMER_MAX_IN_FLIGHT'),
+                        help="Maximum number of concurrent writes, " +
+                        "defaults to the number of queues")
+    parser.add_argument("--set-queues", type=queues_argument,
+                        help="Change the number of queues that machines " +
+                        "are sharded to and exit, -1 for one per machine")
+    args = parser.parse_args()
+    if args.set_queues is not None:
+        version, queues = shard_map.set_queues(
+            get_db_operations().db, args.set_queues)
+        print("Shard map version %d with %d queues" % (version, queues))
+        return
+    Consumer(args.max_in_flight or args.queues).run_workers(args.queues)
 
 if __name__ == "__main__":
     main()
@@ -9,25 +9,54 @@ from tsfdb_server_v1.controllers.queue import Queue
 fdb.api_version(620)
 TSFDB_URI = os.getenv('TSFDB_URI', "http://tsfdb:8080")
 ACTIVE_METRIC_MINUTES = int(os.getenv('ACTIVE_METRIC_MINUTES', 60))
+QUEUE_RECONCILE_SECONDS = int(os.getenv('QUEUE_RECONCILE_SECONDS', 3600))
 
 
 def generate_tsfdb_queues_metrics(db, timestamp):
     try:
         line = "queue,machine_id=tsfdb "
+        bytes_line = "queue_bytes,machine_id=tsfdb "
         available_queues_subspace = fdb.Subspace(('available_queues',))
         count = 0
         for count, (k, v) in enumerate(db[available_queues_subspace.range()],
                                        1):
             name = available_queues_subspace.unpack(k)[0]
-            line += "%s=%d," % (name, Queue(name).count_items(db))
+            items, size = Queue(name).get_stats(db)
+            line += "%s=%d," % (name, items)
+            bytes_line += "%s=%d," % (name, size)
         line += "count=%d %s" % (count, timestamp)
-        return [line]
+        if count == 0:
+            return [line]
+        return [line, bytes_line[:-1] + " %s" % timestamp]
     except fdb.FDBError as err:
         print("ERROR: Could not get queues metrics: %s" %
               str(err.description, 'utf-8'))
         return []
 
 
+def reconcile_queues_stats(db):
+    # Count the queues with items pushed before their counters were kept,
+    # the counters of all the other queues are exact
+    try:
+        available_queues_subspace = fdb.Subspace(('available_queues',))
+        queues = [Queue(available_queues_subspace.unpack(k)[0])
+                  for k, v in db[available_queues_subspace.range()]]
+    except fdb.FDBError as err:
+        print("ERROR: Could not get queues: %s" %
+              str(err.description, 'utf-8'))
+        return
+    for queue in queues:
+        try:
+            if not queue.is_counted(db):
+                print("Counted queue %s: %d items, %d bytes" % (
+                    (queue.name,) + queue.reconcile_stats(db)))
+        except fdb.FDBError as err:
+            # Very long queues can't be counted within one transaction,
+            # they are counted once they are drained
+            print("ERROR: Could not count queue %s: %s" %
+                  (queue.name, str(err.description, 'utf-8')))
+
+
 def generate_tsfdb_processes_metrics(status, timestamp):
     lines = []
     line = ("cluster,machine_id=tsfdb processes=%d,degraded_processes=%d %s" %
@@ -126,9 +155,13 @@ def generate_tsfdb_cluster_data_metrics(status, timestamp):
 def main():
     db = fdb.open()
     db.options.set_transaction_timeout(10000)
+    last_reconcile = 0
     while True:
         lines = []
         dt = datetime.now()
+        if dt.timestamp() - last_reconcile >= QUEUE_RECONCILE_SECONDS:
+            reconcile_queues_stats(db)
+            last_reconcile = dt.timestamp()
         status = {}
         try:
             status = json.loads(db[b'\xff\xff/status/json'])
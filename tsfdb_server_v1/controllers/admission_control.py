@@ -0,0 +1,55 @@
+import threading
+from collections import OrderedDict
+from time import time
+from .helpers import config
+from .queue import Queue
+
+
+class AdmissionControl:
+    """Decides whether payloads can be pushed to a queue, based on the
+    depth counters of the queue, which are read at most every ttl seconds
+    by every process and kept in an LRU of the max_size most recent
+    queues.
+
+    Payloads of LOW_PRIORITY_ORGS are rejected first, once a queue is
+    above QUEUE_SHED_RATIO of its limits.
+    """
+
+    def __init__(self, ttl, max_size, clock=time):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        # {queue name: (items, bytes, refreshed)}
+        self.stats = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_stats(self, db, queue_name):
+        with self.lock:
+            stats = self.stats.get(queue_name)
+            if stats is not None:
+                self.stats.move_to_end(queue_name)
+        if stats is None or self.clock() - stats[2] >= self.ttl:
+            stats = Queue(queue_name).get_stats(db) + (self.clock(),)
+            with self.lock:
+                self.stats[queue_name] = stats
+                self.stats.move_to_end(queue_name)
+                while len(self.stats) > self.max_size:
+                    self.stats.popitem(last=False)
+        return stats[:2]
+
+    def retry_after(self, db, queue_name, org):
+        """Return the seconds after which a payload of org for the queue
+        should be retried, or None if it can be queued."""
+        ratio = 1
+        if org in config('LOW_PRIORITY_ORGS'):
+            ratio = config('QUEUE_SHED_RATIO')
+        items, size = self.get_stats(db, queue_name)
+        for value, limit in ((items, config('QUEUE_MAX_ITEMS')),
+                             (size, config('QUEUE_MAX_BYTES'))):
+            if limit > 0 and value >= limit * ratio:
+                return config('QUEUE_RETRY_AFTER')
+        return None
+
+
+admission_control = AdmissionControl(config('QUEUE_STATS_TTL'),
+                                     config('QUEUE_STATS_CACHE_SIZE'))
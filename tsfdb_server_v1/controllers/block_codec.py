@@ -0,0 +1,220 @@
+import struct
+
+# A block holds the second resolution samples of one metric for one minute.
+# Timestamps are stored as delta-of-delta and values either as zigzag
+# deltas (ints) or XORed with the previous value (floats), following the
+# scheme described in the Gorilla paper. Blocks with both ints and floats
+# prefix every value with its type, so that ints are decoded as ints.
+BLOCK_VERSION = 1
+INT_BLOCK = 0
+FLOAT_BLOCK = 1
+MIXED_BLOCK = 2
+HEADER = struct.Struct('>BBH')
+
+# (control bits, control length, payload length) for each range of
+# timestamp delta-of-deltas, anything bigger falls back to 64 bits
+TIMESTAMP_BUCKETS = ((0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12))
+
+
+class BitWriter:
+    def __init__(self):
+        self.bits = 0
+        self.length = 0
+
+    def write(self, value, length):
+        self.bits = (self.bits << length) | (value & ((1 << length) - 1))
+        self.length += length
+
+    def to_bytes(self):
+        padding = -self.length % 8
+        return (self.bits << padding).to_bytes(
+            (self.length + padding) // 8, 'big')
+
+
+class BitReader:
+    def __init__(self, data):
+        self.bits = int.from_bytes(data, 'big')
+        self.length = len(data) * 8
+        self.position = 0
+
+    def read(self, length):
+        self.position += length
+        if self.position > self.length:
+            raise ValueError("Truncated datapoints block")
+        return (self.bits >> (self.length - self.position)) & \
+            ((1 << length) - 1)
+
+    def read_signed(self, length):
+        value = self.read(length)
+        if value >= 1 << (length - 1):
+            value -= 1 << length
+        return value
+
+
+def float_to_bits(value):
+    return struct.unpack('>Q', struct.pack('>d', value))[0]
+
+
+def bits_to_float(bits):
+    return struct.unpack('>d', struct.pack('>Q', bits))[0]
+
+
+def zigzag(value):
+    return (value << 1) if value >= 0 else ((-value << 1) - 1)
+
+
+def unzigzag(value):
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1)
+
+
+def write_timestamp(writer, delta_of_delta):
+    if delta_of_delta == 0:
+        writer.write(0, 1)
+        return
+    for control, control_length, length in TIMESTAMP_BUCKETS:
+        if -(1 << (length - 1)) <= delta_of_delta < (1 << (length - 1)):
+            writer.write(control, control_length)
+            writer.write(delta_of_delta, length)
+            return
+    writer.write(0b1111, 4)
+    writer.write(delta_of_delta, 64)
+
+
+def read_timestamp(reader):
+    if not reader.read(1):
+        return 0
+    for _, _, length in TIMESTAMP_BUCKETS:
+        if not reader.read(1):
+            return reader.read_signed(length)
+    return reader.read_signed(64)
+
+
+def write_int(writer, delta):
+    delta = zigzag(delta)
+    if delta == 0:
+        writer.write(0, 1)
+        return
+    writer.write(1, 1)
+    writer.write(delta.bit_length(), 7)
+    writer.write(delta, delta.bit_length())
+
+
+def read_int(reader):
+    if not reader.read(1):
+        return 0
+    return unzigzag(reader.read(reader.read(7)))
+
+
+def write_float(writer, state, value):
+    """XOR value with the previous float, state is the [bits, leading
+    zeros, trailing zeros] of the previous float."""
+    value = float_to_bits(float(value))
+    xor = value ^ state[0]
+    state[0] = value
+    if xor == 0:
+        writer.write(0, 1)
+        return
+    leading = min(64 - xor.bit_length(), 31)
+    trailing = (xor & -xor).bit_length() - 1
+    if state[1] is not None and leading >= state[1] and \
+            trailing >= state[2]:
+        writer.write(0b10, 2)
+        writer.write(xor >> state[2], 64 - state[1] - state[2])
+        return
+    significant = 64 - leading - trailing
+    writer.write(0b11, 2)
+    writer.write(leading, 5)
+    writer.write(significant - 1, 6)
+    writer.write(xor >> trailing, significant)
+    state[1], state[2] = leading, trailing
+
+
+def read_float(reader, state):
+    if reader.read(1):
+        if not reader.read(1):
+            if state[1] is None:
+                raise ValueError("Corrupted datapoints block")
+            xor = reader.read(64 - state[1] - state[2]) << state[2]
+        else:
+            state[1] = reader.read(5)
+            significant = reader.read(6) + 1
+            state[2] = 64 - state[1] - significant
+            if state[2] < 0:
+                raise ValueError("Corrupted datapoints block")
+            xor = reader.read(significant) << state[2]
+        state[0] ^= xor
+    return bits_to_float(state[0])
+
+
+def encode_block(points):
+    """Encode a list of [timestamp, value] pairs sorted by timestamp."""
+    types = {type(value) for _, value in points}
+    block_type = INT_BLOCK
+    if float in types:
+        block_type = MIXED_BLOCK if types - {float} else FLOAT_BLOCK
+    writer = BitWriter()
+    prev_timestamp, prev_delta = points[0][0], 0
+    writer.write(prev_timestamp, 64)
+    prev_int, float_state = 0, [0, None, None]
+    first = 1
+    if block_type == FLOAT_BLOCK:
+        float_state[0] = float_to_bits(float(points[0][1]))
+        writer.write(float_state[0], 64)
+    elif block_type == INT_BLOCK:
+        prev_int = points[0][1]
+        write_int(writer, prev_int)
+    else:
+        # The first value of a mixed block is written with its type
+        first = 0
+
+    for i, (timestamp, value) in enumerate(points[first:], first):
+        if i:
+            delta = timestamp - prev_timestamp
+            write_timestamp(writer, delta - prev_delta)
+            prev_timestamp, prev_delta = timestamp, delta
+        if block_type == MIXED_BLOCK:
+            writer.write(type(value) is float, 1)
+        if block_type == INT_BLOCK or \
+                block_type == MIXED_BLOCK and type(value) is not float:
+            write_int(writer, value - prev_int)
+            prev_int = value
+        else:
+            write_float(writer, float_state, value)
+
+    return HEADER.pack(BLOCK_VERSION, block_type, len(points)) + \
+        writer.to_bytes()
+
+
+def decode_block(data):
+    """Decode a block to a list of [timestamp, value] pairs, raises
+    ValueError if the block is corrupted."""
+    try:
+        version, block_type, count = HEADER.unpack_from(data)
+    except struct.error:
+        raise ValueError("Truncated datapoints block")
+    if version != BLOCK_VERSION:
+        raise ValueError("Unsupported datapoints block version: %d" % version)
+    if block_type not in (INT_BLOCK, FLOAT_BLOCK, MIXED_BLOCK) or not count:
+        raise ValueError("Corrupted datapoints block")
+    reader = BitReader(data[HEADER.size:])
+    timestamp, delta = reader.read(64), 0
+    prev_int, float_state = 0, [0, None, None]
+    points = []
+    if block_type == FLOAT_BLOCK:
+        float_state[0] = reader.read(64)
+        points.append([timestamp, bits_to_float(float_state[0])])
+    elif block_type == INT_BLOCK:
+        prev_int = read_int(reader)
+        points.append([timestamp, prev_int])
+
+    while len(points) < count:
+        if points:
+            delta += read_timestamp(reader)
+            timestamp += delta
+        if block_type == INT_BLOCK or \
+                block_type == MIXED_BLOCK and not reader.read(1):
+            prev_int += read_int(reader)
+            points.append([timestamp, prev_int])
+        else:
+            points.append([timestamp, read_float(reader, float_state)])
+    return points
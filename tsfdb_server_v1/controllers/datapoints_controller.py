@@ -9,8 +9,9 @@ from tsfdb_server_v1.models.error import Error  # noqa: E501
 from tsfdb_server_v1 import util
 from .query_funcs import deriv, roundX, roundY, topk, mean
 from .query_funcs import fetch_monitoring as fetch
-from .db import DBOperations
-from .helpers import config, log2slack, separate_metrics
+from .db import get_db_operations
+from .helpers import config, log2slack, too_many_requests
+from .line_batch import LineBatch
 
 log = logging.getLogger(__name__)
 
@@ -50,7 +51,7 @@ def fetch_datapoints(query, x_org_id, x_allowed_resources=None):  # noqa: E501
         return DatapointsResponse(query=str(query), series=data)
 
 
-def write_datapoints(x_org_id, body):  # noqa: E501
+def write_datapoints(x_org_id, body, content_encoding=None):  # noqa: E501
     """Write datapoints to db
 
      # noqa: E501
@@ -59,16 +60,64 @@ def write_datapoints(x_org_id, body):  # noqa: E501
     :type x_org_id: str
     :param body: Datapoints object to write
     :type body:
+    :param content_encoding: Compression of the body (gzip, deflate, zstd)
+    :type content_encoding: str
 
     :rtype: None
     """
-    db_ops = DBOperations()
-    body = str(body, 'utf8')
+    db_ops = get_db_operations()
+    # The whole body is parsed before the first write, so that a malformed
+    # line is rejected before any of the lines is written
+    try:
+        line_batches = list(
+            LineBatch.iter_from_body(body, content_encoding))
+    except ValueError as e:
+        log.error("Error when decoding request body: %s", str(e))
+        return Error(400, "Bad request")
+    admitted = False
+    for line_batch in line_batches:
+        if config('WRITE_IN_QUEUE'):
+            batch_tsfdb, batch_rest = line_batch.separate(("tsfdb",))
+            # Admission is decided once, before anything is written, so
+            # that a 429 never follows a partial write. Queue limits are
+            # soft, the rest of an admitted body is always queued.
+            if batch_rest and not admitted:
+                retry_after = db_ops.queue_retry_after(x_org_id, batch_rest)
+                if retry_after:
+                    return too_many_requests(retry_after)
+            admitted = True
+            if batch_tsfdb:
+                db_ops.write_in_kv(x_org_id, batch_tsfdb)
+            if batch_rest:
+                db_ops.write_in_queue(x_org_id, batch_rest)
+        else:
+            db_ops.write_in_kv(x_org_id, line_batch)
+
+
+def write_prometheus_datapoints(x_org_id, body):  # noqa: E501
+    """Write datapoints from a Prometheus remote_write request to db
+
+     # noqa: E501
+
+    :param x_org_id: Organization id
+    :type x_org_id: str
+    :param body: Snappy compressed remote_write WriteRequest protobuf
+    :type body: str
+
+    :rtype: None
+    """
+    db_ops = get_db_operations()
+    try:
+        line_batch = LineBatch.from_remote_write(body)
+    except ValueError as e:
+        log.error("Error when decoding remote_write request: %s", str(e))
+        return Error(400, "Bad request")
     if config('WRITE_IN_QUEUE'):
-        body_tsfdb, body_rest = separate_metrics(body)
-        if body_tsfdb:
-            db_ops.write_in_kv(x_org_id, body_tsfdb)
-        if body_rest:
-            db_ops.write_in_queue(x_org_id, body_rest)
+        if not line_batch:
+            return
+        retry_after = db_ops.queue_retry_after(x_org_id, line_batch)
+        if retry_after:
+            return too_many_requests(retry_after)
+        db_ops.write_in_queue(x_org_id, line_batch, body)
     else:
-        db_ops.write_in_kv(x_org_id, body)
+        db_ops.write_in_kv(x_org_id, line_batch)
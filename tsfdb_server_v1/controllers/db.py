@@ -1,21 +1,63 @@
 import asyncio
 import fdb
+import threading
 import fdb.tuple
 import re
 import logging
 import traceback
-from .tsfdb_tuple import key_tuple_second, delta_dt
+from .tsfdb_tuple import delta_dt
 from .helpers import error, parse_start_stop_params, \
-    generate_metric, profile, is_regex, config, get_queue_id, \
-    time_range_to_resolution, get_fallback_resolution, filter_artifacts
+    profile, is_regex, config, \
+    time_range_to_resolution, get_fallback_resolution, filter_artifacts, \
+    split_in_batches, split_batch, merge_metrics
 from .queue import Queue
-from line_protocol_parser import parse_line
+from .line_batch import LineBatch
 from datetime import datetime
 from tsfdb_server_v1.models.error import Error  # noqa: E501
 from .time_series_layer import TimeSeriesLayer
+from .metric_catalog import metric_catalog
+from .shard_map import shard_map
+from .admission_control import admission_control
 
 fdb.api_version(620)
 
+# Database handles and DBOperations are created lazily once per process, as
+# the FDB network thread doesn't survive the fork of the uwsgi workers
+registry_lock = threading.RLock()
+databases = {}
+db_operations = {}
+
+
+class PartialWrite(Exception):
+    """Some of the batches of a write were committed and others failed.
+    Holds the metrics which were written, the parsed lines which weren't
+    and the error of the last batch which failed."""
+
+    def __init__(self, metrics, remaining, error):
+        super().__init__("%d lines were not written: %s" % (
+            len(remaining), str(error)))
+        self.metrics = metrics
+        self.remaining = remaining
+        self.error = error
+
+
+def get_db():
+    with registry_lock:
+        if not databases.get("default"):
+            db = fdb.open()
+            db.options.set_transaction_retry_limit(
+                config('TRANSACTION_RETRY_LIMIT'))
+            db.options.set_transaction_timeout(config('TRANSACTION_TIMEOUT'))
+            databases["default"] = db
+        return databases["default"]
+
+
+def get_db_operations(series_type="monitoring"):
+    with registry_lock:
+        if not db_operations.get(series_type):
+            db_operations[series_type] = DBOperations(series_type)
+        return db_operations[series_type]
+
 
 class DBOperations:
     def __init__(self, series_type="monitoring"):
@@ -26,11 +68,7 @@ class DBOperations:
 
     @staticmethod
     def open_db():
-        db = fdb.open()
-        db.options.set_transaction_retry_limit(
-            config('TRANSACTION_RETRY_LIMIT'))
-        db.options.set_transaction_timeout(config('TRANSACTION_TIMEOUT'))
-        return db
+        return get_db()
 
     def find_metrics(self, org, resource):
         try:
@@ -58,7 +96,6 @@ class DBOperations:
     async def async_find_datapoints(self, org, resource, start, stop, metrics):
         metrics_data = []
         try:
-            loop = asyncio.get_event_loop()
             data = {}
             start, stop = parse_start_stop_params(start, stop)
 
@@ -67,19 +104,20 @@ class DBOperations:
 
             resolution = time_range_to_resolution(time_range_in_hours)
             fallback_resolution = get_fallback_resolution(resolution)
-            available_metrics = fdb.directory.create_or_open(
-                self.db, (self.time_series.series_type, org, 'available_metrics'))
-            datapoints_dir = fdb.directory.create_or_open(
-                self.db, (self.time_series.series_type, org, resource, resolution))
+            available_metrics = self.time_series.open_dir(
+                self.db, org, 'available_metrics')
+            datapoints_dir = self.time_series.open_dir(
+                self.db, org, resource, resolution)
             if fallback_resolution:
-                datapoints_fallback_dir = fdb.directory.create_or_open(
-                    self.db, (self.time_series.series_type, org, resource, fallback_resolution))
+                datapoints_fallback_dir = self.time_series.open_dir(
+                    self.db, org, resource, fallback_resolution)
 
+            # The range reads of all the metrics are issued concurrently
+            # from this event loop
             metrics_data = [
-                loop.run_in_executor(None, self.time_series.find_datapoints,
-                                     *(self.db, org, resource, metric, start, stop,
-                                       datapoints_dir, available_metrics,
-                                       resolution))
+                self.time_series.async_find_datapoints(
+                    self.db, org, resource, metric, start, stop,
+                    datapoints_dir, available_metrics, resolution)
                 for metric in metrics
             ]
 
@@ -110,15 +148,14 @@ class DBOperations:
                                 key)[0][1]
                             stop_fallback = datetime.fromtimestamp(
                                 first_timestamp) - delta_dt(fallback_resolution)
-                        async_func_call = (None,
-                                           self.time_series.find_datapoints,
-                                           *(self.db, org, resource,
-                                             key.split(".", 1)[1],
-                                             start, stop_fallback,
-                                             datapoints_fallback_dir,
-                                             available_metrics,
-                                             fallback_resolution))
-                        metrics_data_fallback.append(async_func_call)
+                        metrics_data_fallback.append(
+                            self.time_series.async_find_datapoints(
+                                self.db, org, resource,
+                                key.split(".", 1)[1],
+                                start, stop_fallback,
+                                datapoints_fallback_dir,
+                                available_metrics,
+                                fallback_resolution))
                         metric = next(iter(metric_data)).split(".", 1)[1]
                         metrics_served.append(metric)
                     data.update(metric_data)
@@ -130,19 +167,17 @@ class DBOperations:
                     # In case we have metrics that didn't have any datapoints,
                     # from the appropriate resolution, we try to get the asked
                     # time range in a lower resolution instead.
-                    async_func_call = (None, self.time_series.find_datapoints,
-                                       *(self.db, org, resource,
-                                         metric,
-                                         start, stop,
-                                         datapoints_fallback_dir,
-                                         available_metrics,
-                                         fallback_resolution))
-                    metrics_data_fallback.append(async_func_call)
+                    metrics_data_fallback.append(
+                        self.time_series.async_find_datapoints(
+                            self.db, org, resource,
+                            metric,
+                            start, stop,
+                            datapoints_fallback_dir,
+                            available_metrics,
+                            fallback_resolution))
 
                 metrics_data_fallback = await asyncio.gather(
-                    *(loop.run_in_executor(*metric_data_fallback)
-                      for metric_data_fallback in metrics_data_fallback),
-                    return_exceptions=True)
+                    *metrics_data_fallback, return_exceptions=True)
 
                 for metric_data_fallback in metrics_data_fallback:
                     if isinstance(metric_data_fallback, Error):
@@ -182,50 +217,147 @@ class DBOperations:
             return error(503, error_msg, traceback=traceback.format_exc(),
                          request=str((resource, start, stop, metrics)))
 
+    def write_lines(self, db, org, line_batch):
+        """Write a batch in transactions of about TRANSACTION_MAX_BYTES
+        which are committed concurrently. Writes aren't atomic: if some of
+        the transactions were committed when another one fails,
+        PartialWrite is raised with the lines which weren't written."""
+        batches = split_in_batches(line_batch.items(),
+                                   config('TRANSACTION_MAX_BYTES'))
+        if len(batches) == 1:
+            return self.write_batch(db, org, batches[0])
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(
+                self.async_write_batches(db, org, batches))
+        finally:
+            loop.close()
+
+    async def async_write_batches(self, db, org, batches):
+        loop = asyncio.get_event_loop()
+        results = [
+            loop.run_in_executor(None, self.write_batch,
+                                 *(db, org, batch))
+            for batch in batches
+        ]
+        results = await asyncio.gather(*results, return_exceptions=True)
+        metrics = {}
+        remaining = []
+        last_exception = None
+        committed = False
+        for batch, result in zip(batches, results):
+            if isinstance(result, PartialWrite):
+                committed = True
+                merge_metrics(metrics, result.metrics)
+                remaining += result.remaining
+                last_exception = result.error
+            elif isinstance(result, Exception):
+                remaining += batch
+                last_exception = result
+            else:
+                committed = True
+                merge_metrics(metrics, result)
+        if last_exception and committed:
+            raise PartialWrite(metrics, remaining, last_exception)
+        if last_exception:
+            raise last_exception
+        return metrics
+
+    def write_batch(self, db, org, batch):
+        try:
+            metrics, catalog_entries = self.write_lines_batch(db, org, batch)
+            metric_catalog.update(catalog_entries)
+            return metrics
+        except fdb.FDBError as err:
+            # transaction_too_old or transaction_too_large, retry in halves
+            if err.code not in (1007, 2101) or len(batch) < 2:
+                raise
+            self.log.warning("Splitting batch of %d lines after error: %s" % (
+                len(batch), str(err.description, 'utf-8')))
+        first, second = split_batch(batch)
+        try:
+            metrics = self.write_batch(db, org, first)
+        except PartialWrite as err:
+            raise PartialWrite(err.metrics, err.remaining + second, err.error)
+        try:
+            return merge_metrics(metrics, self.write_batch(db, org, second))
+        except PartialWrite as err:
+            raise PartialWrite(merge_metrics(metrics, err.metrics),
+                               err.remaining, err.error)
+        except Exception as err:
+            raise PartialWrite(metrics, second, err)
+
     @fdb.transactional
-    def write_lines(self, tr, org, lines):
+    def write_lines_batch(self, tr, org, batch):
         metrics = {}
-        datapoints_dir = {}
-        for line in lines:
-            dict_line = parse_line(line)
-            machine = dict_line["tags"]["machine_id"]
-            metric = generate_metric(
-                dict_line["tags"], dict_line["measurement"])
-            dt = datetime.fromtimestamp(int(str(dict_line["time"])[:10]))
-            if self.time_series.series_type == 'metering':
-                dt = datetime.now()
-            for field, value in dict_line["fields"].items():
+        aggregates = {}
+        samples = {}
+        block_samples = {}
+        for machine, metric, dt, fields in batch:
+            for field, value in fields.items():
                 machine_metric = "%s.%s" % (metric, field)
-                if not datapoints_dir.get("second"):
-                    datapoints_dir["second"] = fdb.directory.create_or_open(
-                        tr, (self.time_series.series_type, org, machine, 'second'))
-                if self.time_series.write_datapoint(tr, org, machine, key_tuple_second(
-                    dt, machine_metric), value,
-                        datapoints_dir=datapoints_dir['second']):
-                    if not metrics.get(machine):
-                        metrics[machine] = set()
-                    metrics[machine].add(
-                        (machine_metric, type(value).__name__))
-                    for resolution in self.resolutions:
-                        if not datapoints_dir.get(resolution):
-                            datapoints_dir[resolution] = \
-                                fdb.directory.create_or_open(
-                                tr, (self.time_series.series_type, org, machine, resolution))
-                        self.time_series.write_datapoint_aggregated(
-                            tr, org, machine, machine_metric,
-                            dt, value, resolution,
-                            datapoints_dir=datapoints_dir[resolution])
-        return metrics
+                # Numeric samples are stored in per minute blocks, if enabled
+                if config('SECOND_BLOCKS') and \
+                        type(value) in self.time_series.struct_types:
+                    if not block_samples.get(machine):
+                        block_samples[machine] = []
+                    block_samples[machine].append((machine_metric, dt, value))
+                    continue
+                if not samples.get(machine):
+                    samples[machine] = []
+                samples[machine].append((machine_metric, dt, value))
+        for machine, machine_samples in samples.items():
+            for machine_metric, dt, value in \
+                    self.time_series.write_datapoints(
+                        tr, org, machine, machine_samples):
+                self.aggregate_datapoint(
+                    aggregates, metrics, machine, machine_metric, dt, value)
+        for machine, machine_samples in block_samples.items():
+            for machine_metric, dt, value in \
+                    self.time_series.write_datapoints_block(
+                        tr, org, machine, machine_samples):
+                self.aggregate_datapoint(
+                    aggregates, metrics, machine, machine_metric, dt, value)
+        self.time_series.write_aggregates(tr, org, aggregates)
+        return metrics, self.update_metrics(tr, org, metrics)
+
+    def aggregate_datapoint(self, aggregates, metrics, machine,
+                            machine_metric, dt, value):
+        if not metrics.get(machine):
+            metrics[machine] = set()
+        metrics[machine].add(
+            (machine_metric, type(value).__name__))
+        self.time_series.aggregate_datapoint(
+            aggregates, machine, machine_metric, dt, value, self.resolutions)
+
+    def get_queue_id(self, line_batch):
+        return shard_map.get_queue_id(self.db, line_batch.machines[0])
+
+    def queue_retry_after(self, org, line_batch):
+        """Return the seconds after which the batch should be retried if
+        its queue is too deep, otherwise None."""
+        try:
+            return admission_control.retry_after(
+                self.db, self.get_queue_id(line_batch), org)
+        except fdb.FDBError as err:
+            # Don't reject writes because the depth couldn't be read
+            self.log.error("%s on queue_retry_after" % (
+                str(err.description, 'utf-8')))
+            return None
 
     @profile
-    def write_in_queue(self, org, data):
+    def write_in_queue(self, org, line_batch, data=None):
         try:
-            if not data:
+            if not line_batch:
                 return
-            db = self.open_db()
-            queue = Queue(get_queue_id(data))
-            queue.push(db, (org, data))
-            print("Pushed %d bytes" % len(data.encode('utf-8')))
+            if data is None:
+                data = line_batch.to_text()
+            queue = Queue(self.get_queue_id(line_batch))
+            queue.push(self.db, (org, data))
+            print("Pushed %d bytes" % len(
+                data if isinstance(data, bytes) else data.encode('utf-8')))
         except fdb.FDBError as err:
             error_msg = ("%s on write_in_queue(data)" % (
                 str(err.description, 'utf-8')))
@@ -237,56 +369,42 @@ class DBOperations:
             if not data:
                 return
 
-            # Create a list of lines
-            data = data.split('\n')
-            # Get rid of all empty lines
-            data = [line for line in data if line != ""]
-
-            metrics = set()
-            total_datapoints = 0
-            machine = ""
-            for line in data:
-                dict_line = parse_line(line)
-                machine = dict_line["tags"]["machine_id"]
-                total_datapoints += len(dict_line["fields"].items())
-                metric = generate_metric(
-                    dict_line["tags"], dict_line["measurement"])
-                for field, _ in dict_line["fields"].items():
-                    metrics.add(machine + "-" + metric + "-" + field)
+            line_batch = data
+            if not isinstance(data, LineBatch):
+                line_batch = LineBatch.from_payload(
+                    data, self.time_series.series_type)
+            if not line_batch:
+                return
 
             self.log.warning(("Request for resource: %s, number of metrics: %d," +
                               " number of datapoints: %d") % (
-                machine, len(metrics), total_datapoints))
+                ", ".join(line_batch.machines), line_batch.count_metrics(),
+                line_batch.count_datapoints()))
 
-            metrics = self.write_lines(self.db, org, data)
-            self.update_metrics(self.db, org, metrics)
+            self.write_lines(self.db, org, line_batch)
+        except PartialWrite as err:
+            error_msg = ("%s on write_in_kv(data) with resource_id: %s" % (
+                str(err), ", ".join(line_batch.machines)))
+            return error(503, error_msg, traceback=traceback.format_exc(),
+                         request=str(data))
         except fdb.FDBError as err:
             error_msg = ("%s on write_in_kv(data) with resource_id: %s" % (
                 str(err.description, 'utf-8'),
-                parse_line(data[0])["tags"]["machine_id"]))
+                ", ".join(line_batch.machines)))
             return error(503, error_msg, traceback=traceback.format_exc(),
                          request=str(data))
 
     @profile
     def write_in_kv(self, org, data):
-        self.write_in_kv_base(org, data)
+        return self.write_in_kv_base(org, data)
 
     @fdb.transactional
     def update_metrics(self, tr, org, new_metrics):
-        for machine, metrics in new_metrics.items():
-            current_metrics = self.time_series.find_metrics(
-                tr, org, machine)
-            timestamp_now = datetime.timestamp(datetime.now())
-            current_metrics = {
-                m for m in current_metrics.keys(
-                ) if not abs(timestamp_now - current_metrics.get(m, {}).get(
-                    "last_updated", 0)) / 60 > config('ACTIVE_METRIC_MINUTES') / 2
-            }
-            for metric, metric_type in metrics:
-                if not (metric in current_metrics):
-                    self.time_series.add_metric(tr, org,
-                                                (machine, metric),
-                                                metric_type)
+        return self.time_series.add_metrics(tr, org, {
+            (machine, metric): metric_type
+            for machine, metrics in new_metrics.items()
+            for metric, metric_type in metrics
+        })
 
     async def async_fetch_list(self, org, multiple_resources_and_metrics, start="",
                                stop="", authorized_resources=None):
@@ -0,0 +1,68 @@
+import fdb
+import threading
+from collections import OrderedDict
+from .helpers import config
+
+fdb.api_version(620)
+
+
+class DirectoryCache:
+    """Process wide LRU cache of resolved directory layer subspaces.
+
+    Directories are always resolved in their own transaction, so that a
+    cached prefix never belongs to a directory whose creation was rolled
+    back together with the transaction that asked for it.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.dirs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        with self.lock:
+            directory = self.dirs.get(path)
+            if directory is not None:
+                self.dirs.move_to_end(path)
+            return directory
+
+    def put(self, path, directory):
+        with self.lock:
+            self.dirs[path] = directory
+            self.dirs.move_to_end(path)
+            while len(self.dirs) > self.max_size:
+                self.dirs.popitem(last=False)
+        return directory
+
+    def create_or_open(self, tr, path):
+        if config('DO_NOT_CACHE_FDB_DIRS'):
+            return fdb.directory.create_or_open(tr, path)
+        directory = self.get(path)
+        if directory is None:
+            directory = self.put(path, fdb.directory.create_or_open(
+                getattr(tr, 'db', tr), path))
+        return directory
+
+    def open(self, tr, path):
+        """Open a directory without creating it, returns None if it
+        doesn't exist."""
+        directory = None if config('DO_NOT_CACHE_FDB_DIRS') \
+            else self.get(path)
+        if directory is None:
+            try:
+                directory = fdb.directory.open(tr, path)
+            except ValueError:
+                return None
+            if not config('DO_NOT_CACHE_FDB_DIRS'):
+                self.put(path, directory)
+        return directory
+
+    def invalidate(self, path):
+        """Drop a directory and all of its subdirectories from the cache."""
+        with self.lock:
+            for cached_path in list(self.dirs):
+                if cached_path[:len(path)] == path:
+                    del self.dirs[cached_path]
+
+
+directory_cache = DirectoryCache(config('FDB_DIRS_CACHE_SIZE'))
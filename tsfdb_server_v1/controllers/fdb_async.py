@@ -0,0 +1,53 @@
+import asyncio
+import fdb
+
+fdb.api_version(620)
+
+
+def wait(future):
+    """Return an asyncio future which resolves to the result of an fdb
+    future, without blocking a thread while it's pending."""
+    loop = asyncio.get_event_loop()
+    result = loop.create_future()
+
+    def resolve():
+        if result.cancelled():
+            return
+        # The fdb future is ready, so this doesn't block
+        try:
+            result.set_result(future.wait())
+        except Exception as err:
+            result.set_exception(err)
+
+    # on_ready callbacks run in the network thread
+    future.on_ready(lambda _: loop.call_soon_threadsafe(resolve))
+    return result
+
+
+async def get_range(tr, begin, end, streaming_mode=fdb.StreamingMode.want_all):
+    """Read all the key values of [begin, end), awaiting every batch of
+    the range instead of blocking on it like tr.get_range does."""
+    begin = fdb.KeySelector.first_greater_or_equal(begin)
+    end = fdb.KeySelector.first_greater_or_equal(end)
+    kvs = []
+    iteration = 1
+    while True:
+        batch, _, more = await wait(tr._get_range(
+            begin, end, 0, streaming_mode, iteration, False))
+        kvs += batch
+        if not more or not batch:
+            return kvs
+        begin = fdb.KeySelector.first_greater_than(batch[-1].key)
+        iteration += 1
+
+
+async def transact(db, func, *args, **kwargs):
+    """Run the coroutine func(tr, *args, **kwargs) in a new transaction,
+    retrying it on retryable errors like fdb.transactional does. Meant for
+    reads, the transaction isn't committed."""
+    tr = db.create_transaction()
+    while True:
+        try:
+            return await func(tr, *args, **kwargs)
+        except fdb.FDBError as err:
+            await wait(tr.on_error(err))
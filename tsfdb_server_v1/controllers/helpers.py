@@ -5,8 +5,9 @@ import logging
 import json
 import time
 import os
+import hashlib
 from datetime import datetime, timedelta
-from line_protocol_parser import parse_line
+from functools import lru_cache
 from tsfdb_server_v1.models.error import Error  # noqa: E501
 
 log = logging.getLogger(__name__)
@@ -44,6 +45,11 @@ def error(code, error_msg, traceback=None, request=None):
     return Error(code, error_msg)
 
 
+def too_many_requests(retry_after):
+    return Error(429, "Too many requests, retry after %ds" % retry_after), \
+        429, {'Retry-After': str(retry_after)}
+
+
 def metric_to_dict(metric, metric_type, timestamp=0):
     return {
         metric: {
@@ -113,11 +119,14 @@ def decrement_time(dt, resolution):
 
 
 def generate_metric(tags, measurement):
-    tags.pop("machine_id", None)
-    tags.pop("host", None)
-    metric = measurement
     # First sort the tags in alphanumeric order
-    tags = sorted(tags.items())
+    tags = tuple(sorted((tag, value) for tag, value in tags.items()
+                        if tag not in ("machine_id", "host")))
+    return generate_metric_from_sorted_tags(tags, measurement)
+
+
+def generate_metric_from_sorted_tags(tags, measurement):
+    metric = measurement
     # Then promote the tags which have the same name as the measurement
     tags = sorted(tags, key=lambda item: item[0] == measurement, reverse=True)
     for tag, value in tags:
@@ -158,7 +167,7 @@ def div_datapoints(datapoints1, datapoints2):
 def profile(func):
     def wrap(*args, **kwargs):
         begin = time.time()
-        func(*args, **kwargs)
+        result = func(*args, **kwargs)
         end = time.time()
         dt = int((end - begin)*1000)
         timestamp = str(int(datetime.now().timestamp())) + 9 * '0'
@@ -172,9 +181,11 @@ def profile(func):
                         "stats,machine_id=tsfdb,func=%s" +
                         " latency=%f %s") %
                         (func.__name__, dt, timestamp))
-                    from tsfdb_server_v1.controllers.db import DBOperations
-                    db_ops = DBOperations()
+                    from tsfdb_server_v1.controllers.db import \
+                        get_db_operations
+                    db_ops = get_db_operations()
                     db_ops.write_in_kv_base("tsfdb", line + "\n")
+        return result
 
     return wrap
 
@@ -202,35 +213,92 @@ def print_trace(func):
     return wrap
 
 
-def config(name):
-    config_dict = {
+@lru_cache(maxsize=None)
+def load_config():
+    # The environment is read once per process
+    return {
         'AGGREGATE_MINUTE': (os.getenv('AGGREGATE_MINUTE', 'True') == 'True'),
         'AGGREGATE_HOUR': (os.getenv('AGGREGATE_HOUR', 'True') == 'True'),
         'AGGREGATE_DAY': (os.getenv('AGGREGATE_DAY', 'True') == 'True'),
         'DO_NOT_CACHE_FDB_DIRS':
         (os.getenv('DO_NOT_CACHE_FDB_DIRS', 'False') == 'True'),
+        'FDB_DIRS_CACHE_SIZE': int(os.getenv('FDB_DIRS_CACHE_SIZE', 10000)),
         'TRANSACTION_RETRY_LIMIT':
         int(os.getenv('TRANSACTION_RETRY_LIMIT', 0)),
         'TRANSACTION_TIMEOUT': int(os.getenv('TRANSACTION_TIMEOUT', 2000)),
+        'TRANSACTION_MAX_BYTES':
+        int(os.getenv('TRANSACTION_MAX_BYTES', 1000000)),
         'CHECK_DUPLICATES': (os.getenv('CHECK_DUPLICATES', 'False') == 'True'),
+        'SECOND_BLOCKS': (os.getenv('SECOND_BLOCKS', 'False') == 'True'),
         'TSFDB_URI': os.getenv('TSFDB_URI', "http://localhost:8080"),
         'TSFDB_NOTIFICATIONS_WEBHOOK':
         os.getenv('TSFDB_NOTIFICATIONS_WEBHOOK'),
         'ACQUIRE_TIMEOUT': float(os.getenv('ACQUIRE_TIMEOUT', 30)),
+        'QUEUE_LEASE_SECONDS': float(os.getenv('QUEUE_LEASE_SECONDS', 10)),
+        'QUEUE_STEAL_SECONDS': float(os.getenv('QUEUE_STEAL_SECONDS', 30)),
+        'QUEUE_ACQUIRE_CANDIDATES':
+        int(os.getenv('QUEUE_ACQUIRE_CANDIDATES', 100)),
         'CONSUME_TIMEOUT': float(os.getenv('CONSUME_TIMEOUT', 1)),
         'QUEUE_RETRY_TIMEOUT': int(os.getenv('QUEUE_RETRY_TIMEOUT', 5)),
+        'QUEUE_WAKEUP_INTERVAL':
+        float(os.getenv('QUEUE_WAKEUP_INTERVAL', 0.1)),
+        'CONSUMER_QUEUES': int(os.getenv('CONSUMER_QUEUES', 1)),
+        'CONSUMER_PIPELINE_DEPTH':
+        int(os.getenv('CONSUMER_PIPELINE_DEPTH', 2)),
+        'CONSUMER_MAX_IN_FLIGHT':
+        int(os.getenv('CONSUMER_MAX_IN_FLIGHT', 0)),
+        'CONSUMER_ERROR_BACKOFF':
+        float(os.getenv('CONSUMER_ERROR_BACKOFF', 1)),
         'QUEUE_TRANSACTION_RETRY_LIMIT':
         int(os.getenv('QUEUE_TRANSACTION_RETRY_LIMIT', 3)),
+        'QUEUE_COMPRESSION': os.getenv('QUEUE_COMPRESSION', 'none'),
+        'QUEUE_CHUNK_BYTES': int(os.getenv('QUEUE_CHUNK_BYTES', 90000)),
+        'CONSUME_EXACTLY_ONCE':
+        (os.getenv('CONSUME_EXACTLY_ONCE', 'True') == 'True'),
+        'QUEUE_POP_ITEMS': int(os.getenv('QUEUE_POP_ITEMS', 100)),
+        'QUEUE_VISIBILITY_TIMEOUT':
+        float(os.getenv('QUEUE_VISIBILITY_TIMEOUT', 0)),
+        'QUEUE_SHARE_ITEMS': int(os.getenv('QUEUE_SHARE_ITEMS', 1000)),
+        'QUEUE_POP_BYTES': int(os.getenv('QUEUE_POP_BYTES', 1000000)),
+        'DEAD_LETTER_MAX_RETRIES':
+        int(os.getenv('DEAD_LETTER_MAX_RETRIES', 5)),
+        'DEAD_LETTER_BACKOFF': float(os.getenv('DEAD_LETTER_BACKOFF', 10)),
+        'QUEUE_MAX_ITEMS': int(os.getenv('QUEUE_MAX_ITEMS', 100000)),
+        'QUEUE_MAX_BYTES': int(os.getenv('QUEUE_MAX_BYTES', 268435456)),
+        'QUEUE_SHED_RATIO': float(os.getenv('QUEUE_SHED_RATIO', 0.5)),
+        'QUEUE_STATS_TTL': float(os.getenv('QUEUE_STATS_TTL', 2)),
+        'QUEUE_STATS_CACHE_SIZE':
+        int(os.getenv('QUEUE_STATS_CACHE_SIZE', 10000)),
+        'QUEUE_RETRY_AFTER': int(os.getenv('QUEUE_RETRY_AFTER', 30)),
+        'LOW_PRIORITY_ORGS':
+        set(filter(None, os.getenv('LOW_PRIORITY_ORGS', '').split(','))),
         'WRITE_IN_QUEUE': (os.getenv('WRITE_IN_QUEUE', 'True') == 'True'),
+        'INGEST_BATCH_BYTES': int(os.getenv('INGEST_BATCH_BYTES', 1000000)),
+        'PROMETHEUS_MACHINE_LABEL':
+        os.getenv('PROMETHEUS_MACHINE_LABEL', 'machine_id'),
         'SECONDS_RANGE': int(os.getenv('SECONDS_RANGE', 1)),
         'MINUTES_RANGE': int(os.getenv('MINUTES_RANGE', 48)),
         'HOURS_RANGE': int(os.getenv('HOURS_RANGE', 1440)),
         'QUEUES': int(os.getenv('QUEUES', -1)),
+        'SHARD_MAP_TTL': float(os.getenv('SHARD_MAP_TTL', 30)),
         'STATS_LOG_RATE': int(os.getenv('STATS_LOG_RATE', -1)),
         'DATAPOINTS_PER_READ': int(os.getenv('DATAPOINTS_PER_READ', 200)),
-        'ACTIVE_METRIC_MINUTES': int(os.getenv('ACTIVE_METRIC_MINUTES', 60))
+        'ACTIVE_METRIC_MINUTES': int(os.getenv('ACTIVE_METRIC_MINUTES', 60)),
+        'METRIC_NAMES_CACHE_SIZE':
+        int(os.getenv('METRIC_NAMES_CACHE_SIZE', 100000)),
+        'METRIC_CATALOG_SIZE': int(os.getenv('METRIC_CATALOG_SIZE', 100000))
     }
-    return config_dict.get(name)
+
+
+def config(name):
+    return load_config().get(name)
+
+
+# Metric names only depend on the measurement and the tag set, which
+# repeat on every flush of an agent
+generate_metric_from_sorted_tags = lru_cache(
+    maxsize=config('METRIC_NAMES_CACHE_SIZE'))(
+        generate_metric_from_sorted_tags)
 
 
 def time_range_to_resolution(time_range_in_hours):
@@ -252,32 +320,89 @@ def get_fallback_resolution(resolution):
     return fallback_resolutions.get(resolution)
 
 
-def separate_metrics(data):
-    data = data.split('\n')
-    # Get rid of all empty lines
-    data = [line for line in data if line != ""]
-    data_tsfdb = []
-    data_rest = []
-    for line in data:
-        if parse_line(line)["tags"]["machine_id"] == "tsfdb":
-            data_tsfdb.append(line)
-        else:
-            data_rest.append(line)
-    return '\n'.join(data_tsfdb), '\n'.join(data_rest)
+def jump_hash(key, buckets):
+    """Jump consistent hash by Lamping and Veach, going from n to n + 1
+    buckets moves only 1 / (n + 1) of the keys."""
+    bucket, j = -1, 0
+    while j < buckets:
+        bucket = j
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
 
 
-def get_machine_id(data):
-    data = data.split('\n')
-    # Get rid of all empty lines
-    data = [line for line in data if line != ""]
-    return parse_line(data[0])["tags"]["machine_id"]
+def stable_hash(value):
+    # Unlike hash(), this is the same in every process
+    return int.from_bytes(hashlib.blake2b(
+        value.encode('utf-8'), digest_size=8).digest(), 'big')
 
 
-def get_queue_id(data):
-    machine_id = get_machine_id(data)
-    if config('QUEUES') == -1:
+def get_queue_id(machine_id, queues=None):
+    if queues is None:
+        queues = config('QUEUES')
+    if queues == -1:
         return machine_id
-    return 'q' + str(hash(machine_id) % config('QUEUES'))
+    return 'q' + str(jump_hash(stable_hash(machine_id), queues))
+
+
+def estimate_mutation_bytes(metric, fields):
+    # Every field is written once in second resolution plus 4 atomic
+    # operations (count, sum, min, max) for each of minute, hour and day.
+    # Keys contain the metric, the field and the packed date tuple.
+    size = 0
+    for field in fields:
+        key_size = len(metric) + len(field) + 32
+        size += 13 * (key_size + 16)
+    return size
+
+
+def split_in_batches(parsed_lines, max_bytes):
+    # The lines of a (machine, metric) are kept in the same batch, so that
+    # batches which are committed concurrently only share the aggregate
+    # keys, which are updated with atomic operations, and don't conflict
+    groups = {}
+    for parsed_line in parsed_lines:
+        machine, metric, _, fields = parsed_line
+        group = groups.setdefault((machine, metric), [[], 0])
+        group[0].append(parsed_line)
+        group[1] += estimate_mutation_bytes(metric, fields)
+    batches = [[]]
+    batch_size = 0
+    for lines, size in groups.values():
+        if batches[-1] and batch_size + size > max_bytes:
+            batches.append([])
+            batch_size = 0
+        batches[-1].extend(lines)
+        batch_size += size
+    return batches
+
+
+def split_batch(batch):
+    # Split a batch in two halves which, when possible, don't share any
+    # (machine, metric, minute), so that no block is in both
+    def minute(parsed_line):
+        machine, metric, dt, _ = parsed_line
+        return machine, metric, dt.replace(second=0, microsecond=0)
+
+    batch = sorted(batch, key=lambda parsed_line: parsed_line[:3])
+    middle = cut = len(batch) // 2
+    while cut < len(batch) and minute(batch[cut]) == minute(batch[cut - 1]):
+        cut += 1
+    if cut == len(batch):
+        cut = middle
+        while cut > 0 and minute(batch[cut]) == minute(batch[cut - 1]):
+            cut -= 1
+    if cut == 0:
+        cut = middle
+    return batch[:cut], batch[cut:]
+
+
+def merge_metrics(metrics, new_metrics):
+    for machine, machine_metrics in new_metrics.items():
+        if not metrics.get(machine):
+            metrics[machine] = set()
+        metrics[machine] |= machine_metrics
+    return metrics
 
 
 def filter_artifacts(start, stop, datapoints):
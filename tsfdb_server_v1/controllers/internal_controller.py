@@ -1,9 +1,13 @@
 import connexion
 import six
 
+from tsfdb_server_v1.models.dead_letter import DeadLetter  # noqa: E501
 from tsfdb_server_v1.models.error import Error  # noqa: E501
+from tsfdb_server_v1.models.replayed_dead_letters import ReplayedDeadLetters  # noqa: E501
 from tsfdb_server_v1 import util
 from tsfdb_server_v1.controllers.internal_metrics import InternalMetrics
+from tsfdb_server_v1.controllers.db import get_db
+from tsfdb_server_v1.controllers.queue import Queue
 from prometheus_client import CollectorRegistry, Gauge
 from prometheus_client.exposition import _bake_output
 
@@ -24,3 +28,56 @@ def list_internal_metrics():  # noqa: E501
         g.set(v)
     _, _, output = _bake_output(registry, '', {})
     return output.decode("utf-8")
+
+
+def list_dead_letters(queue_name):  # noqa: E501
+    """Return the items of a queue which failed to be consumed
+
+     # noqa: E501
+
+    :param queue_name: The name of the queue
+    :type queue_name: str
+
+    :rtype: List[DeadLetter]
+    """
+    return [DeadLetter(**letter)
+            for letter in Queue(queue_name).list_dead_letters(get_db())]
+
+
+def replay_dead_letters(queue_name, letter_id=None, limit=None):  # noqa: E501
+    """Push dead letters back to their queue
+
+     # noqa: E501
+
+    :param queue_name: The name of the queue
+    :type queue_name: str
+    :param letter_id: The id of the dead letter to replay, all if omitted
+    :type letter_id: str
+    :param limit: How many dead letters to replay at most when letterId is omitted
+    :type limit: int
+
+    :rtype: ReplayedDeadLetters
+    """
+    queue = Queue(queue_name)
+    if letter_id is not None:
+        try:
+            replayed = queue.replay_dead_letters(get_db(), letter_id)
+        except ValueError:
+            return Error(400, "Bad request")
+        if not replayed:
+            return Error(404, "Dead letter not found")
+        return ReplayedDeadLetters(replayed)
+    if limit is None:
+        limit = 1000
+    if limit < 1:
+        return Error(400, "Bad request")
+    # Replay in transactions of up to 100 dead letters, until there are
+    # none left or limit of them were replayed
+    replayed = 0
+    while replayed < limit:
+        batch = queue.replay_dead_letters(
+            get_db(), limit=min(100, limit - replayed))
+        if not batch:
+            break
+        replayed += batch
+    return ReplayedDeadLetters(replayed)
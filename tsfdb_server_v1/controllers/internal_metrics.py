@@ -4,6 +4,7 @@ import requests
 import os
 from datetime import datetime
 from tsfdb_server_v1.controllers.queue import Queue
+from tsfdb_server_v1.controllers.db import get_db
 
 fdb.api_version(620)
 ACTIVE_METRIC_MINUTES = int(os.getenv('ACTIVE_METRIC_MINUTES', 60))
@@ -11,12 +12,15 @@ ACTIVE_METRIC_MINUTES = int(os.getenv('ACTIVE_METRIC_MINUTES', 60))
 
 class InternalMetrics:
     def __init__(self):
-        self.db = fdb.open()
-        self.db.options.set_transaction_timeout(10000)
+        # The database handle is shared with the API, so the longer timeout
+        # is only set on the transaction which reads the status
+        self.db = get_db()
         self.update_status()
 
     def update_status(self):
-        self.status = json.loads(self.db[b'\xff\xff/status/json'])
+        tr = self.db.create_transaction()
+        tr.options.set_timeout(10000)
+        self.status = json.loads(tr[b'\xff\xff/status/json'].wait())
 
     def generate_tsfdb_queues_metrics(self):
         try:
@@ -28,8 +32,9 @@ class InternalMetrics:
                     1):
 
                 name = available_queues_subspace.unpack(k)[0]
-                metric = {f"tsfdb.queue.{name}": Queue(
-                    name).count_items(self.db)}
+                items, size = Queue(name).get_stats(self.db)
+                metric = {f"tsfdb.queue.{name}": items,
+                          f"tsfdb.queue_bytes.{name}": size}
                 metrics.update(metric)
             metric = {"tsfdb.queue.count": count}
             metrics.update(metric)
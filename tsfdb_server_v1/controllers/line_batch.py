@@ -0,0 +1,198 @@
+import math
+import zlib
+from datetime import datetime
+from line_protocol_parser import parse_line, LineFormatError
+from .helpers import generate_metric, config
+from .remote_write import decode_write_request
+try:
+    import zstandard
+    DECOMPRESSION_ERRORS = (zlib.error, zstandard.ZstdError)
+except ImportError:
+    zstandard = None
+    DECOMPRESSION_ERRORS = (zlib.error,)
+
+CHUNK_SIZE = 65536
+
+
+def decompress_chunks(body, content_encoding=None):
+    """Yield the decompressed body in chunks of bounded size."""
+    content_encoding = (content_encoding or "identity").strip().lower()
+    if content_encoding == "identity":
+        body = memoryview(body)
+        for start in range(0, len(body), CHUNK_SIZE):
+            yield body[start:start + CHUNK_SIZE]
+        return
+    if content_encoding in ("gzip", "x-gzip"):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif content_encoding == "deflate":
+        decompressor = zlib.decompressobj()
+    elif content_encoding == "zstd" and zstandard is not None:
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    else:
+        raise ValueError("Unsupported Content-Encoding: %s" % content_encoding)
+    body = memoryview(body)
+    try:
+        for start in range(0, len(body), CHUNK_SIZE):
+            chunk = decompressor.decompress(body[start:start + CHUNK_SIZE])
+            if chunk:
+                yield chunk
+        chunk = decompressor.flush()
+    except DECOMPRESSION_ERRORS as err:
+        raise ValueError("Invalid %s request body: %s" % (
+            content_encoding, str(err)))
+    if chunk:
+        yield chunk
+
+
+def iter_lines(chunks):
+    """Split a stream of byte chunks in lines, decoding only one line at
+    a time."""
+    rest = b''
+    for chunk in chunks:
+        data = rest + chunk if rest else bytes(chunk)
+        view = memoryview(data)
+        start = 0
+        end = data.find(b'\n')
+        while end != -1:
+            # Get rid of all empty lines
+            if end > start:
+                yield str(view[start:end], 'utf-8')
+            start = end + 1
+            end = data.find(b'\n', start)
+        rest = data[start:]
+    if rest:
+        yield str(rest, 'utf-8')
+
+
+class LineBatch:
+    """Line protocol payload parsed once and grouped by machine.
+
+    For every machine we keep the raw lines, which are pushed to the queue,
+    and the parsed datapoints as (metric, dt, fields) tuples. Batches
+    decoded from other formats only have datapoints.
+    """
+
+    def __init__(self, series_type="monitoring"):
+        self.series_type = series_type
+        self.lines = {}
+        self.datapoints = {}
+
+    @classmethod
+    def from_text(cls, data, series_type="monitoring"):
+        batch = cls(series_type)
+        for line in data.split('\n'):
+            # Get rid of all empty lines
+            if line != "":
+                batch.add_line(line)
+        return batch
+
+    @classmethod
+    def iter_from_body(cls, body, content_encoding=None,
+                       series_type="monitoring"):
+        """Parse a, possibly compressed, line protocol request body in
+        batches of at most INGEST_BATCH_BYTES of lines."""
+        batch, batch_size = cls(series_type), 0
+        for line in iter_lines(decompress_chunks(body, content_encoding)):
+            batch.add_line(line)
+            batch_size += len(line)
+            if batch_size >= config('INGEST_BATCH_BYTES'):
+                yield batch
+                batch, batch_size = cls(series_type), 0
+        if batch:
+            yield batch
+
+    @classmethod
+    def from_remote_write(cls, data, series_type="monitoring"):
+        batch = cls(series_type)
+        for labels, samples in decode_write_request(data):
+            machine = labels.pop(config('PROMETHEUS_MACHINE_LABEL'), None) \
+                or labels.pop('instance', None)
+            if not machine:
+                continue
+            measurement = labels.pop('__name__', '')
+            metric = generate_metric(labels, measurement)
+            for timestamp, value in samples:
+                # NaN is used by Prometheus as a staleness marker, neither
+                # it nor infinities can be aggregated as integers
+                if not math.isfinite(value):
+                    continue
+                batch.add_datapoint(
+                    machine, metric,
+                    datetime.fromtimestamp(timestamp // 1000),
+                    {"value": value})
+        return batch
+
+    @classmethod
+    def from_payload(cls, data, series_type="monitoring"):
+        # Queued payloads are line protocol text or remote_write requests
+        if isinstance(data, bytes):
+            return cls.from_remote_write(data, series_type)
+        return cls.from_text(data, series_type)
+
+    def add_line(self, line):
+        # Malformed lines raise ValueError, like the other decoding errors
+        try:
+            dict_line = parse_line(line)
+        except LineFormatError as err:
+            raise ValueError("Invalid line: %s" % str(err))
+        machine = dict_line["tags"].get("machine_id")
+        if not machine:
+            raise ValueError("Line without machine_id: %s" % line[:100])
+        metric = generate_metric(
+            dict_line["tags"], dict_line["measurement"])
+        dt = datetime.fromtimestamp(int(str(dict_line["time"])[:10]))
+        if self.series_type == 'metering':
+            dt = datetime.now()
+        if not self.lines.get(machine):
+            self.lines[machine] = []
+        self.lines[machine].append(line)
+        self.add_datapoint(machine, metric, dt, dict_line["fields"])
+
+    def add_datapoint(self, machine, metric, dt, fields):
+        if not self.datapoints.get(machine):
+            self.datapoints[machine] = []
+        self.datapoints[machine].append((metric, dt, fields))
+
+    def extend(self, other):
+        """Append the lines and datapoints of another batch."""
+        for machine, lines in other.lines.items():
+            self.lines.setdefault(machine, []).extend(lines)
+        for machine, datapoints in other.datapoints.items():
+            self.datapoints.setdefault(machine, []).extend(datapoints)
+        return self
+
+    def __bool__(self):
+        return bool(self.datapoints)
+
+    @property
+    def machines(self):
+        return list(self.datapoints)
+
+    def items(self):
+        for machine, datapoints in self.datapoints.items():
+            for metric, dt, fields in datapoints:
+                yield machine, metric, dt, fields
+
+    def count_datapoints(self):
+        return sum(len(fields) for _, _, _, fields in self.items())
+
+    def count_metrics(self):
+        return len({(machine, metric, field)
+                    for machine, metric, _, fields in self.items()
+                    for field in fields})
+
+    def separate(self, machines):
+        """Split the batch in two, the lines of the given machines and the
+        rest."""
+        selected, rest = LineBatch(self.series_type), \
+            LineBatch(self.series_type)
+        for machine in self.machines:
+            batch = selected if machine in machines else rest
+            if self.lines.get(machine):
+                batch.lines[machine] = self.lines[machine]
+            batch.datapoints[machine] = self.datapoints[machine]
+        return selected, rest
+
+    def to_text(self):
+        return '\n'.join(line for lines in self.lines.values()
+                         for line in lines)
@@ -1,15 +1,19 @@
 import connexion
 import six
+import logging
 
 from RestrictedPython import compile_restricted
 from RestrictedPython import safe_builtins
 from tsfdb_server_v1.models.datapoints_response import DatapointsResponse  # noqa: E501
 from tsfdb_server_v1.models.error import Error  # noqa: E501
 from tsfdb_server_v1 import util
-from .db import DBOperations
+from .db import get_db_operations
+from .line_batch import LineBatch
 from .query_funcs import deriv, roundX, roundY, topk, mean
 from .query_funcs import fetch_metering as fetch
 
+log = logging.getLogger(__name__)
+
 
 def fetch_metering_datapoints(query, x_org_id, x_allowed_resources=None):  # noqa: E501
     """Return metering datapoints within a given time range for given resources &amp; metric name patterns
@@ -45,7 +49,7 @@ def fetch_metering_datapoints(query, x_org_id, x_allowed_resources=None):  # noq
         return DatapointsResponse(query=str(query), series=data)
 
 
-def write_metering_datapoints(x_org_id, body):  # noqa: E501
+def write_metering_datapoints(x_org_id, body, content_encoding=None):  # noqa: E501
     """Write metering datapoints to db
 
      # noqa: E501
@@ -54,9 +58,19 @@ def write_metering_datapoints(x_org_id, body):  # noqa: E501
     :type x_org_id: str
     :param body: Datapoints object to write
     :type body: str
+    :param content_encoding: Compression of the body (gzip, deflate, zstd)
+    :type content_encoding: str
 
     :rtype: None
     """
-    db_ops = DBOperations(series_type="metering")
-    body = str(body, 'utf8')
-    db_ops.write_in_kv(x_org_id, body)
+    db_ops = get_db_operations(series_type="metering")
+    # The whole body is parsed before the first write, so that a malformed
+    # line is rejected before any of the lines is written
+    try:
+        line_batches = list(LineBatch.iter_from_body(
+            body, content_encoding, series_type="metering"))
+    except ValueError as e:
+        log.error("Error when decoding request body: %s", str(e))
+        return Error(400, "Bad request")
+    for line_batch in line_batches:
+        db_ops.write_in_kv(x_org_id, line_batch)
@@ -0,0 +1,36 @@
+import threading
+from collections import OrderedDict
+from .helpers import config
+
+
+class MetricCatalog:
+    """Process wide LRU catalog of the metrics known to be registered in
+    available_metrics, as {(series_type, org, resource, metric):
+    (metric_type, last_refreshed)}.
+
+    Entries must only be added after the transaction that wrote them has
+    been committed.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.metrics = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.metrics.get(key)
+            if entry is not None:
+                self.metrics.move_to_end(key)
+            return entry
+
+    def update(self, entries):
+        with self.lock:
+            for key, entry in entries.items():
+                self.metrics[key] = entry
+                self.metrics.move_to_end(key)
+            while len(self.metrics) > self.max_size:
+                self.metrics.popitem(last=False)
+
+
+metric_catalog = MetricCatalog(config('METRIC_CATALOG_SIZE'))
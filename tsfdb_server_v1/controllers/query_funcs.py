@@ -7,7 +7,7 @@ import json
 from .helpers import round_base, error, parse_relative_time_to_seconds, \
     parse_start_stop_params
 from datetime import datetime
-from .db import DBOperations
+from .db import get_db_operations
 from tsfdb_server_v1.models.error import Error  # noqa: E501
 
 log = logging.getLogger(__name__)
@@ -78,11 +78,11 @@ def fetch(db_ops, resources_and_metrics, start="", stop="", step=""):
     return data
 
 def fetch_monitoring(resources_and_metrics, start="", stop="", step=""):
-    db_ops = DBOperations()
+    db_ops = get_db_operations()
     return fetch(db_ops, resources_and_metrics, start, stop, step)
 
 def fetch_metering(resources_and_metrics, start="", stop="", step=""):
-    db_ops = DBOperations("metering")
+    db_ops = get_db_operations("metering")
     return fetch(db_ops, resources_and_metrics, start, stop, step)
 
 def deriv(data):
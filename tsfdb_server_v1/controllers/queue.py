@@ -18,85 +18,527 @@
 # limitations under the License.
 #
 
-import os
+import struct
+import threading
+import zlib
 import fdb
 import fdb.tuple
-from datetime import datetime
+from time import time, sleep
 from .helpers import config
+from .directory_cache import directory_cache
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 fdb.api_version(620)
 
+# Items are either a packed (org, data) tuple, which always starts with
+# the tuple type code of a string (0x02), or an envelope whose first byte
+# holds the envelope format version and the codec of the packed tuple
+ENVELOPE_VERSION = 1
+CODECS = {'zlib': 0, 'zstd': 1}
+
+# Bumped when a queue is created, deleted or released by its consumer,
+# idle consumers watch it to wake up when there may be a queue to acquire.
+# Pushes to queues which exist only wake up their own consumer.
+QUEUES_SIGNAL = fdb.tuple.pack(('queues_signal',))
+
+
+def signal_queues(tr):
+    tr.add(QUEUES_SIGNAL, struct.pack('<q', 1))
+
+
+def pack_item(value, compression=None):
+    item = fdb.tuple.pack((*value,))
+    compression = compression or config('QUEUE_COMPRESSION')
+    if compression == 'zstd' and zstandard is None:
+        compression = 'zlib'
+    if compression == 'zlib':
+        item = zlib.compress(item)
+    elif compression == 'zstd':
+        item = zstandard.ZstdCompressor().compress(item)
+    else:
+        return item
+    return bytes((ENVELOPE_VERSION << 4 | CODECS[compression],)) + item
+
+
+def unpack_item(item):
+    item = bytes(item)
+    if item[:1] == b'\x02':
+        return fdb.tuple.unpack(item)
+    version, codec = item[0] >> 4, item[0] & 0x0f
+    if version != ENVELOPE_VERSION:
+        raise ValueError("Unsupported queue item version: %d" % version)
+    if codec == CODECS['zlib']:
+        return fdb.tuple.unpack(zlib.decompress(item[1:]))
+    if codec == CODECS['zstd'] and zstandard is not None:
+        return fdb.tuple.unpack(
+            zstandard.ZstdDecompressor().decompress(item[1:]))
+    raise ValueError("Unsupported queue item codec: %d" % codec)
+
+
+def wait_for_watch(watch, timeout):
+    """Block until the watch fires or for at most timeout seconds, returns
+    whether the watch fired."""
+    start = time()
+    fired = threading.Event()
+    watch.on_ready(lambda _: fired.set())
+    if not fired.wait(timeout):
+        watch.cancel()
+        return False
+    try:
+        watch.wait()
+        return True
+    except fdb.FDBError:
+        # e.g. too many watches, fall back to polling
+        sleep(max(timeout - (time() - start), 0))
+        return False
+
+
+def unpack_counter(value):
+    return struct.unpack('<q', bytes(value))[0] if value.present() else 0
+
+
+def parse_lease(value):
+    """Leases are (owner, expires, last progress) tuples, before them the
+    lock held the (timestamp,) of the last pop of any consumer."""
+    lease = fdb.tuple.unpack(value)
+    if len(lease) == 1:
+        return None, lease[0] + config('ACQUIRE_TIMEOUT'), lease[0]
+    return lease
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def is_chunk(key):
+    """Items are keyed (versionstamp,) or, before versionstamped keys,
+    (index, item id). Chunks of split items have the chunk number
+    appended to the key of the item."""
+    return len(key) > 1 and isinstance(key[-1], int)
+
 
 class Queue:
     def __init__(self, name):
         self._name = name
         self.consumer_lock = fdb.Subspace(('consumer_lock', name))
         self.available_queue = fdb.Subspace(('available_queues', name))
+        # Number of items and bytes in the queue, maintained with atomic
+        # adds in the transactions which push and remove items, so that
+        # the depth of a queue can be read without a scan. 'counted' is set
+        # once the counters include every item of the queue.
+        self.stats = fdb.Subspace(('queue_stats', name))
+        # Items which failed to be consumed, with the reason and the number
+        # of retries, and the times their next retries are due
+        self.dead_letters = fdb.Subspace(('dead_letters', name))
+        self.dead_letter_retries = fdb.Subspace(
+            ('dead_letter_retries', name))
+        # Claims of the items being consumed, {item key: (owner, until)}
+        self.claims = fdb.Subspace(('queue_claims', name))
 
     @property
     def name(self):
         return self._name
 
     @fdb.transactional
-    def register_queue(self, tr):
-        tr[self.available_queue] = fdb.tuple.pack((0,))
+    def register_queue(self, tr, prefix):
+        # The prefix of the queue directory is kept with the registration,
+        # so that pushes notice when the queue was deleted and created
+        # again under a new prefix since they cached it
+        tr[self.available_queue] = fdb.tuple.pack((0, prefix))
+
+    def registered_prefix(self, registration):
+        """Return the directory prefix of a registration value, None for
+        registrations written before it was kept."""
+        registration = fdb.tuple.unpack(registration)
+        return registration[1] if len(registration) > 1 else None
 
     @fdb.transactional
-    def pop(self, tr):
-        item = self.first_item(tr)
-        # Update the timestamp in order to indicate
-        # that this queue is being served by a consumer
+    def get_lease(self, tr):
+        value = tr[self.consumer_lock]
+        return parse_lease(value) if value.present() else None
+
+    def set_lease(self, tr, owner, progress):
         tr[self.consumer_lock] = fdb.tuple.pack(
-            (int(datetime.now().timestamp()),))
-        if item is None:
-            return None
-        del tr[item.key]
-        return item.value
+            (owner, time() + config('QUEUE_LEASE_SECONDS'), progress))
 
     @fdb.transactional
-    def push(self, tr, value):
-        tr.options.set_retry_limit(config('QUEUE_TRANSACTION_RETRY_LIMIT'))
-        self.queue = fdb.directory.create_or_open(tr, ('queue', self.name))
-        tr[self.queue[self.last_index(tr) + 1][os.urandom(20)]] = \
-            fdb.tuple.pack((*value,))
-        self.register_queue(tr)
+    def renew_lease(self, tr, owner, progress=False):
+        """Extend the lease of owner and, if progress is set, record that
+        it popped items. Raises LeaseLost if the queue was leased to
+        another consumer or deleted."""
+        # The lease is only advisory, pops of the same items conflict anyway,
+        # so it's read as snapshot to not conflict with the heartbeats
+        lease = self.get_lease(tr.snapshot)
+        if lease is None or lease[0] != owner:
+            raise LeaseLost("Lost the lease of queue: %s" % self.name)
+        self.set_lease(tr, owner, time() if progress else lease[2])
+
+    @fdb.transactional
+    def release_lease(self, tr, owner):
+        lease = self.get_lease(tr)
+        if lease is not None and lease[0] == owner:
+            del tr[self.consumer_lock]
+            signal_queues(tr)
+
+    def update_stats(self, tr, items, size):
+        tr.add(self.stats['items'], struct.pack('<q', items))
+        tr.add(self.stats['bytes'], struct.pack('<q', size))
+
+    @fdb.transactional
+    def pop(self, tr):
+        items = self.pop_batch(tr, max_items=1)
+        return items[0] if items else None
+
+    @fdb.transactional
+    def pop_batch(self, tr, max_items=None, max_bytes=None, owner=None,
+                  after=None):
+        """Pop the first items of the queue until max_items items or
+        max_bytes bytes are popped, the item that crosses max_bytes is
+        included. If owner is set, its lease is checked and renewed. If
+        after is set, only the items after that key are popped.
+
+        The last key popped is kept in last_popped."""
+        max_items = max_items or config('QUEUE_POP_ITEMS')
+        max_bytes = max_bytes or config('QUEUE_POP_BYTES')
+        self.queue = self.open_queue(tr)
+        if owner is not None:
+            self.renew_lease(tr, owner, progress=True)
+        r = self.queue.range()
+        begin = r.start if after is None else after + b'\x00'
+        items, item_prefix, popped_bytes, last_key = [], None, 0, None
+        for k, v in tr.get_range(begin, r.stop):
+            key = self.queue.unpack(k)
+            # Chunks of split items share the key prefix of the item
+            prefix = key[:-1] if is_chunk(key) else key
+            if prefix != item_prefix:
+                if len(items) >= max_items or popped_bytes >= max_bytes:
+                    break
+                items.append([])
+                item_prefix = prefix
+            items[-1].append(v)
+            popped_bytes += len(v)
+            last_key = k
+        if last_key is not None:
+            del tr[begin:last_key + b'\x00']
+            self.update_stats(tr, -len(items), -popped_bytes)
+        self.last_popped = last_key
+        return [b''.join(chunks) for chunks in items]
+
+    @fdb.transactional
+    def pop_batch_or_watch(self, tr, timeout, max_items=None,
+                           max_bytes=None, owner=None, after=None):
+        """Pop a batch of items or, if the queue is empty, return a watch
+        which fires when an item is pushed, within the same transaction so
+        that no push is missed."""
+        items = self.pop_batch(tr, max_items, max_bytes, owner, after)
+        if items:
+            return items, None
+        # Watches fail when the transaction which created them times out
+        tr.options.set_timeout(
+            config('TRANSACTION_TIMEOUT') + int(timeout * 1000))
+        return items, tr.watch(self.stats['items'])
 
     @fdb.transactional
-    def last_index(self, tr):
-        self.queue = fdb.directory.create_or_open(tr, ('queue', self.name))
+    def claim_batch_or_watch(self, tr, owner, timeout, visibility,
+                             max_items=None, max_bytes=None, lease=True):
+        """Claim the first items of the queue which aren't claimed, or
+        whose claim expired, for visibility seconds. Unlike popped items
+        they stay in the queue until they're acked, so several consumers
+        can serve the same queue. Returns the claimed (item key, item)
+        pairs or, if nothing could be claimed, a watch of the depth of the
+        queue. If lease is set the lease of owner is renewed."""
+        max_items = max_items or config('QUEUE_POP_ITEMS')
+        max_bytes = max_bytes or config('QUEUE_POP_BYTES')
+        self.queue = self.open_queue(tr)
+        if lease:
+            self.renew_lease(tr, owner, progress=True)
+        now = time()
+        # Items and claims are read as snapshot, conflicts are only added
+        # for the claimed items, so that consumers claiming different
+        # items don't conflict
+        r = self.claims.range()
+        claims = {self.claims.unpack(k): fdb.tuple.unpack(v)
+                  for k, v in tr.snapshot.get_range(
+                      r.start, r.stop,
+                      streaming_mode=fdb.StreamingMode.want_all)}
         r = self.queue.range()
-        for key, _ in tr.snapshot.get_range(r.start, r.stop, limit=1,
-                                            reverse=True):
-            return self.queue.unpack(key)[0]
-        return 0
+        items, item_prefix, claimed_bytes, skip = [], None, 0, False
+        for k, v in tr.snapshot.get_range(r.start, r.stop):
+            key = self.queue.unpack(k)
+            prefix = key[:-1] if is_chunk(key) else key
+            if prefix != item_prefix:
+                item_prefix = prefix
+                claim = claims.get(prefix)
+                skip = claim is not None and claim[1] > now
+                if skip:
+                    continue
+                if len(items) >= max_items or claimed_bytes >= max_bytes:
+                    break
+                items.append([prefix, k, k, []])
+            elif skip:
+                continue
+            items[-1][2] = k
+            items[-1][3].append(v)
+            claimed_bytes += len(v)
+        if not items:
+            tr.add_read_conflict_range(r.start, r.stop)
+            tr.options.set_timeout(
+                config('TRANSACTION_TIMEOUT') + int(timeout * 1000))
+            return [], tr.watch(self.stats['items'])
+        for prefix, first_key, last_key, _ in items:
+            claim_key = self.claims.pack(prefix)
+            tr.add_read_conflict_key(claim_key)
+            tr.add_read_conflict_range(first_key, last_key + b'\x00')
+            tr[claim_key] = fdb.tuple.pack((owner, now + visibility))
+        return [(prefix, b''.join(chunks))
+                for prefix, _, _, chunks in items], None
+
+    @fdb.transactional
+    def ack(self, tr, owner, claimed):
+        """Delete the (item key, item) pairs claimed by owner, returns the
+        ones which were still claimed by it. The others were claimed by
+        another consumer after their claim expired, or were already
+        removed from the queue, e.g. popped once claims were disabled, and
+        aren't counted again."""
+        self.queue = self.open_queue(tr)
+        claims = [(prefix, item, tr[self.claims.pack(prefix)])
+                  for prefix, item in claimed]
+        acked = []
+        for prefix, item, claim in claims:
+            if not claim.present() or fdb.tuple.unpack(claim)[0] != owner:
+                continue
+            del tr[self.claims.pack(prefix)]
+            begin = self.queue.pack(prefix)
+            end = self.queue.subspace(prefix).range().stop
+            if not list(tr.get_range(begin, end, limit=1)):
+                continue
+            del tr[begin:end]
+            self.update_stats(tr, -1, -len(item))
+            acked.append((prefix, item))
+        return acked
+
+    @fdb.transactional
+    def push(self, tr, value):
+        tr.options.set_retry_limit(config('QUEUE_TRANSACTION_RETRY_LIMIT'))
+        self.push_item(tr, pack_item(value))
+
+    def push_item(self, tr, item, user_version=0):
+        """Push an already packed item, items pushed in the same
+        transaction need distinct user versions."""
+        # Deleting a queue clears its registration, which is only written
+        # by the first push, so reading it makes pushes conflict with the
+        # deletion of their queue but not with each other
+        path = ('queue', self.name)
+        registration = tr[self.available_queue]
+        registered = registration.present()
+        prefix = self.registered_prefix(registration) if registered else None
+        if prefix is None:
+            # The queue may have been deleted since its prefix was cached
+            directory_cache.invalidate(path)
+        self.queue = self.open_queue(tr)
+        if prefix is not None and self.queue.key() != prefix:
+            # The queue was deleted and created again by another process
+            # since its prefix was cached, if it changes again before this
+            # transaction commits, the registration read conflicts
+            directory_cache.invalidate(path)
+            self.queue = self.open_queue(tr)
+        stamp = fdb.tuple.Versionstamp(user_version=user_version)
+        # Items are keyed by the commit versionstamp, so pushing is a blind
+        # write and items are ordered by the commit order of their pushes
+        for key, chunk in self.split_item(item):
+            tr.set_versionstamped_key(
+                self.queue.pack_with_versionstamp((stamp,) + key), chunk)
+        self.update_stats(tr, 1, len(item))
+        if not registered:
+            # The queue was just created, so its counters start empty
+            self.register_queue(tr, self.queue.key())
+            tr[self.stats['counted']] = b''
+            signal_queues(tr)
+        elif prefix is None:
+            self.register_queue(tr, self.queue.key())
+
+    @staticmethod
+    def split_item(item):
+        """Yield the (key suffix, value) pairs to store an item with."""
+        chunk_size = config('QUEUE_CHUNK_BYTES')
+        if len(item) <= chunk_size:
+            yield (), item
+            return
+        # Values are limited to 100KB, so big items are split in ordered
+        # chunks which are read together
+        for chunk, start in enumerate(range(0, len(item), chunk_size)):
+            yield (chunk,), item[start:start + chunk_size]
+
+    def open_queue(self, tr):
+        # Queue directories are removed with the queue. Deletes drop the
+        # cached prefix in their process, pushes compare it with the prefix
+        # of the registration and delete_if_empty with the directory
+        return directory_cache.create_or_open(tr, ('queue', self.name))
 
     @fdb.transactional
     def first_item(self, tr):
-        self.queue = fdb.directory.create_or_open(tr, ('queue', self.name))
+        self.queue = self.open_queue(tr)
         r = self.queue.range()
         for kv in tr.get_range(r.start, r.stop, limit=1):
             return kv
 
     @fdb.transactional
     def delete(self, tr):
+        # Pushes read the registration of the queue, so they conflict with
+        # its deletion
+        tr.add_read_conflict_key(self.available_queue.key())
         fdb.directory.remove_if_exists(tr, ('queue', self.name))
+        directory_cache.invalidate(('queue', self.name))
+        del tr[self.stats.range()]
+        del tr[self.claims.range()]
         del tr[self.consumer_lock]
         del tr[self.available_queue]
+        signal_queues(tr)
         print("Deleted queue: %s" % (self.name))
 
     @fdb.transactional
     def delete_if_empty(self, tr):
-        if not self.first_item(tr):
-            self.delete(tr)
-            return True
-        return False
-
-    def count_items(self, db):
+        # The directory is resolved without the cache, in case the queue
+        # was deleted and created again by another process
+        path = ('queue', self.name)
         try:
-            self.queue = fdb.directory.open(db, ('queue', self.name))
+            queue = fdb.directory.open(tr, path)
         except ValueError:
-            return 0
-        r = self.queue.range()
-        count = 0
-        for kv in db.get_range(r.start, r.stop):
-            count += 1
-        return count
+            queue = None
+        if queue is not None:
+            r = queue.range()
+            if list(tr.get_range(r.start, r.stop, limit=1)):
+                cached = directory_cache.get(path)
+                if cached is not None and cached.key() != queue.key():
+                    directory_cache.invalidate(path)
+                return False
+        # Keep the queue registered while dead letters wait to be retried
+        r = self.dead_letter_retries.range()
+        if list(tr.get_range(r.start, r.stop, limit=1)):
+            return False
+        self.delete(tr)
+        return True
+
+    @fdb.transactional
+    def dead_letter(self, tr, item, reason, retries=0, retry=True,
+                    user_version=0):
+        """Move an item which couldn't be consumed to the dead letters of
+        the queue. Unless retry is unset or it already failed
+        DEAD_LETTER_MAX_RETRIES times, it's retried after an exponential
+        backoff. Items moved in the same transaction need distinct user
+        versions."""
+        now = time()
+        retry_at = None
+        stamp = fdb.tuple.Versionstamp(user_version=user_version)
+        if retry and retries < config('DEAD_LETTER_MAX_RETRIES'):
+            retry_at = now + config('DEAD_LETTER_BACKOFF') * 2 ** retries
+            tr.set_versionstamped_key(
+                self.dead_letter_retries.pack_with_versionstamp(
+                    (retry_at, stamp)), b'')
+        tr.set_versionstamped_key(
+            self.dead_letters.pack_with_versionstamp((stamp, 'info')),
+            fdb.tuple.pack((reason[:1000], retries, now, retry_at)))
+        for key, chunk in self.split_item(item):
+            tr.set_versionstamped_key(
+                self.dead_letters.pack_with_versionstamp(
+                    (stamp, 'item') + key), chunk)
+
+    def read_dead_letters(self, tr, begin, end, limit=0):
+        """Return the (stamp, (reason, retries, failed at, retry at), item)
+        of the dead letters in the given key range."""
+        letters = []
+        for k, v in tr.get_range(begin, end):
+            key = self.dead_letters.unpack(k)
+            if key[1] == 'info':
+                if limit and len(letters) == limit:
+                    break
+                letters.append((key[0], fdb.tuple.unpack(v), []))
+            elif letters and letters[-1][0] == key[0]:
+                letters[-1][2].append(v)
+        return [(stamp, info, b''.join(chunks))
+                for stamp, info, chunks in letters]
+
+    def remove_dead_letter(self, tr, stamp, info):
+        r = self.dead_letters.subspace((stamp,)).range()
+        del tr[r.start:r.stop]
+        if info[3] is not None:
+            del tr[self.dead_letter_retries.pack((info[3], stamp))]
+
+    @fdb.transactional
+    def pop_due_dead_letters(self, tr, limit=None):
+        """Pop the dead letters whose retry is due, as (item, retries)."""
+        limit = limit or config('QUEUE_POP_ITEMS')
+        items = []
+        r = self.dead_letter_retries.range()
+        for k, _ in tr.get_range(r.start, self.dead_letter_retries.pack(
+                (time(),)), limit=limit):
+            _, stamp = self.dead_letter_retries.unpack(k)
+            letter = self.dead_letters.subspace((stamp,)).range()
+            for _, info, item in self.read_dead_letters(
+                    tr, letter.start, letter.stop):
+                self.remove_dead_letter(tr, stamp, info)
+                items.append((item, info[1]))
+        return items
+
+    @fdb.transactional
+    def list_dead_letters(self, tr, limit=100):
+        r = self.dead_letters.range()
+        return [{
+            "id": stamp.to_bytes().hex(),
+            "reason": reason,
+            "retries": retries,
+            "failed_at": int(failed_at),
+            "retry_at": retry_at and int(retry_at),
+            "size": len(item)
+        } for stamp, (reason, retries, failed_at, retry_at), item in
+            self.read_dead_letters(tr, r.start, r.stop, limit)]
+
+    @fdb.transactional
+    def replay_dead_letters(self, tr, letter_id=None, limit=100):
+        """Push dead letters back to the queue, either the one with the
+        given id or up to limit of them. Returns how many were replayed."""
+        if letter_id is not None:
+            r = self.dead_letters.subspace((fdb.tuple.Versionstamp.from_bytes(
+                bytes.fromhex(letter_id)),)).range()
+        else:
+            r = self.dead_letters.range()
+        letters = self.read_dead_letters(tr, r.start, r.stop, limit)
+        for user_version, (stamp, info, item) in enumerate(letters):
+            self.remove_dead_letter(tr, stamp, info)
+            self.push_item(tr, item, user_version)
+        return len(letters)
+
+    @fdb.transactional
+    def get_stats(self, tr):
+        """Return the number of items and bytes in the queue."""
+        items, size = tr[self.stats['items']], tr[self.stats['bytes']]
+        return unpack_counter(items), unpack_counter(size)
+
+    def count_items(self, db):
+        return self.get_stats(db)[0]
+
+    @fdb.transactional
+    def is_counted(self, tr):
+        return tr[self.stats['counted']].present()
+
+    @fdb.transactional
+    def reconcile_stats(self, tr):
+        """Recount the items of the queue and set its counters, for queues
+        with items pushed before the counters were kept."""
+        queue = directory_cache.open(tr, ('queue', self.name))
+        if queue is None:
+            return 0, 0
+        r = queue.range()
+        items = size = 0
+        for k, v in tr.get_range(r.start, r.stop):
+            key = queue.unpack(k)
+            # Count only the first chunk of chunked items
+            if not is_chunk(key) or key[-1] == 0:
+                items += 1
+            size += len(v)
+        tr[self.stats['items']] = struct.pack('<q', items)
+        tr[self.stats['bytes']] = struct.pack('<q', size)
+        tr[self.stats['counted']] = b''
+        return items, size
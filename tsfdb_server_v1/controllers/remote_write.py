@@ -0,0 +1,127 @@
+import struct
+try:
+    import snappy
+    DECODING_ERRORS = (struct.error, IndexError, snappy.UncompressError)
+except ImportError:
+    snappy = None
+    DECODING_ERRORS = (struct.error, IndexError)
+
+# Decoding of Prometheus remote_write requests, which are snappy (block
+# format) compressed protobuf WriteRequest messages:
+#
+#   WriteRequest { repeated TimeSeries timeseries = 1; }
+#   TimeSeries { repeated Label labels = 1; repeated Sample samples = 2; }
+#   Label { string name = 1; string value = 2; }
+#   Sample { double value = 1; int64 timestamp = 2; }
+
+
+def read_varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def snappy_decompress(data):
+    if snappy is not None:
+        return snappy.uncompress(bytes(data))
+    data = memoryview(data)
+    length, pos = read_varint(data, 0)
+    out = bytearray()
+    while pos < len(data):
+        tag = data[pos]
+        pos += 1
+        if tag & 3 == 0:
+            # Literal, lengths above 60 are stored in the next 1-4 bytes
+            size = tag >> 2
+            if size >= 60:
+                extra = size - 59
+                size = int.from_bytes(data[pos:pos + extra], 'little')
+                pos += extra
+            out += data[pos:pos + size + 1]
+            pos += size + 1
+            continue
+        if tag & 3 == 1:
+            size = ((tag >> 2) & 7) + 4
+            offset = ((tag >> 5) << 8) | data[pos]
+            pos += 1
+        elif tag & 3 == 2:
+            size = (tag >> 2) + 1
+            offset = int.from_bytes(data[pos:pos + 2], 'little')
+            pos += 2
+        else:
+            size = (tag >> 2) + 1
+            offset = int.from_bytes(data[pos:pos + 4], 'little')
+            pos += 4
+        if not 0 < offset <= len(out):
+            raise ValueError("Invalid snappy copy offset: %d" % offset)
+        start = len(out) - offset
+        if offset >= size:
+            out += out[start:start + size]
+        else:
+            # Overlapping copies repeat the last offset bytes
+            for i in range(size):
+                out.append(out[start + i])
+    if len(out) != length:
+        raise ValueError("Invalid snappy data length")
+    return bytes(out)
+
+
+def parse_message(data):
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+        elif wire_type == 1:
+            value, pos = data[pos:pos + 8], pos + 8
+        elif wire_type == 2:
+            size, pos = read_varint(data, pos)
+            value, pos = data[pos:pos + size], pos + size
+        elif wire_type == 5:
+            value, pos = data[pos:pos + 4], pos + 4
+        else:
+            raise ValueError("Unsupported protobuf wire type: %d" % wire_type)
+        if pos > len(data):
+            raise ValueError("Truncated protobuf message")
+        yield field, wire_type, value
+
+
+def parse_time_series(data):
+    labels = {}
+    samples = []
+    for field, wire_type, value in parse_message(data):
+        if field == 1 and wire_type == 2:
+            label = {}
+            for label_field, _, label_value in parse_message(value):
+                label[label_field] = str(label_value, 'utf-8')
+            labels[label.get(1, "")] = label.get(2, "")
+        elif field == 2 and wire_type == 2:
+            sample_value, timestamp = 0.0, 0
+            for sample_field, _, sample_data in parse_message(value):
+                if sample_field == 1:
+                    sample_value = struct.unpack('<d', sample_data)[0]
+                elif sample_field == 2:
+                    timestamp = sample_data
+                    if timestamp >= 1 << 63:
+                        timestamp -= 1 << 64
+            samples.append((timestamp, sample_value))
+    return labels, samples
+
+
+def decode_write_request(data):
+    """Yield the (labels, [(timestamp in ms, value)]) of every time series
+    of a snappy compressed remote_write request, raises ValueError if the
+    request is invalid."""
+    try:
+        data = memoryview(snappy_decompress(data))
+        for field, wire_type, value in parse_message(data):
+            if field == 1 and wire_type == 2:
+                yield parse_time_series(value)
+    except DECODING_ERRORS as err:
+        raise ValueError("Invalid remote_write request: %s" % str(err))
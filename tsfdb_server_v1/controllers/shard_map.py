@@ -0,0 +1,72 @@
+import fdb
+import fdb.tuple
+import threading
+from time import time
+from .helpers import config, get_queue_id
+
+fdb.api_version(620)
+
+
+def validate_queues(queues):
+    """Return queues if it's a valid number of queues, at least 1 or -1
+    for one queue per machine, otherwise raise ValueError."""
+    if isinstance(queues, bool) or not isinstance(queues, int) or \
+            queues < 1 and queues != -1:
+        raise ValueError("Invalid number of queues: %r, it must be at " %
+                         (queues,) + "least 1 or -1 for one per machine")
+    return queues
+
+
+class ShardMap:
+    """Versioned number of queues that machines are sharded to, stored in
+    FDB as (version, queues) and cached by every process for ttl seconds.
+
+    Until it's set the QUEUES config is used, -1 means one queue per
+    machine.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.key = fdb.tuple.pack(('queue_shard_map',))
+        self.version, self.queues = 0, config('QUEUES')
+        self.refreshed = None
+        self.lock = threading.Lock()
+
+    @fdb.transactional
+    def read(self, tr):
+        value = tr[self.key]
+        if not value.present():
+            return 0, config('QUEUES')
+        return fdb.tuple.unpack(value)
+
+    @fdb.transactional
+    def set_queues(self, tr, queues):
+        """Change the number of queues, returns the new (version, queues).
+        Only the machines that hash to different queues move, but their
+        items pushed before the change are consumed independently."""
+        validate_queues(queues)
+        version, current = self.read(tr)
+        if queues != current:
+            version += 1
+            tr[self.key] = fdb.tuple.pack((version, queues))
+        return version, queues
+
+    def get(self, db):
+        with self.lock:
+            if self.refreshed is not None and \
+                    time() - self.refreshed < self.ttl:
+                return self.version, self.queues
+        version, queues = self.read(db)
+        with self.lock:
+            if version != self.version:
+                print("Using shard map version %d with %d queues" % (
+                    version, queues))
+            self.version, self.queues = version, queues
+            self.refreshed = time()
+            return version, queues
+
+    def get_queue_id(self, db, machine_id):
+        return get_queue_id(machine_id, self.get(db)[1])
+
+
+shard_map = ShardMap(config('SHARD_MAP_TTL'))
@@ -7,7 +7,12 @@ import struct
 from .helpers import metric_to_dict, error, config, div_datapoints, \
     time_range_to_resolution, config, print_trace
 from .tsfdb_tuple import tuple_to_datapoint, time_aggregate_tuple, \
-    start_stop_key_tuples, round_start, round_stop
+    start_stop_key_tuples, round_start, round_stop, key_tuple_minute, \
+    key_tuple_second, tuple_to_timestamp
+from .block_codec import encode_block, decode_block
+from .directory_cache import directory_cache
+from .fdb_async import wait, get_range, transact
+from .metric_catalog import metric_catalog
 from tsfdb_server_v1.models.error import Error  # noqa: E501
 from datetime import datetime
 
@@ -16,12 +21,22 @@ fdb.api_version(620)
 log = logging.getLogger(__name__)
 
 
+def unsigned(value):
+    return value & 0xFFFFFFFFFFFFFFFF
+
+
 class TimeSeriesLayer():
     def __init__(self, series_type="monitoring"):
         self.struct_types = (int, float)
         self.limit = config('DATAPOINTS_PER_READ')
         self.series_type = series_type
 
+    def open_dir(self, tr, *path):
+        return directory_cache.open(tr, (self.series_type,) + path)
+
+    def create_or_open_dir(self, tr, *path):
+        return directory_cache.create_or_open(tr, (self.series_type,) + path)
+
     @fdb.transactional
     def find_orgs(self, tr):
         orgs = fdb.directory.create_or_open(
@@ -31,8 +46,9 @@ class TimeSeriesLayer():
     @fdb.transactional
     def find_metrics(self, tr, org, resource):
         metrics = {}
-        available_metrics = fdb.directory.create_or_open(
-            tr, (self.series_type, org, 'available_metrics'))
+        available_metrics = self.open_dir(tr, org, 'available_metrics')
+        if not available_metrics:
+            return metrics
         for k, v in tr.get_range_startswith(available_metrics.pack(
                 (resource,))):
             metric = available_metrics.unpack(k)[1]
@@ -48,10 +64,12 @@ class TimeSeriesLayer():
     def find_resources(self, tr, org, regex_resources,
                        authorized_resources=None):
         filtered_resources = []
-        resources = set(fdb.directory.create_or_open(
-            tr, (self.series_type, org)).list(tr))
+        org_dir = self.open_dir(tr, org)
+        if not org_dir:
+            return filtered_resources
+        resources = set(org_dir.list(tr))
         # Remove reserved directory for metrics
-        resources.remove('available_metrics')
+        resources.discard('available_metrics')
         # Use only authorized resources
         if authorized_resources:
             authorized_resources = set(authorized_resources)
@@ -67,11 +85,10 @@ class TimeSeriesLayer():
         return filtered_resources
 
     @print_trace
-    def find_datapoints(self, db, org, resource,
-                        metric, start, stop, datapoints_dir=None,
-                        available_metrics=None, resolution=None):
+    async def async_find_datapoints(self, db, org, resource,
+                                    metric, start, stop, datapoints_dir=None,
+                                    available_metrics=None, resolution=None):
         stats = (None,)
-        datapoints_per_stat = {}
         if not resolution:
             time_range = stop - start
             time_range_in_hours = round(time_range.total_seconds() / 3600, 2)
@@ -85,28 +102,20 @@ class TimeSeriesLayer():
             return {("%s.%s" % (resource, metric)): []}
 
         if not available_metrics:
-            available_metrics = fdb.directory.create_or_open(
-                db, (self.series_type, org, 'available_metrics'))
+            available_metrics = self.open_dir(db, org, 'available_metrics')
         if not datapoints_dir:
-            datapoints_dir = fdb.directory.create_or_open(
-                db, (self.series_type, org, resource, resolution))
+            datapoints_dir = self.open_dir(db, org, resource, resolution)
 
+        # The ranges of all the stats are read concurrently
+        datapoints_per_stat = await asyncio.gather(*(
+            self.__async_find_datapoints_per_stat(
+                db, start_stop_key_tuples(db, resolution, resource, metric,
+                                          start, stop, stat, self.limit),
+                resolution, org, resource, metric, stat, datapoints_dir,
+                available_metrics)
+            for stat in stats))
+        datapoints_per_stat = dict(zip(stats, datapoints_per_stat))
         for stat in stats:
-            tuples = start_stop_key_tuples(
-                db, resolution,
-                resource, metric, start,
-                stop, stat, self.limit
-            )
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            datapoints_per_stat[stat] = loop.run_until_complete(
-                self.__async_find_datapoints_per_stat(db, tuples,
-                                                      resolution,
-                                                      org, resource, metric,
-                                                      stat, datapoints_dir,
-                                                      available_metrics))
-            loop.close()
-
             if isinstance(datapoints_per_stat[stat], Error):
                 return datapoints_per_stat[stat]
 
@@ -125,12 +134,11 @@ class TimeSeriesLayer():
                                                org, resource, metric, stat,
                                                datapoints_dir=None,
                                                available_metrics=None):
-        loop = asyncio.get_event_loop()
         data_lists = [
-            loop.run_in_executor(None, self.__find_datapoints_per_stat, *
-                                 (db, start, stop, resolution,
-                                  org, resource, metric, stat, datapoints_dir,
-                                  available_metrics))
+            transact(db, self.__find_datapoints_per_stat, *
+                     (start, stop, resolution,
+                      org, resource, metric, stat, datapoints_dir,
+                      available_metrics))
             for start, stop in zip(tuples, tuples[1:])
         ]
 
@@ -157,31 +165,35 @@ class TimeSeriesLayer():
         return combined_data_list
 
     @print_trace
-    @fdb.transactional
-    def __find_datapoints_per_stat(self, tr, start, stop, resolution,
-                                   org, resource, metric, stat,
-                                   datapoints_dir=None,
-                                   available_metrics=None):
+    async def __find_datapoints_per_stat(self, tr, start, stop, resolution,
+                                         org, resource, metric, stat,
+                                         datapoints_dir=None,
+                                         available_metrics=None):
 
         if not available_metrics:
-            available_metrics = fdb.directory.create_or_open(
-                tr, (self.series_type, org, 'available_metrics'))
-        if not tr[available_metrics.pack(
-                (resource, metric))].present():
+            available_metrics = self.open_dir(tr, org, 'available_metrics')
+        metric_type_tuple = None
+        if available_metrics:
+            metric_type_tuple = await wait(
+                tr[available_metrics.pack((resource, metric))])
+        if metric_type_tuple is None or not metric_type_tuple.present():
             error_msg = "Metric type: %s for resource: %s doesn't exist." % (
                 metric, resource)
             return error(404, error_msg)
-        metric_type_tuple = tr[available_metrics.
-                               pack((resource, metric))]
         metric_type = fdb.tuple.unpack(metric_type_tuple)[0]
 
         datapoints = []
         if not datapoints_dir:
-            datapoints_dir = fdb.directory.create_or_open(
-                tr, (self.series_type, org, resource, resolution))
-        for k, v in tr.get_range(datapoints_dir.pack(start),
-                                 datapoints_dir.pack(stop),
-                                 streaming_mode=fdb.StreamingMode.want_all):
+            datapoints_dir = self.open_dir(tr, org, resource, resolution)
+        if not datapoints_dir:
+            return datapoints
+        reads = [get_range(tr, datapoints_dir.pack(start),
+                           datapoints_dir.pack(stop))]
+        if resolution == 'second' and config('SECOND_BLOCKS'):
+            reads.append(self.__find_datapoints_in_blocks(
+                tr, start, stop, org, resource))
+        kvs, *block_datapoints = await asyncio.gather(*reads)
+        for k, v in kvs:
             tuple_key = list(fdb.tuple.unpack(k))
             if resolution == 'second':
                 tuple_value = list(fdb.tuple.unpack(v))
@@ -194,14 +206,34 @@ class TimeSeriesLayer():
                     stat
                 )
             )
+        if block_datapoints:
+            datapoints += block_datapoints[0]
+            datapoints.sort(key=lambda datapoint: datapoint[1])
+        return datapoints
+
+    async def __find_datapoints_in_blocks(self, tr, start, stop, org,
+                                          resource):
+        blocks_dir = self.open_dir(tr, org, resource, 'second_blocks')
+        if not blocks_dir:
+            return []
+        start_timestamp = tuple_to_timestamp('second', start)
+        stop_timestamp = tuple_to_timestamp('second', stop)
+        datapoints = []
+        # Blocks are keyed by minute, so we fetch every block that overlaps
+        # with [start, stop) and filter out the datapoints outside of it
+        for _, v in await get_range(tr, blocks_dir.pack(start[:-1]),
+                                    blocks_dir.pack(stop[:-1]) + b'\x00'):
+            datapoints += [[value, timestamp] for timestamp, value
+                           in decode_block(v)
+                           if start_timestamp <= timestamp < stop_timestamp]
         return datapoints
 
     @fdb.transactional
     def write_datapoint(self, tr, org, resource, key, value,
                         resolution='second', datapoints_dir=None):
         if not datapoints_dir:
-            datapoints_dir = fdb.directory.create_or_open(
-                tr, (self.series_type, org, resource, resolution))
+            datapoints_dir = self.create_or_open_dir(
+                tr, org, resource, resolution)
         if config('CHECK_DUPLICATES'):
             if not tr[datapoints_dir.pack(key)].present():
                 tr[datapoints_dir.pack(key)] = fdb.tuple.pack(
@@ -221,10 +253,85 @@ class TimeSeriesLayer():
             (value,))
         return True
 
+    @fdb.transactional
+    def write_datapoints(self, tr, org, resource, samples,
+                         datapoints_dir=None):
+        if not datapoints_dir:
+            datapoints_dir = self.create_or_open_dir(
+                tr, org, resource, 'second')
+        keys = [datapoints_dir.pack(key_tuple_second(dt, metric))
+                for metric, dt, _ in samples]
+        saved_values = {}
+        if config('CHECK_DUPLICATES'):
+            # Issue all the reads before blocking on any of them
+            saved_values = {key: tr[key] for key in keys}
+        written_values = {}
+        written_samples = []
+        for key, (metric, dt, value) in zip(keys, samples):
+            if key in written_values:
+                saved_value = written_values[key]
+            elif key in saved_values and saved_values[key].present():
+                saved_value = fdb.tuple.unpack(saved_values[key])[0]
+            else:
+                tr[key] = fdb.tuple.pack((value,))
+                if config('CHECK_DUPLICATES'):
+                    written_values[key] = value
+                written_samples.append((metric, dt, value))
+                continue
+            if saved_value != value:
+                log.error("key: %s already exists with a different value" %
+                          str(key_tuple_second(dt, metric)))
+            else:
+                log.warning("key: %s already exists with the same value" %
+                            str(key_tuple_second(dt, metric)))
+        return written_samples
+
+    @fdb.transactional
+    def write_datapoints_block(self, tr, org, resource, samples,
+                               datapoints_dir=None):
+        if not datapoints_dir:
+            datapoints_dir = self.create_or_open_dir(
+                tr, org, resource, 'second_blocks')
+        blocks = {}
+        for metric, dt, value in samples:
+            key = datapoints_dir.pack(key_tuple_minute(dt, metric))
+            blocks.setdefault(key, []).append((metric, dt, value))
+        # Issue all the reads before blocking on any of them
+        saved_blocks = {key: tr[key] for key in blocks}
+        written_samples = []
+        for key, new_samples in blocks.items():
+            points = {}
+            if saved_blocks[key].present():
+                points = dict(decode_block(saved_blocks[key]))
+            for metric, dt, value in new_samples:
+                timestamp = int(dt.timestamp())
+                if config('CHECK_DUPLICATES') and timestamp in points:
+                    if points[timestamp] != value:
+                        log.error("datapoint: %s already exists with a "
+                                  "different value" % str((metric, dt)))
+                    else:
+                        log.warning("datapoint: %s already exists with the "
+                                    "same value" % str((metric, dt)))
+                    continue
+                points[timestamp] = value
+                written_samples.append((metric, dt, value))
+            tr[key] = encode_block(sorted(points.items()))
+        return written_samples
+
     @fdb.transactional
     def write_datapoint_aggregated(self, tr, org, resource,
                                    metric, dt, value, resolution,
                                    datapoints_dir=None):
+        aggregates = {}
+        self.aggregate_datapoint(aggregates, resource, metric, dt, value,
+                                 (resolution,))
+        self.write_aggregates(tr, org, aggregates, datapoints_dir)
+
+    def aggregate_datapoint(self, aggregates, resource, metric, dt, value,
+                            resolutions):
+        # Folds a datapoint into the in memory aggregates of a batch,
+        # {(resource, resolution, key): [count, sum, min, max]}, so that
+        # only one atomic operation per stat and time bucket is needed
         if type(value) not in self.struct_types:
             log.warning("Unsupported aggregation value type: %s" %
                         str(type(value)))
@@ -232,29 +339,43 @@ class TimeSeriesLayer():
         if type(value) is float:
             value *= 1000
             value = int(value)
-        if not config('AGGREGATE_%s' % resolution.upper()):
-            # log something
-            return
-        if not datapoints_dir:
-            datapoints_dir = fdb.directory.create_or_open(
-                tr, (self.series_type, org, resource, resolution))
-        tr.add(datapoints_dir.pack(
-            time_aggregate_tuple(metric, "count", dt, resolution)),
-            struct.pack('<q', 1))
-        tr.add(datapoints_dir.pack(
-            time_aggregate_tuple(metric, "sum", dt, resolution)),
-            struct.pack('<q', value))
-        tr.min(datapoints_dir.pack(
-            time_aggregate_tuple(metric, "min", dt, resolution)),
-            struct.pack('<q', value))
-        tr.max(datapoints_dir.pack(
-            time_aggregate_tuple(metric, "max", dt, resolution)),
-            struct.pack('<q', value))
+        for resolution in resolutions:
+            if not config('AGGREGATE_%s' % resolution.upper()):
+                continue
+            bucket = (resource, resolution,
+                      time_aggregate_tuple(metric, None, dt, resolution))
+            aggregate = aggregates.get(bucket)
+            if not aggregate:
+                aggregates[bucket] = [1, value, value, value]
+                continue
+            aggregate[0] += 1
+            aggregate[1] += value
+            # Atomic min/max compare the values as unsigned integers
+            aggregate[2] = min(aggregate[2], value, key=unsigned)
+            aggregate[3] = max(aggregate[3], value, key=unsigned)
+
+    @fdb.transactional
+    def write_aggregates(self, tr, org, aggregates, datapoints_dir=None):
+        for (resource, resolution, key), (count, total, minimum, maximum) \
+                in aggregates.items():
+            resolution_dir = datapoints_dir or self.create_or_open_dir(
+                tr, org, resource, resolution)
+            metric, date = key[0], key[1:]
+            tr.add(resolution_dir.pack((metric, "count") + date),
+                   struct.pack('<q', count))
+            # The sum of the batch may not fit in 64 bits, the atomic add
+            # wraps it around like it would wrap separate adds
+            tr.add(resolution_dir.pack((metric, "sum") + date),
+                   struct.pack('<Q', unsigned(total)))
+            tr.min(resolution_dir.pack((metric, "min") + date),
+                   struct.pack('<q', minimum))
+            tr.max(resolution_dir.pack((metric, "max") + date),
+                   struct.pack('<q', maximum))
 
     @fdb.transactional
     def add_metric(self, tr, org, metric, metric_type):
-        available_metrics = fdb.directory.create_or_open(
-            tr, (self.series_type, org, 'available_metrics'))
+        available_metrics = self.create_or_open_dir(
+            tr, org, 'available_metrics')
         timestamp_now = datetime.timestamp(datetime.now())
         values_list = tr[available_metrics.pack(metric)]
         if not values_list.present():
@@ -270,6 +391,47 @@ class TimeSeriesLayer():
             tr[available_metrics.pack(
                 metric)] = fdb.tuple.pack((metric_type, timestamp_now))
 
+    @fdb.transactional
+    def add_metrics(self, tr, org, metrics):
+        # Registers {(resource, metric): metric_type} skipping the metrics
+        # which the catalog knows were refreshed recently. Returns the
+        # catalog entries to add once the transaction is committed.
+        timestamp_now = datetime.timestamp(datetime.now())
+        refresh_seconds = config('ACTIVE_METRIC_MINUTES') * 60 / 2
+        available_metrics = None
+        saved_values = {}
+        entries = {}
+        for metric, metric_type in metrics.items():
+            entry = metric_catalog.get((self.series_type, org) + metric)
+            if entry and abs(timestamp_now - entry[1]) <= refresh_seconds:
+                continue
+            if not available_metrics:
+                available_metrics = self.create_or_open_dir(
+                    tr, org, 'available_metrics')
+            if entry:
+                tr[available_metrics.pack(metric)] = fdb.tuple.pack(
+                    (metric_type, timestamp_now))
+                entries[(self.series_type, org) + metric] = (
+                    metric_type, timestamp_now)
+            else:
+                # Issue all the reads before blocking on any of them
+                saved_values[metric] = tr[available_metrics.pack(metric)]
+        for metric, saved_value in saved_values.items():
+            metric_type, timestamp_metric = metrics[metric], 0
+            if saved_value.present():
+                values_list = fdb.tuple.unpack(saved_value)
+                metric_type = values_list[0]
+                if len(values_list) > 1:
+                    timestamp_metric = values_list[1]
+            if abs(timestamp_now - timestamp_metric) > refresh_seconds:
+                metric_type, timestamp_metric = metrics[metric], \
+                    timestamp_now
+                tr[available_metrics.pack(metric)] = fdb.tuple.pack(
+                    (metric_type, timestamp_metric))
+            entries[(self.series_type, org) + metric] = (
+                metric_type, timestamp_metric)
+        return entries
+
     @fdb.transactional
     def delete_datapoints(self, tr, org, resource,
                           metric, start, stop, resolution):
@@ -286,7 +448,48 @@ class TimeSeriesLayer():
 
             key_timestamp_start, key_timestamp_stop = tuples
 
-            datapoints_dir = fdb.directory.create_or_open(
-                tr, (self.series_type, org, resource, resolution))
-            tr.clear_range(datapoints_dir.pack(key_timestamp_start),
-                           datapoints_dir.pack(key_timestamp_stop))
+            datapoints_dir = self.open_dir(tr, org, resource, resolution)
+            if datapoints_dir:
+                tr.clear_range(datapoints_dir.pack(key_timestamp_start),
+                               datapoints_dir.pack(key_timestamp_stop))
+
+            if resolution == 'second':
+                blocks_dir = self.open_dir(tr, org, resource, 'second_blocks')
+                if blocks_dir:
+                    self.__delete_datapoints_in_blocks(
+                        tr, blocks_dir, key_timestamp_start,
+                        key_timestamp_stop)
+
+    def __delete_datapoints_in_blocks(self, tr, blocks_dir, start, stop):
+        # The blocks of the minutes which are entirely in [start, stop) are
+        # cleared, the blocks of the minutes at its edges are rewritten
+        # without the datapoints in it. The timestamps of the bounds are
+        # only computed for edges, start may be datetime.min which has no
+        # timestamp
+        start_timestamp = stop_timestamp = None
+        begin = blocks_dir.pack(start[:-1])
+        end = blocks_dir.pack(stop[:-1])
+        edges = []
+        if start[-1]:
+            start_timestamp = tuple_to_timestamp('second', start)
+            edges.append(begin)
+            begin += b'\x00'
+        if stop[-1]:
+            stop_timestamp = tuple_to_timestamp('second', stop)
+            if end not in edges:
+                edges.append(end)
+        if begin < end:
+            tr.clear_range(begin, end)
+        saved_blocks = [(key, tr[key]) for key in edges]
+        for key, saved_block in saved_blocks:
+            if not saved_block.present():
+                continue
+            points = [point for point in decode_block(saved_block)
+                      if start_timestamp is not None and
+                      point[0] < start_timestamp or
+                      stop_timestamp is not None and
+                      point[0] >= stop_timestamp]
+            if points:
+                tr[key] = encode_block(points)
+            else:
+                del tr[key]
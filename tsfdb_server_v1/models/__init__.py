@@ -4,6 +4,8 @@
 from __future__ import absolute_import
 # import models into model package
 from tsfdb_server_v1.models.datapoints_response import DatapointsResponse
+from tsfdb_server_v1.models.dead_letter import DeadLetter
 from tsfdb_server_v1.models.error import Error
+from tsfdb_server_v1.models.replayed_dead_letters import ReplayedDeadLetters
 from tsfdb_server_v1.models.resource import Resource
 from tsfdb_server_v1.models.series import Series
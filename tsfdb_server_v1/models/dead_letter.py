@@ -0,0 +1,204 @@
+# coding: utf-8
+
+from __future__ import absolute_import
+from datetime import date, datetime  # noqa: F401
+
+from typing import List, Dict  # noqa: F401
+
+from tsfdb_server_v1.models.base_model_ import Model
+from tsfdb_server_v1 import util
+
+
+class DeadLetter(Model):
+    """NOTE: This class is auto generated by OpenAPI Generator (https://openapi-generator.tech).
+
+    Do not edit the class manually.
+    """
+
+    def __init__(self, id=None, reason=None, retries=None, failed_at=None, retry_at=None, size=None):  # noqa: E501
+        """DeadLetter - a model defined in OpenAPI
+
+        :param id: The id of this DeadLetter.  # noqa: E501
+        :type id: str
+        :param reason: The reason of this DeadLetter.  # noqa: E501
+        :type reason: str
+        :param retries: The retries of this DeadLetter.  # noqa: E501
+        :type retries: int
+        :param failed_at: The failed_at of this DeadLetter.  # noqa: E501
+        :type failed_at: int
+        :param retry_at: The retry_at of this DeadLetter.  # noqa: E501
+        :type retry_at: int
+        :param size: The size of this DeadLetter.  # noqa: E501
+        :type size: int
+        """
+        self.openapi_types = {
+            'id': str,
+            'reason': str,
+            'retries': int,
+            'failed_at': int,
+            'retry_at': int,
+            'size': int
+        }
+
+        self.attribute_map = {
+            'id': 'id',
+            'reason': 'reason',
+            'retries': 'retries',
+            'failed_at': 'failed_at',
+            'retry_at': 'retry_at',
+            'size': 'size'
+        }
+
+        self._id = id
+        self._reason = reason
+        self._retries = retries
+        self._failed_at = failed_at
+        self._retry_at = retry_at
+        self._size = size
+
+    @classmethod
+    def from_dict(cls, dikt) -> 'DeadLetter':
+        """Returns the dict as a model
+
+        :param dikt: A dict.
+        :type: dict
+        :return: The DeadLetter of this DeadLetter.  # noqa: E501
+        :rtype: DeadLetter
+        """
+        return util.deserialize_model(dikt, cls)
+
+    @property
+    def id(self):
+        """Gets the id of this DeadLetter.
+
+
+        :return: The id of this DeadLetter.
+        :rtype: str
+        """
+        return self._id
+
+    @id.setter
+    def id(self, id):
+        """Sets the id of this DeadLetter.
+
+
+        :param id: The id of this DeadLetter.
+        :type id: str
+        """
+        if id is None:
+            raise ValueError("Invalid value for `id`, must not be `None`")  # noqa: E501
+
+        self._id = id
+
+    @property
+    def reason(self):
+        """Gets the reason of this DeadLetter.
+
+
+        :return: The reason of this DeadLetter.
+        :rtype: str
+        """
+        return self._reason
+
+    @reason.setter
+    def reason(self, reason):
+        """Sets the reason of this DeadLetter.
+
+
+        :param reason: The reason of this DeadLetter.
+        :type reason: str
+        """
+        if reason is None:
+            raise ValueError("Invalid value for `reason`, must not be `None`")  # noqa: E501
+
+        self._reason = reason
+
+    @property
+    def retries(self):
+        """Gets the retries of this DeadLetter.
+
+
+        :return: The retries of this DeadLetter.
+        :rtype: int
+        """
+        return self._retries
+
+    @retries.setter
+    def retries(self, retries):
+        """Sets the retries of this DeadLetter.
+
+
+        :param retries: The retries of this DeadLetter.
+        :type retries: int
+        """
+        if retries is None:
+            raise ValueError("Invalid value for `retries`, must not be `None`")  # noqa: E501
+
+        self._retries = retries
+
+    @property
+    def failed_at(self):
+        """Gets the failed_at of this DeadLetter.
+
+
+        :return: The failed_at of this DeadLetter.
+        :rtype: int
+        """
+        return self._failed_at
+
+    @failed_at.setter
+    def failed_at(self, failed_at):
+        """Sets the failed_at of this DeadLetter.
+
+
+        :param failed_at: The failed_at of this DeadLetter.
+        :type failed_at: int
+        """
+        if failed_at is None:
+            raise ValueError("Invalid value for `failed_at`, must not be `None`")  # noqa: E501
+
+        self._failed_at = failed_at
+
+    @property
+    def retry_at(self):
+        """Gets the retry_at of this DeadLetter.
+
+
+        :return: The retry_at of this DeadLetter.
+        :rtype: int
+        """
+        return self._retry_at
+
+    @retry_at.setter
+    def retry_at(self, retry_at):
+        """Sets the retry_at of this DeadLetter.
+
+
+        :param retry_at: The retry_at of this DeadLetter.
+        :type retry_at: int
+        """
+
+        self._retry_at = retry_at
+
+    @property
+    def size(self):
+        """Gets the size of this DeadLetter.
+
+
+        :return: The size of this DeadLetter.
+        :rtype: int
+        """
+        return self._size
+
+    @size.setter
+    def size(self, size):
+        """Sets the size of this DeadLetter.
+
+
+        :param size: The size of this DeadLetter.
+        :type size: int
+        """
+        if size is None:
+            raise ValueError("Invalid value for `size`, must not be `None`")  # noqa: E501
+
+        self._size = size
@@ -0,0 +1,66 @@
+# coding: utf-8
+
+from __future__ import absolute_import
+from datetime import date, datetime  # noqa: F401
+
+from typing import List, Dict  # noqa: F401
+
+from tsfdb_server_v1.models.base_model_ import Model
+from tsfdb_server_v1 import util
+
+
+class ReplayedDeadLetters(Model):
+    """NOTE: This class is auto generated by OpenAPI Generator (https://openapi-generator.tech).
+
+    Do not edit the class manually.
+    """
+
+    def __init__(self, replayed=None):  # noqa: E501
+        """ReplayedDeadLetters - a model defined in OpenAPI
+
+        :param replayed: The replayed of this ReplayedDeadLetters.  # noqa: E501
+        :type replayed: int
+        """
+        self.openapi_types = {
+            'replayed': int
+        }
+
+        self.attribute_map = {
+            'replayed': 'replayed'
+        }
+
+        self._replayed = replayed
+
+    @classmethod
+    def from_dict(cls, dikt) -> 'ReplayedDeadLetters':
+        """Returns the dict as a model
+
+        :param dikt: A dict.
+        :type: dict
+        :return: The ReplayedDeadLetters of this ReplayedDeadLetters.  # noqa: E501
+        :rtype: ReplayedDeadLetters
+        """
+        return util.deserialize_model(dikt, cls)
+
+    @property
+    def replayed(self):
+        """Gets the replayed of this ReplayedDeadLetters.
+
+
+        :return: The replayed of this ReplayedDeadLetters.
+        :rtype: int
+        """
+        return self._replayed
+
+    @replayed.setter
+    def replayed(self, replayed):
+        """Sets the replayed of this ReplayedDeadLetters.
+
+
+        :param replayed: The replayed of this ReplayedDeadLetters.
+        :type replayed: int
+        """
+        if replayed is None:
+            raise ValueError("Invalid value for `replayed`, must not be `None`")  # noqa: E501
+
+        self._replayed = replayed
@@ -0,0 +1,96 @@
+# coding: utf-8
+
+from __future__ import absolute_import
+import unittest
+from unittest import mock
+
+import fdb
+
+from tsfdb_server_v1.controllers.admission_control import AdmissionControl
+from tsfdb_server_v1.controllers.helpers import load_config
+
+fdb.api_version(620)
+
+
+class TestAdmissionControl(unittest.TestCase):
+    """Rejection of payloads for queues which are too deep"""
+
+    def setUp(self):
+        self.now = 1000
+        self.admission_control = AdmissionControl(
+            ttl=2, max_size=2, clock=lambda: self.now)
+        # {queue name: (items, bytes)}
+        self.depths = {}
+        patcher = mock.patch(
+            'tsfdb_server_v1.controllers.admission_control.Queue')
+        Queue = patcher.start()
+        self.addCleanup(patcher.stop)
+        Queue.side_effect = self.queue
+        self.reads = []
+        patcher = mock.patch.dict(load_config(), {
+            'QUEUE_MAX_ITEMS': 100, 'QUEUE_MAX_BYTES': 1000,
+            'QUEUE_SHED_RATIO': 0.5, 'QUEUE_RETRY_AFTER': 30,
+            'LOW_PRIORITY_ORGS': {'low'}})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def queue(self, name):
+        queue = mock.Mock()
+
+        def get_stats(db):
+            self.reads.append(name)
+            return self.depths.get(name, (0, 0))
+        queue.get_stats.side_effect = get_stats
+        return queue
+
+    def retry_after(self, queue_name, org='org'):
+        return self.admission_control.retry_after(None, queue_name, org)
+
+    def test_limits(self):
+        for depth, retry_after in (((0, 0), None), ((99, 999), None),
+                                   ((100, 0), 30), ((0, 1000), 30)):
+            self.depths['q0'] = depth
+            self.now += 2
+            self.assertEqual(self.retry_after('q0'), retry_after)
+
+    def test_disabled_limits(self):
+        self.depths['q0'] = (10 ** 6, 10 ** 9)
+        with mock.patch.dict(load_config(), {'QUEUE_MAX_ITEMS': 0,
+                                             'QUEUE_MAX_BYTES': 0}):
+            self.assertIsNone(self.retry_after('q0'))
+
+    def test_low_priority_orgs(self):
+        # Low priority orgs are shed above QUEUE_SHED_RATIO of the limits
+        self.depths['q0'] = (50, 0)
+        self.assertEqual(self.retry_after('q0', 'low'), 30)
+        self.assertIsNone(self.retry_after('q0', 'org'))
+        self.depths['q1'] = (0, 499)
+        self.assertIsNone(self.retry_after('q1', 'low'))
+
+    def test_ttl(self):
+        self.depths['q0'] = (0, 0)
+        self.assertIsNone(self.retry_after('q0'))
+        self.depths['q0'] = (100, 0)
+        self.now += 1.9
+        self.assertIsNone(self.retry_after('q0'))
+        self.assertEqual(self.reads, ['q0'])
+        # The depth is read again once the ttl expired
+        self.now += 0.1
+        self.assertEqual(self.retry_after('q0'), 30)
+        self.assertEqual(self.reads, ['q0', 'q0'])
+
+    def test_lru(self):
+        self.retry_after('q0')
+        self.retry_after('q1')
+        # q0 is the most recently used, q1 is evicted
+        self.retry_after('q0')
+        self.retry_after('q2')
+        self.assertEqual(list(self.admission_control.stats), ['q0', 'q2'])
+        self.assertEqual(self.reads, ['q0', 'q1', 'q2'])
+        self.retry_after('q1')
+        self.assertEqual(self.reads, ['q0', 'q1', 'q2', 'q1'])
+        self.assertEqual(list(self.admission_control.stats), ['q2', 'q1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+# coding: utf-8
+
+from __future__ import absolute_import
+import math
+import unittest
+
+from tsfdb_server_v1.controllers.block_codec import encode_block, \
+    decode_block, HEADER, BLOCK_VERSION, INT_BLOCK, FLOAT_BLOCK, MIXED_BLOCK
+
+START = 1600000020
+
+
+class TestBlockCodec(unittest.TestCase):
+    """Encoding of per minute blocks of second datapoints"""
+
+    def assertRoundTrip(self, points, block_type):
+        block = encode_block(points)
+        self.assertEqual(HEADER.unpack_from(block),
+                         (BLOCK_VERSION, block_type, len(points)))
+        decoded = decode_block(block)
+        self.assertEqual(decoded, points)
+        self.assertEqual([type(value) for _, value in decoded],
+                         [type(value) for _, value in points])
+
+    def test_ints(self):
+        self.assertRoundTrip(
+            [[START + i, value] for i, value in
+             enumerate([0, 1, -1, 42, 42, 2 ** 62, -2 ** 62, 7])], INT_BLOCK)
+
+    def test_floats(self):
+        self.assertRoundTrip(
+            [[START + i, value] for i, value in
+             enumerate([0.0, 0.5, 0.5, -1.25, 1e300, 1e-300, math.pi])],
+            FLOAT_BLOCK)
+
+    def test_mixed(self):
+        self.assertRoundTrip(
+            [[START, 1], [START + 1, 1.5], [START + 2, 2], [START + 3, 2.0],
+             [START + 4, -3], [START + 5, 0.1]], MIXED_BLOCK)
+        self.assertRoundTrip([[START, 0.5], [START + 30, 3]], MIXED_BLOCK)
+
+    def test_single_point(self):
+        self.assertRoundTrip([[START, 3]], INT_BLOCK)
+        self.assertRoundTrip([[START, 3.5]], FLOAT_BLOCK)
+
+    def test_irregular_timestamps(self):
+        timestamps = [0, 1, 2, 10, 11, 59, 60 * 60 * 24 * 365, 2 ** 40]
+        self.assertRoundTrip(
+            [[START + timestamp, i] for i, timestamp in enumerate(timestamps)],
+            INT_BLOCK)
+
+    def test_full_minute(self):
+        self.assertRoundTrip(
+            [[START + i, i * 0.1] for i in range(60)], FLOAT_BLOCK)
+
+    def test_truncated(self):
+        block = encode_block([[START + i, i * 0.1] for i in range(60)])
+        for size in (0, 1, HEADER.size, HEADER.size + 8, len(block) - 8):
+            with self.assertRaises(ValueError):
+                decode_block(block[:size])
+
+    def test_unsupported_version(self):
+        block = encode_block([[START, 1]])
+        with self.assertRaises(ValueError):
+            decode_block(bytes([BLOCK_VERSION + 1]) + block[1:])
+
+    def test_unknown_block_type(self):
+        block = encode_block([[START, 1]])
+        with self.assertRaises(ValueError):
+            decode_block(block[:1] + bytes([7]) + block[2:])
+
+    def test_corrupted(self):
+        block = encode_block([[START, 1.5], [START + 1, 2.5]])
+        # A count above the number of encoded points runs out of bits
+        corrupted = HEADER.pack(BLOCK_VERSION, FLOAT_BLOCK, 1000) + \
+            block[HEADER.size:]
+        with self.assertRaises(ValueError):
+            decode_block(corrupted)
+        # Reusing the previous window before any was set
+        corrupted = HEADER.pack(BLOCK_VERSION, FLOAT_BLOCK, 2) + \
+            bytes(8) + bytes(8) + bytes([0b01000000]) + bytes(8)
+        with self.assertRaises(ValueError):
+            decode_block(corrupted)
+
+
+if __name__ == '__main__':
+    unittest.main()
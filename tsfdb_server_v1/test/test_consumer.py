@@ -0,0 +1,296 @@
+# coding: utf-8
+
+from __future__ import absolute_import
+import unittest
+from collections import deque
+from unittest import mock
+
+import fdb
+
+from consumer import Consumer, BatchTooLarge
+from tsfdb_server_v1.controllers.helpers import load_config
+from tsfdb_server_v1.controllers.queue import pack_item, LeaseLost, \
+    ENVELOPE_VERSION, CODECS
+from tsfdb_server_v1.controllers.db import PartialWrite
+
+LINE = "system,machine_id=m1 load1=0.5 1600000000000000000"
+
+
+class TestConsumer(unittest.TestCase):
+    """Consumption of queue items"""
+
+    def setUp(self):
+        with mock.patch('consumer.get_db_operations') as get_db_operations:
+            self.consumer = Consumer()
+        self.db_ops = get_db_operations.return_value
+        self.db_ops.time_series.series_type = 'monitoring'
+        self.queue = mock.Mock()
+        self.queue.name = 'q0'
+
+    def test_consume_items(self):
+        item = pack_item(('org', LINE))
+        self.consumer.consume_items(self.queue, [(item, 0)])
+        self.assertEqual(self.db_ops.write_lines.call_count, 1)
+        self.queue.dead_letter.assert_not_called()
+
+    def test_failed_write_is_dead_lettered(self):
+        self.db_ops.write_lines.side_effect = TimeoutError("Timed out")
+        item = pack_item(('org', LINE))
+        self.consumer.consume_items(self.queue, [(item, 2)])
+        self.queue.dead_letter.assert_called_once_with(
+            self.db_ops.db, item, "TimeoutError: Timed out", 3, retry=True)
+
+    def test_only_failed_items_are_dead_lettered(self):
+        items = [pack_item(('org', LINE)), pack_item(('org', LINE))]
+        # The merged write fails, then only the first item fails again
+        self.db_ops.write_lines.side_effect = [
+            TimeoutError("Timed out"), TimeoutError("Timed out"), None]
+        self.consumer.consume_items(self.queue, [(item, 0) for item in items])
+        self.queue.dead_letter.assert_called_once_with(
+            self.db_ops.db, items[0], "TimeoutError: Timed out", 1,
+            retry=True)
+
+    def test_partial_write_retries_remaining_lines(self):
+        items = [pack_item(('org', LINE)), pack_item(('org', LINE))]
+        remaining = [('m1', 'system.load1', None, {'load1': 0.5})]
+        self.db_ops.write_lines.side_effect = [
+            PartialWrite({}, remaining, TimeoutError("Timed out")), None]
+        self.consumer.consume_items(self.queue, [(item, 0) for item in items])
+        # Only the remaining lines are written again, not the items
+        self.assertEqual(self.db_ops.write_lines.call_count, 2)
+        retried = self.db_ops.write_lines.call_args[0][2]
+        self.assertEqual(list(retried.items()), remaining)
+        self.queue.dead_letter.assert_not_called()
+
+    def test_partial_write_is_not_retried(self):
+        items = [pack_item(('org', LINE)), pack_item(('org', LINE))]
+        remaining = [('m1', 'system.load1', None, {'load1': 0.5})]
+        self.db_ops.write_lines.side_effect = [
+            PartialWrite({}, remaining, TimeoutError("Timed out")),
+            TimeoutError("Timed out")]
+        self.consumer.consume_items(self.queue, [(item, 0) for item in items])
+        self.assertEqual(self.db_ops.write_lines.call_count, 2)
+        self.assertEqual(
+            [(call[0][1], call[1]) for call in
+             self.queue.dead_letter.call_args_list],
+            [(item, {'retry': False}) for item in items])
+
+    def test_poison_items_are_dead_lettered(self):
+        items = [
+            # Corrupted zlib stream
+            bytes((ENVELOPE_VERSION << 4 | CODECS['zlib'],)) + b'garbage',
+            # Not a tuple of org and data
+            pack_item(('org',)),
+            # Malformed line protocol
+            pack_item(('org', 'system load1=')),
+        ]
+        self.consumer.consume_items(self.queue, [(item, 0) for item in items])
+        self.db_ops.write_lines.assert_not_called()
+        self.assertEqual(
+            [(call[0][1], call[1]) for call in
+             self.queue.dead_letter.call_args_list],
+            [(item, {'retry': False}) for item in items])
+
+
+class Stop(Exception):
+    pass
+
+
+class TestConsumerErrors(unittest.TestCase):
+    """Recovery of the workers from FDB errors"""
+
+    def setUp(self):
+        with mock.patch('consumer.get_db_operations'):
+            self.consumer = Consumer()
+        self.consumer.db_ops.db = mock.Mock(spec=fdb.Database)
+        patcher = mock.patch('consumer.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_consume_queue_backs_off(self):
+        for code in (1031, 1007):
+            self.sleep.reset_mock()
+            with mock.patch('consumer.Queue') as Queue:
+                queue = Queue.return_value
+                queue.name = 'q0'
+                queue.pop_due_dead_letters.side_effect = fdb.FDBError(code)
+                self.consumer.consume_queue('q0', 'owner')
+            self.sleep.assert_called_once()
+            queue.release_lease.assert_called_once_with(
+                self.consumer.db_ops.db, 'owner')
+            self.assertNotIn('q0', self.consumer.leases)
+
+    def test_consume_queue_conflict(self):
+        with mock.patch('consumer.Queue') as Queue:
+            Queue.return_value.pop_due_dead_letters.side_effect = \
+                fdb.FDBError(1020)
+            self.consumer.consume_queue('q0', 'owner')
+        self.sleep.assert_not_called()
+
+    def test_run_backs_off(self):
+        with mock.patch.object(Consumer, 'list_queues', side_effect=[
+                fdb.FDBError(1031), Stop()]):
+            with self.assertRaises(Stop):
+                self.consumer.run()
+        self.sleep.assert_called_once()
+
+
+class TestConsumeExactlyOnce(unittest.TestCase):
+    """Consumption of batches in one transaction with their writes"""
+
+    def setUp(self):
+        with mock.patch('consumer.get_db_operations'):
+            self.consumer = Consumer(max_in_flight=3)
+        self.db = self.consumer.db_ops.db
+        self.db.create_transaction.side_effect = \
+            lambda: mock.MagicMock(spec=fdb.Transaction)
+        self.queue = mock.Mock()
+        self.queue.name = 'q0'
+        self.queue.pop_batch_or_watch.return_value = [], 'watch'
+        for target, attribute in (('consumer', 'sleep'),
+                                  ('consumer', 'metric_catalog'),
+                                  ('consumer.Consumer', 'consume_items')):
+            patcher = mock.patch('%s.%s' % (target, attribute))
+            setattr(self, attribute, patcher.start())
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict(load_config(), {
+            'QUEUE_POP_ITEMS': 8, 'CONSUMER_PIPELINE_DEPTH': 2,
+            'QUEUE_TRANSACTION_RETRY_LIMIT': 2})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def consume(self, *batches):
+        """Consume with consume_batch returning or raising batches"""
+        with mock.patch.object(Consumer, 'consume_batch',
+                               side_effect=batches) as self.consume_batch:
+            return self.consumer.consume_exactly_once(self.queue, 'owner')
+
+    def test_retries_on_new_transaction(self):
+        self.assertEqual(self.consume(fdb.FDBError(1031),
+                                      ([], {}, 'watch')),
+                         (False, 'watch'))
+        transactions = [call[0][0] for call in
+                        self.consume_batch.call_args_list]
+        self.assertEqual(len(set(map(id, transactions))), 2)
+        transactions[0].on_error.assert_not_called()
+        self.sleep.assert_called_once()
+        self.queue.pop_batch_or_watch.assert_not_called()
+
+    def test_retry_limit(self):
+        self.assertEqual(self.consume(*[fdb.FDBError(1031)] * 3),
+                         (False, 'watch'))
+        self.assertEqual(self.sleep.call_count, 2)
+        # The items are popped and written separately instead
+        self.queue.pop_batch_or_watch.assert_called_once_with(
+            self.db, mock.ANY, max_items=8, owner='owner')
+        self.consume_items.assert_called_once_with(self.queue, [])
+
+    def max_items(self):
+        return [call[0][3] for call in self.consume_batch.call_args_list]
+
+    def assertSlotsReleased(self):
+        for _ in range(3):
+            self.assertTrue(self.consumer.write_slots.acquire(blocking=False))
+
+    def test_halving(self):
+        # Batches too large, or too slow, for one transaction
+        self.assertEqual(self.consume(
+            BatchTooLarge(), fdb.FDBError(2101), fdb.FDBError(1007),
+            ([], {}, 'watch')), (False, 'watch'))
+        self.assertEqual(self.max_items(), [8, 4, 2, 1])
+        self.sleep.assert_not_called()
+        self.queue.pop_batch_or_watch.assert_not_called()
+        self.assertSlotsReleased()
+
+    def test_fallback_to_single_items(self):
+        # Items too large for one transaction on their own are popped and
+        # written separately
+        self.queue.pop_batch_or_watch.return_value = ['item'], None
+        self.assertEqual(self.consume(*[BatchTooLarge()] * 4),
+                         (True, None))
+        self.assertEqual(self.max_items(), [8, 4, 2, 1])
+        self.queue.pop_batch_or_watch.assert_called_once_with(
+            self.db, mock.ANY, max_items=1, owner='owner')
+        self.consume_items.assert_called_once_with(self.queue, [('item', 0)])
+        self.assertSlotsReleased()
+
+    def test_finish_commits_returns_first_failure(self):
+        in_flight = deque()
+        for code in (None, 1031, 1020):
+            self.consumer.write_slots.acquire()
+            commit = mock.Mock()
+            if code:
+                commit.wait.side_effect = fdb.FDBError(code)
+            in_flight.append((code, commit, {}))
+        tr, err = self.consumer.finish_commits(in_flight)
+        self.assertEqual((tr, err.code), (1031, 1031))
+        self.assertFalse(in_flight)
+        self.assertSlotsReleased()
+
+
+class TestConsumeClaims(unittest.TestCase):
+    """Consumption of claimed items, acked with their writes"""
+
+    def setUp(self):
+        with mock.patch('consumer.get_db_operations'):
+            self.consumer = Consumer()
+        self.db_ops = self.consumer.db_ops
+        self.db_ops.time_series.series_type = 'monitoring'
+        self.db_ops.write_lines_batch.return_value = {}, {}
+        self.queue = mock.Mock()
+        self.queue.name = 'q0'
+        self.claimed = [(('k%d' % i,), pack_item(('org', LINE)))
+                        for i in range(3)]
+        for attribute in ('metric_catalog', 'Consumer.consume_items'):
+            patcher = mock.patch('consumer.%s' % attribute)
+            setattr(self, attribute.split('.')[-1], patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def test_only_acked_items_are_written(self):
+        # The claim of the others expired and they were claimed again
+        self.queue.ack.return_value = self.claimed[:1]
+        tr = mock.MagicMock(spec=fdb.Transaction)
+        self.consumer.consume_claimed(tr, self.queue, 'owner', self.claimed)
+        self.queue.ack.assert_called_once_with(tr, 'owner', self.claimed)
+        self.db_ops.write_lines_batch.assert_called_once()
+        self.assertEqual(
+            len(self.db_ops.write_lines_batch.call_args[0][2]), 1)
+
+    def test_nothing_acked(self):
+        self.queue.ack.return_value = []
+        self.consumer.consume_claimed(mock.MagicMock(spec=fdb.Transaction),
+                                      self.queue, 'owner', self.claimed)
+        self.db_ops.write_lines_batch.assert_not_called()
+
+    def test_nothing_claimed(self):
+        self.queue.claim_batch_or_watch.return_value = [], 'watch'
+        self.assertEqual(self.consumer.consume_claims(self.queue, 'owner'),
+                         (False, 'watch'))
+
+    def test_lost_lease(self):
+        self.queue.claim_batch_or_watch.side_effect = LeaseLost()
+        with self.assertRaises(LeaseLost):
+            self.consumer.consume_claims(self.queue, 'owner')
+        self.queue.claim_batch_or_watch.assert_called_once_with(
+            self.db_ops.db, 'owner', mock.ANY, mock.ANY, lease=True)
+
+    def test_failed_batch_is_consumed_per_item(self):
+        self.queue.claim_batch_or_watch.return_value = self.claimed, None
+        self.queue.ack.return_value = self.claimed[1:2]
+        with mock.patch.object(Consumer, 'consume_claimed', side_effect=[
+                fdb.FDBError(1031), {}, BatchTooLarge(), {}]) as claimed:
+            self.assertEqual(self.consumer.consume_claims(
+                self.queue, 'owner', shared=True), (True, None))
+        self.assertEqual([call[0][3] for call in claimed.call_args_list], [
+            self.claimed, self.claimed[:1], self.claimed[1:2],
+            self.claimed[2:]])
+        # The item too large for one transaction is acked and written
+        # separately
+        self.queue.ack.assert_called_once_with(
+            self.db_ops.db, 'owner', self.claimed[1:2])
+        self.consume_items.assert_called_once_with(
+            self.queue, [(self.claimed[1][1], 0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,13 +2,17 @@
 
 from __future__ import absolute_import
 import unittest
+from unittest import mock
 
 from flask import json
 from six import BytesIO
 
+from tsfdb_server_v1.controllers import datapoints_controller
+from tsfdb_server_v1.controllers.helpers import load_config
 from tsfdb_server_v1.models.datapoints_response import DatapointsResponse  # noqa: E501
 from tsfdb_server_v1.models.error import Error  # noqa: E501
 from tsfdb_server_v1.test import BaseTestCase
+from tsfdb_server_v1.test.test_remote_write import write_request
 
 
 class TestDatapointsController(BaseTestCase):
@@ -54,6 +58,109 @@ class TestDatapointsController(BaseTestCase):
         self.assert200(response,
                        'Response body is : ' + response.data.decode('utf-8'))
 
+    def test_write_datapoints_malformed_line(self):
+        """Test case for write_datapoints with a malformed line after
+        several batches of valid ones"""
+        line = b"system,machine_id=m1 load1=0.5 1600000000000000000\n"
+        for bad_line in (b"system,machine_id=m1 load1= 1600000000000000000",
+                         b"system load1=0.5 1600000000000000000"):
+            body = line * 10 + bad_line + b"\n" + line
+            for write_in_queue in (True, False):
+                with mock.patch.object(
+                        datapoints_controller,
+                        'get_db_operations') as get_db_operations, \
+                        mock.patch.dict(load_config(), {
+                            'INGEST_BATCH_BYTES': len(line) * 2,
+                            'WRITE_IN_QUEUE': write_in_queue}):
+                    get_db_operations.return_value.queue_retry_after \
+                        .return_value = None
+                    result = datapoints_controller.write_datapoints(
+                        'org', body)
+                self.assertIsInstance(result, Error)
+                self.assertEqual(result.code, 400)
+                db_ops = get_db_operations.return_value
+                db_ops.write_in_kv.assert_not_called()
+                db_ops.write_in_queue.assert_not_called()
+
+    def test_write_datapoints_in_batches(self):
+        """Test case for write_datapoints with a body of several batches"""
+        line = b"system,machine_id=m1 load1=0.5 1600000000000000000\n"
+        with mock.patch.object(datapoints_controller,
+                               'get_db_operations') as get_db_operations, \
+                mock.patch.dict(load_config(), {
+                    'INGEST_BATCH_BYTES': len(line),
+                    'WRITE_IN_QUEUE': False}):
+            self.assertIsNone(
+                datapoints_controller.write_datapoints('org', line * 5))
+        self.assertEqual(
+            get_db_operations.return_value.write_in_kv.call_count, 3)
+
+    def test_write_prometheus_datapoints(self):
+        """Test case for write_prometheus_datapoints
+
+        Write datapoints from Prometheus remote_write to db, the controller
+        is called directly since Connexion doesn't support
+        application/x-protobuf bodies
+        """
+        body = write_request(
+            ({'__name__': 'node_load1', 'machine_id': 'm1'},
+             [(1600000000000, 0.5), (1600000015000, float('nan')),
+              (1600000030000, float('inf')), (1600000045000, -float('inf')),
+              (1600000060000, 2.0)]),
+            # Series without a machine are dropped
+            ({'__name__': 'up'}, [(1600000000000, 1.0)]))
+        with mock.patch.object(datapoints_controller,
+                               'get_db_operations') as get_db_operations, \
+                mock.patch.dict(load_config(), {'WRITE_IN_QUEUE': False}):
+            result = datapoints_controller.write_prometheus_datapoints(
+                'org', body)
+        self.assertIsNone(result)
+        db_ops = get_db_operations.return_value
+        org, line_batch = db_ops.write_in_kv.call_args[0]
+        self.assertEqual(org, 'org')
+        self.assertEqual(
+            [(machine, metric, fields) for machine, metric, _, fields
+             in line_batch.items()],
+            [('m1', 'node_load1', {'value': 0.5}),
+             ('m1', 'node_load1', {'value': 2.0})])
+
+    def test_write_prometheus_datapoints_in_queue(self):
+        """Test case for write_prometheus_datapoints queueing the request"""
+        body = write_request(
+            ({'__name__': 'node_load1', 'machine_id': 'm1'},
+             [(1600000000000, 0.5)]))
+        with mock.patch.object(datapoints_controller,
+                               'get_db_operations') as get_db_operations, \
+                mock.patch.dict(load_config(), {'WRITE_IN_QUEUE': True}):
+            db_ops = get_db_operations.return_value
+            db_ops.queue_retry_after.return_value = None
+            self.assertIsNone(
+                datapoints_controller.write_prometheus_datapoints(
+                    'org', body))
+            db_ops.write_in_queue.assert_called_once_with(
+                'org', mock.ANY, body)
+            # Deep queues reject the request before anything is queued
+            db_ops.write_in_queue.reset_mock()
+            db_ops.queue_retry_after.return_value = 5
+            _, status, _ = datapoints_controller.write_prometheus_datapoints(
+                'org', body)
+            self.assertEqual(status, 429)
+            db_ops.write_in_queue.assert_not_called()
+
+    def test_write_prometheus_datapoints_bad_request(self):
+        """Test case for write_prometheus_datapoints with a corrupted
+        request"""
+        body = write_request(
+            ({'__name__': 'node_load1', 'machine_id': 'm1'},
+             [(1600000000000, 0.5)]))
+        with mock.patch.object(datapoints_controller,
+                               'get_db_operations') as get_db_operations:
+            result = datapoints_controller.write_prometheus_datapoints(
+                'org', body[:len(body) // 2])
+        self.assertIsInstance(result, Error)
+        self.assertEqual(result.code, 400)
+        get_db_operations.return_value.write_in_kv.assert_not_called()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,92 @@
+# coding: utf-8
+
+from __future__ import absolute_import
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import fdb
+
+from tsfdb_server_v1.controllers.db import DBOperations, PartialWrite
+
+fdb.api_version(620)
+
+DT = datetime(2020, 9, 13, 12, 26)
+
+
+def lines(count, machine='m1'):
+    return [(machine, 'cpu', DT.replace(minute=minute), {'idle': minute})
+            for minute in range(count)]
+
+
+class TestWriteBatch(unittest.TestCase):
+    """Halving of batches too large for one transaction"""
+
+    def setUp(self):
+        with mock.patch.object(DBOperations, 'open_db'):
+            self.db_ops = DBOperations()
+        patcher = mock.patch(
+            'tsfdb_server_v1.controllers.db.metric_catalog')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.written = []
+
+    def write_lines_batch(self, max_lines, failing=()):
+        def write(db, org, batch):
+            if len(batch) > max_lines:
+                raise fdb.FDBError(2101)  # transaction_too_large
+            if any(line in failing for line in batch):
+                raise fdb.FDBError(1031)  # transaction_timed_out
+            self.written.append(batch)
+            return {'m1': {line[1] for line in batch}}, {}
+        return mock.patch.object(DBOperations, 'write_lines_batch',
+                                 side_effect=write)
+
+    def test_write_batch(self):
+        batch = lines(4)
+        with self.write_lines_batch(4):
+            self.assertEqual(self.db_ops.write_batch(None, 'org', batch),
+                             {'m1': {'cpu'}})
+        self.assertEqual(self.written, [batch])
+
+    def test_halving(self):
+        batch = lines(8)
+        with self.write_lines_batch(2):
+            self.db_ops.write_batch(None, 'org', batch)
+        self.assertEqual(self.written, [batch[0:2], batch[2:4],
+                                        batch[4:6], batch[6:8]])
+
+    def test_single_line_too_large(self):
+        with self.write_lines_batch(0):
+            with self.assertRaises(fdb.FDBError):
+                self.db_ops.write_batch(None, 'org', lines(1))
+        self.assertEqual(self.written, [])
+
+    def test_other_errors_are_not_halved(self):
+        batch = lines(4)
+        with self.write_lines_batch(4, failing=batch[:1]) as write:
+            with self.assertRaises(fdb.FDBError):
+                self.db_ops.write_batch(None, 'org', batch)
+        self.assertEqual(write.call_count, 1)
+
+    def test_partial_write(self):
+        batch = lines(4)
+        with self.write_lines_batch(2, failing=batch[3:]):
+            with self.assertRaises(PartialWrite) as context:
+                self.db_ops.write_batch(None, 'org', batch)
+        self.assertEqual(self.written, [batch[:2]])
+        self.assertEqual(context.exception.remaining, batch[2:])
+        self.assertEqual(context.exception.metrics, {'m1': {'cpu'}})
+
+    def test_partial_write_in_first_half(self):
+        batch = lines(8)
+        with self.write_lines_batch(2, failing=batch[2:3]):
+            with self.assertRaises(PartialWrite) as context:
+                self.db_ops.write_batch(None, 'org', batch)
+        self.assertEqual(self.written, [batch[:2]])
+        # The lines of the second half weren't written either
+        self.assertEqual(context.exception.remaining, batch[2:])
+
+
+if __name__ == '__main__':
+    unittest.main()
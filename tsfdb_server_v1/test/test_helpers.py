@@ -0,0 +1,130 @@
+# coding: utf-8
+
+from __future__ import absolute_import
+import unittest
+from datetime import datetime
+from unittest import mock
+
+from tsfdb_server_v1.controllers.helpers import estimate_mutation_bytes, \
+    split_in_batches, split_batch, jump_hash, stable_hash, get_queue_id, \
+    load_config
+
+DT = datetime(2020, 9, 13, 12, 26)
+
+
+def line(machine, metric, second=0, minute=26, fields=None):
+    return (machine, metric, DT.replace(minute=minute, second=second),
+            fields or {'value': 1})
+
+
+class TestWriteBatches(unittest.TestCase):
+    """Splitting of parsed lines in batches committed concurrently"""
+
+    def test_estimate_mutation_bytes(self):
+        self.assertEqual(estimate_mutation_bytes('cpu', {}), 0)
+        one = estimate_mutation_bytes('cpu', {'idle': 1})
+        self.assertEqual(estimate_mutation_bytes(
+            'cpu', {'idle': 1, 'user': 2}), 2 * one)
+        self.assertGreater(estimate_mutation_bytes('cpu.longer', {'idle': 1}),
+                           one)
+
+    def test_split_in_batches(self):
+        size = estimate_mutation_bytes('cpu', {'value': 1})
+        lines = [line('m1', 'cpu', second) for second in range(3)] + \
+            [line('m2', 'cpu', second) for second in range(3)] + \
+            [line('m1', 'mem', second) for second in range(3)]
+        self.assertEqual(split_in_batches(lines, 3 * size),
+                         [lines[:3], lines[3:6], lines[6:]])
+        self.assertEqual(split_in_batches(lines, 6 * size),
+                         [lines[:6], lines[6:]])
+        self.assertEqual(split_in_batches(lines, 9 * size), [lines])
+
+    def test_split_in_batches_keeps_series_together(self):
+        # The lines of a (machine, metric) are never split, even when they
+        # exceed max_bytes on their own
+        lines = [line('m1', 'cpu', second) for second in range(10)] + \
+            [line('m2', 'cpu')]
+        self.assertEqual(split_in_batches(lines, 1),
+                         [lines[:10], lines[10:]])
+        interleaved = [line('m1', 'cpu', 1), line('m2', 'cpu', 1),
+                       line('m1', 'cpu', 2)]
+        self.assertEqual(split_in_batches(interleaved, 1), [
+            [interleaved[0], interleaved[2]], [interleaved[1]]])
+
+    def test_split_in_batches_empty(self):
+        self.assertEqual(split_in_batches([], 100), [[]])
+
+    def test_split_batch(self):
+        batch = [line('m1', 'cpu', second, minute)
+                 for minute in (26, 27) for second in (0, 30)]
+        self.assertEqual(split_batch(batch), (batch[:2], batch[2:]))
+
+    def test_split_batch_at_minute_boundary(self):
+        # The middle falls in the second minute, the cut moves after it
+        batch = [line('m1', 'cpu', 0, 26)] + \
+            [line('m1', 'cpu', second, 27) for second in range(3)] + \
+            [line('m1', 'cpu', 0, 28)]
+        self.assertEqual(split_batch(batch), (batch[:4], batch[4:]))
+        # When the last minute is shared, the cut moves before it
+        batch = [line('m1', 'cpu', 0, 26)] + \
+            [line('m1', 'cpu', second, 27) for second in range(3)]
+        self.assertEqual(split_batch(batch), (batch[:1], batch[1:]))
+
+    def test_split_batch_single_minute(self):
+        # Halves share the minute when there's no other way to split
+        batch = [line('m1', 'cpu', second) for second in range(4)]
+        self.assertEqual(split_batch(batch), (batch[:2], batch[2:]))
+
+    def test_split_batch_sorts(self):
+        batch = [line('m2', 'cpu'), line('m1', 'mem'), line('m1', 'cpu')]
+        first, second = split_batch(batch)
+        self.assertEqual(first + second, sorted(batch, key=lambda l: l[:3]))
+        self.assertEqual(len(first), 1)
+
+
+class TestQueueSharding(unittest.TestCase):
+    """Sharding of machines to queues with jump consistent hashing"""
+
+    def test_jump_hash(self):
+        # Outputs of the reference implementation
+        for key, buckets, bucket in ((1, 1, 0), (42, 57, 43),
+                                     (0xDEAD10CC, 1, 0),
+                                     (0xDEAD10CC, 666, 361),
+                                     (256, 1024, 520)):
+            self.assertEqual(jump_hash(key, buckets), bucket)
+
+    def test_jump_hash_range(self):
+        for buckets in (1, 2, 7, 100):
+            for key in range(1000):
+                self.assertIn(jump_hash(stable_hash(str(key)), buckets),
+                              range(buckets))
+
+    def test_minimal_remapping(self):
+        keys = [stable_hash('machine-%d' % i) for i in range(10000)]
+        for buckets in (1, 4, 10):
+            before = [jump_hash(key, buckets) for key in keys]
+            after = [jump_hash(key, buckets + 1) for key in keys]
+            moved = [new for old, new in zip(before, after) if old != new]
+            # Keys only move to the new bucket, about 1 / (n + 1) of them
+            self.assertEqual(set(moved), {buckets})
+            self.assertAlmostEqual(len(moved) / len(keys),
+                                   1 / (buckets + 1), delta=0.02)
+
+    def test_stable_hash(self):
+        self.assertEqual(stable_hash('m1'), stable_hash('m1'))
+        self.assertNotEqual(stable_hash('m1'), stable_hash('m2'))
+        self.assertLess(stable_hash('m1'), 2 ** 64)
+
+    def test_get_queue_id(self):
+        self.assertEqual(get_queue_id('m1', -1), 'm1')
+        self.assertEqual(get_queue_id('m1', 1), 'q0')
+        self.assertEqual(get_queue_id('m1', 16),
+                         'q%d' % jump_hash(stable_hash('m1'), 16))
+        with mock.patch.dict(load_config(), {'QUEUES': -1}):
+            self.assertEqual(get_queue_id('m1'), 'm1')
+        with mock.patch.dict(load_config(), {'QUEUES': 16}):
+            self.assertEqual(get_queue_id('m1'), get_queue_id('m1', 16))
+
+
+if __name__ == '__main__':
+    unittest.main()
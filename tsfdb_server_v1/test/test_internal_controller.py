@@ -27,6 +27,38 @@ class TestInternalController(BaseTestCase):
         self.assert200(response,
                        'Response body is : ' + response.data.decode('utf-8'))
 
+    def test_list_dead_letters(self):
+        """Test case for list_dead_letters
+
+        Return the items of a queue which failed to be consumed
+        """
+        headers = { 
+            'Accept': 'application/json',
+        }
+        response = self.client.open(
+            '/v1/internal/queues/{queue_name}/dead_letters'.format(queue_name='queue_name_example'),
+            method='GET',
+            headers=headers)
+        self.assert200(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+
+    def test_replay_dead_letters(self):
+        """Test case for replay_dead_letters
+
+        Push dead letters back to their queue
+        """
+        query_string = [('limit', 1000)]
+        headers = { 
+            'Accept': 'application/json',
+        }
+        response = self.client.open(
+            '/v1/internal/queues/{queue_name}/dead_letters/replay'.format(queue_name='queue_name_example'),
+            method='POST',
+            headers=headers,
+            query_string=query_string)
+        self.assert200(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -2,10 +2,13 @@
 
 from __future__ import absolute_import
 import unittest
+from unittest import mock
 
 from flask import json
 from six import BytesIO
 
+from tsfdb_server_v1.controllers import metering_controller
+from tsfdb_server_v1.controllers.helpers import load_config
 from tsfdb_server_v1.models.datapoints_response import DatapointsResponse  # noqa: E501
 from tsfdb_server_v1.models.error import Error  # noqa: E501
 from tsfdb_server_v1.test import BaseTestCase
@@ -54,6 +57,21 @@ class TestMeteringController(BaseTestCase):
         self.assert200(response,
                        'Response body is : ' + response.data.decode('utf-8'))
 
+    def test_write_metering_datapoints_malformed_line(self):
+        """Test case for write_metering_datapoints with a malformed line
+        after several batches of valid ones"""
+        line = b"cost,machine_id=m1 value=0.5 1600000000000000000\n"
+        body = line * 10 + b"cost,machine_id=m1 value=\n" + line
+        with mock.patch.object(metering_controller,
+                               'get_db_operations') as get_db_operations, \
+                mock.patch.dict(load_config(),
+                                {'INGEST_BATCH_BYTES': len(line) * 2}):
+            result = metering_controller.write_metering_datapoints(
+                'org', body)
+        self.assertIsInstance(result, Error)
+        self.assertEqual(result.code, 400)
+        get_db_operations.return_value.write_in_kv.assert_not_called()
+
 
 if __name__ == '__main__':
     unittest.main()
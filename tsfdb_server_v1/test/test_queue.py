@@ -0,0 +1,358 @@
+# coding: utf-8
+
+from __future__ import absolute_import
+import struct
+import unittest
+import zlib
+from unittest import mock
+
+import fdb
+
+from tsfdb_server_v1.controllers.directory_cache import directory_cache
+from tsfdb_server_v1.controllers.helpers import load_config
+from tsfdb_server_v1.controllers.queue import Queue, pack_item, \
+    unpack_item, is_chunk, LeaseLost, ENVELOPE_VERSION, CODECS
+from tsfdb_server_v1.test.test_time_series_layer import Value
+
+fdb.api_version(620)
+
+LINES = "system,machine_id=m1 load1=0.5 1600000000000000000\n" * 100
+
+
+class TestItemEnvelope(unittest.TestCase):
+    """Packing of queue items with optional compression"""
+
+    def assertRoundTrip(self, value, compression):
+        item = pack_item(value, compression)
+        self.assertEqual(unpack_item(item), value)
+        # Items read from fdb are Value objects, not bytes
+        self.assertEqual(unpack_item(bytearray(item)), value)
+        return item
+
+    def test_uncompressed(self):
+        for compression in ('none', None):
+            with mock.patch.dict(load_config(),
+                                 {'QUEUE_COMPRESSION': 'none'}):
+                item = self.assertRoundTrip(('org', LINES), compression)
+            # Uncompressed items are plain packed tuples, like before the
+            # envelope, starting with the type code of a string
+            self.assertEqual(item, fdb.tuple.pack(('org', LINES)))
+            self.assertEqual(item[:1], b'\x02')
+
+    def test_zlib(self):
+        item = self.assertRoundTrip(('org', LINES), 'zlib')
+        self.assertEqual(item[0], ENVELOPE_VERSION << 4 | CODECS['zlib'])
+        self.assertLess(len(item), len(fdb.tuple.pack(('org', LINES))))
+
+    def test_zstd(self):
+        item = self.assertRoundTrip(('org', LINES), 'zstd')
+        self.assertIn(item[0], (ENVELOPE_VERSION << 4 | CODECS['zstd'],
+                                ENVELOPE_VERSION << 4 | CODECS['zlib']))
+
+    def test_default_compression(self):
+        with mock.patch.dict(load_config(), {'QUEUE_COMPRESSION': 'zlib'}):
+            item = self.assertRoundTrip(('org', LINES), None)
+        self.assertEqual(item[0], ENVELOPE_VERSION << 4 | CODECS['zlib'])
+
+    def test_binary_payload(self):
+        # remote_write requests are queued as bytes
+        self.assertRoundTrip(('org', b'\x00\xff' * 1000), 'zlib')
+        self.assertRoundTrip(('org', b'\x00\xff' * 1000), 'none')
+
+    def test_unsupported_version(self):
+        item = bytes(((ENVELOPE_VERSION + 1) << 4 | CODECS['zlib'],)) + \
+            zlib.compress(fdb.tuple.pack(('org', LINES)))
+        with self.assertRaises(ValueError):
+            unpack_item(item)
+
+    def test_unsupported_codec(self):
+        item = bytes((ENVELOPE_VERSION << 4 | 0x0f,)) + b'data'
+        with self.assertRaises(ValueError):
+            unpack_item(item)
+
+    def test_is_chunk(self):
+        stamp = fdb.tuple.Versionstamp(b'\x00' * 10)
+        self.assertFalse(is_chunk((stamp,)))
+        self.assertTrue(is_chunk((stamp, 0)))
+        self.assertTrue(is_chunk((stamp, 3)))
+        # Items of queues from before versionstamped keys
+        self.assertFalse(is_chunk((12, 'item-id')))
+        self.assertTrue(is_chunk((12, 'item-id', 0)))
+
+
+class TestItemChunks(unittest.TestCase):
+    """Splitting of items above the value size limit in chunks"""
+
+    def setUp(self):
+        patcher = mock.patch.dict(load_config(), {'QUEUE_CHUNK_BYTES': 10})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def split(self, item):
+        return list(Queue.split_item(item))
+
+    def test_empty(self):
+        self.assertEqual(self.split(b''), [((), b'')])
+
+    def test_chunk_size(self):
+        self.assertEqual(self.split(b'a' * 9), [((), b'a' * 9)])
+        self.assertEqual(self.split(b'a' * 10), [((), b'a' * 10)])
+
+    def test_chunk_size_plus_one(self):
+        self.assertEqual(self.split(b'a' * 10 + b'b'),
+                         [((0,), b'a' * 10), ((1,), b'b')])
+
+    def test_multiple_of_chunk_size(self):
+        item = bytes(range(30))
+        self.assertEqual(self.split(item), [
+            ((0,), item[:10]), ((1,), item[10:20]), ((2,), item[20:])])
+
+    def test_reassembly(self):
+        queue = Queue('q0')
+        subspace = fdb.Subspace(('queue', 'q0'))
+        items = [b'', b'a' * 10, b'b' * 11, bytes(range(25)), b'c']
+        kvs = []
+        for i, item in enumerate(items):
+            stamp = fdb.tuple.Versionstamp(bytes(9) + bytes((i,)))
+            for suffix, chunk in queue.split_item(item):
+                key = (stamp,) + suffix
+                self.assertEqual(is_chunk(key), bool(suffix))
+                kvs.append((subspace.pack(key), chunk))
+        tr = mock.MagicMock(spec=fdb.Transaction)
+        tr.get_range.return_value = kvs
+        with mock.patch.object(Queue, 'open_queue', return_value=subspace), \
+                mock.patch.object(Queue, 'update_stats') as update_stats:
+            popped = queue.pop_batch(tr, max_items=10, max_bytes=1000)
+        self.assertEqual(popped, items)
+        update_stats.assert_called_once_with(
+            tr, -len(items), -sum(map(len, items)))
+        # Only the first items are popped, with all their chunks
+        tr.get_range.return_value = kvs
+        with mock.patch.object(Queue, 'open_queue', return_value=subspace), \
+                mock.patch.object(Queue, 'update_stats'):
+            popped = queue.pop_batch(tr, max_items=3, max_bytes=1000)
+        self.assertEqual(popped, items[:3])
+        self.assertEqual(queue.last_popped, kvs[3][0])
+
+
+def key_bytes(key):
+    # Subspaces can be used as keys
+    return key.key() if isinstance(key, fdb.Subspace) else key
+
+
+class TestPush(unittest.TestCase):
+    """Pushes to queues whose directory may have been deleted"""
+
+    def setUp(self):
+        self.queue = Queue('q0')
+        self.path = ('queue', 'q0')
+        self.directory = fdb.Subspace(rawPrefix=b'\x15\x02')
+        patcher = mock.patch(
+            'tsfdb_server_v1.controllers.directory_cache.fdb.directory')
+        fdb_directory = patcher.start()
+        self.addCleanup(patcher.stop)
+        fdb_directory.create_or_open.side_effect = \
+            lambda tr, path: self.directory
+        self.addCleanup(directory_cache.invalidate, self.path)
+        self.registration = None
+        self.tr = mock.MagicMock(spec=fdb.Transaction)
+        self.tr.__getitem__.side_effect = lambda key: Value(
+            self.registration if key_bytes(key) ==
+            self.queue.available_queue.key() else None)
+
+    def push(self):
+        self.tr.reset_mock()
+        self.queue.push_item(self.tr, pack_item(('org', 'line'), 'none'))
+        return [call[0][0] for call in
+                self.tr.set_versionstamped_key.call_args_list]
+
+    def registered(self):
+        return [(key_bytes(key), value) for key, value in
+                (call[0] for call in self.tr.__setitem__.call_args_list)
+                if key_bytes(key) == self.queue.available_queue.key()]
+
+    def test_first_push(self):
+        keys = self.push()
+        self.assertTrue(keys[0].startswith(self.directory.key()))
+        self.assertEqual(self.registered(), [(
+            self.queue.available_queue.key(),
+            fdb.tuple.pack((0, self.directory.key())))])
+        self.assertEqual(directory_cache.get(self.path), self.directory)
+
+    def test_push_after_queue_was_recreated(self):
+        # The queue was deleted and created again by another process
+        directory_cache.put(self.path, fdb.Subspace(rawPrefix=b'\x15\x01'))
+        self.registration = fdb.tuple.pack((0, self.directory.key()))
+        keys = self.push()
+        self.assertTrue(keys[0].startswith(self.directory.key()))
+        self.assertEqual(directory_cache.get(self.path), self.directory)
+        self.assertEqual(self.registered(), [])
+
+    def test_push_with_cached_prefix(self):
+        directory_cache.put(self.path, self.directory)
+        self.registration = fdb.tuple.pack((0, self.directory.key()))
+        keys = self.push()
+        self.assertTrue(keys[0].startswith(self.directory.key()))
+        self.assertEqual(self.registered(), [])
+
+    def test_push_to_legacy_registration(self):
+        # Registrations without the prefix can't be compared, the prefix
+        # is resolved again and kept with the registration
+        directory_cache.put(self.path, fdb.Subspace(rawPrefix=b'\x15\x01'))
+        self.registration = fdb.tuple.pack((0,))
+        keys = self.push()
+        self.assertTrue(keys[0].startswith(self.directory.key()))
+        self.assertEqual(self.registered(), [(
+            self.queue.available_queue.key(),
+            fdb.tuple.pack((0, self.directory.key())))])
+
+
+def memory_transaction(kvs):
+    """Transaction reading and writing the kvs dict"""
+    tr = mock.MagicMock(spec=fdb.Transaction)
+    tr.snapshot = tr
+    tr.options = mock.Mock()
+
+    def get_range(begin, end, limit=0, **kwargs):
+        keys = sorted(key for key in kvs
+                      if key_bytes(begin) <= key < key_bytes(end))
+        return [(key, kvs[key]) for key in keys[:limit or None]]
+
+    def delete(key):
+        if isinstance(key, slice):
+            for k, _ in get_range(key.start, key.stop):
+                del kvs[k]
+        else:
+            kvs.pop(key_bytes(key), None)
+
+    def add(key, param):
+        value = kvs.get(key_bytes(key), bytes(8))
+        kvs[key_bytes(key)] = struct.pack('<q', struct.unpack(
+            '<q', value)[0] + struct.unpack('<q', param)[0])
+
+    tr.__getitem__.side_effect = lambda key: Value(kvs.get(key_bytes(key)))
+    tr.__setitem__.side_effect = \
+        lambda key, value: kvs.__setitem__(key_bytes(key), value)
+    tr.__delitem__.side_effect = delete
+    tr.get_range.side_effect = get_range
+    tr.add.side_effect = add
+    tr.watch.return_value = 'watch'
+    return tr
+
+
+class TestClaims(unittest.TestCase):
+    """Claims of items consumed concurrently by several consumers"""
+
+    def setUp(self):
+        self.queue = Queue('q0')
+        self.subspace = fdb.Subspace(('queue', 'q0'))
+        patcher = mock.patch.object(Queue, 'open_queue',
+                                    return_value=self.subspace)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('tsfdb_server_v1.controllers.queue.time')
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.time.return_value = 1000
+        self.kvs = {}
+        self.tr = memory_transaction(self.kvs)
+        self.items = [b'a', b'bb' * 10, b'ccc']
+        with mock.patch.dict(load_config(), {'QUEUE_CHUNK_BYTES': 10}):
+            for i, item in enumerate(self.items):
+                stamp = fdb.tuple.Versionstamp(bytes(9) + bytes((i,)))
+                for suffix, chunk in self.queue.split_item(item):
+                    self.kvs[self.subspace.pack((stamp,) + suffix)] = chunk
+        self.queue.update_stats(self.tr, len(self.items),
+                                sum(map(len, self.items)))
+
+    def claim(self, owner, max_items=2, lease=False):
+        return self.queue.claim_batch_or_watch(
+            self.tr, owner, 1, 30, max_items=max_items, lease=lease)
+
+    def stats(self):
+        return [struct.unpack('<q', self.kvs[self.queue.stats[key].key()])[0]
+                for key in ('items', 'bytes')]
+
+    def test_claim(self):
+        claimed, watch = self.claim('a')
+        self.assertIsNone(watch)
+        self.assertEqual([item for _, item in claimed], self.items[:2])
+        # Items stay in the queue until they're acked
+        self.assertEqual(self.stats(), [3, 24])
+        for prefix, _ in claimed:
+            self.assertEqual(
+                fdb.tuple.unpack(self.kvs[self.queue.claims.pack(prefix)]),
+                ('a', 1030))
+
+    def test_claimed_items_are_skipped(self):
+        self.claim('a')
+        claimed, _ = self.claim('b')
+        self.assertEqual([item for _, item in claimed], self.items[2:])
+        self.assertEqual(self.claim('c'), ([], 'watch'))
+
+    def test_expired_claim(self):
+        self.claim('a')
+        self.time.return_value = 1029
+        self.assertEqual([item for _, item in self.claim('b')[0]],
+                         self.items[2:])
+        # Claims expire after the visibility timeout
+        self.time.return_value = 1030
+        self.assertEqual([item for _, item in self.claim('c')[0]],
+                         self.items[:2])
+
+    def test_ack(self):
+        claimed, _ = self.claim('a')
+        self.assertEqual(self.queue.ack(self.tr, 'a', claimed), claimed)
+        self.assertEqual(self.stats(), [1, 3])
+        self.assertEqual([key for key in self.kvs
+                          if self.queue.claims.contains(key)], [])
+        self.assertEqual([item for _, item in self.claim('b')[0]],
+                         self.items[2:])
+
+    def test_double_ack(self):
+        claimed, _ = self.claim('a')
+        self.queue.ack(self.tr, 'a', claimed)
+        self.assertEqual(self.queue.ack(self.tr, 'a', claimed), [])
+        self.assertEqual(self.stats(), [1, 3])
+
+    def test_ack_of_item_already_removed(self):
+        claimed, _ = self.claim('a')
+        self.queue.pop_batch(self.tr, max_items=1)
+        self.assertEqual(self.queue.ack(self.tr, 'a', claimed), claimed[1:])
+        self.assertEqual(self.stats(), [1, 3])
+
+    def test_ack_of_items_all_removed(self):
+        claimed, _ = self.claim('a')
+        self.queue.pop_batch(self.tr, max_items=2)
+        with mock.patch.object(Queue, 'update_stats') as update_stats:
+            self.assertEqual(self.queue.ack(self.tr, 'a', claimed), [])
+        update_stats.assert_not_called()
+        # The claims are removed all the same
+        self.assertEqual([key for key in self.kvs
+                          if self.queue.claims.contains(key)], [])
+
+    def test_ack_after_claim_expired(self):
+        claimed, _ = self.claim('a')
+        self.time.return_value = 1030
+        reclaimed, _ = self.claim('b')
+        self.assertEqual(reclaimed, claimed)
+        # The items are only written by the consumer which claimed them last
+        self.assertEqual(self.queue.ack(self.tr, 'a', claimed), [])
+        self.assertEqual(self.stats(), [3, 24])
+        self.assertEqual(self.queue.ack(self.tr, 'b', reclaimed), claimed)
+        self.assertEqual(self.stats(), [1, 3])
+
+    def test_lost_lease(self):
+        self.queue.set_lease(self.tr, 'a', 1000)
+        self.assertEqual(len(self.claim('a', lease=True)[0]), 2)
+        self.queue.set_lease(self.tr, 'b', 1000)
+        with self.assertRaises(LeaseLost):
+            self.claim('a', lease=True)
+        with self.assertRaises(LeaseLost):
+            self.queue.renew_lease(self.tr, 'a')
+        # Claims don't need the lease when the queue is shared
+        self.assertEqual(len(self.claim('a')[0]), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+# coding: utf-8
+
+from __future__ import absolute_import
+import struct
+import unittest
+
+from tsfdb_server_v1.controllers.remote_write import decode_write_request, \
+    snappy_decompress
+
+
+def varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def field(number, wire_type, payload):
+    if wire_type == 2:
+        payload = varint(len(payload)) + payload
+    return varint(number << 3 | wire_type) + payload
+
+
+def time_series(labels, samples):
+    message = b''
+    for name, value in labels.items():
+        message += field(1, 2, field(1, 2, name.encode('utf-8')) +
+                         field(2, 2, value.encode('utf-8')))
+    for timestamp, value in samples:
+        message += field(2, 2, field(1, 1, struct.pack('<d', value)) +
+                         field(2, 0, varint(timestamp & (2 ** 64 - 1))))
+    return message
+
+
+def snappy_compress(data):
+    # Valid snappy block made of literals only
+    out = bytearray(varint(len(data)))
+    for start in range(0, len(data), 60):
+        literal = data[start:start + 60]
+        out.append((len(literal) - 1) << 2)
+        out += literal
+    return bytes(out)
+
+
+def write_request(*series):
+    return snappy_compress(b''.join(field(1, 2, time_series(*ts))
+                                    for ts in series))
+
+
+class TestRemoteWrite(unittest.TestCase):
+    """Decoding of Prometheus remote_write requests"""
+
+    def test_decode(self):
+        request = write_request(
+            ({'__name__': 'node_load1', 'instance': 'host:9100',
+              'job': 'node'},
+             [(1600000000000, 0.5), (1600000015000, 1.25)]),
+            ({'__name__': 'up', 'instance': 'other:9100'},
+             [(1600000000000, 1.0)]))
+        self.assertEqual(list(decode_write_request(request)), [
+            ({'__name__': 'node_load1', 'instance': 'host:9100',
+              'job': 'node'},
+             [(1600000000000, 0.5), (1600000015000, 1.25)]),
+            ({'__name__': 'up', 'instance': 'other:9100'},
+             [(1600000000000, 1.0)])])
+
+    def test_negative_timestamp(self):
+        request = write_request(({'__name__': 'up'}, [(-1000, 2.0)]))
+        self.assertEqual(list(decode_write_request(request)),
+                         [({'__name__': 'up'}, [(-1000, 2.0)])])
+
+    def test_empty(self):
+        self.assertEqual(list(decode_write_request(snappy_compress(b''))), [])
+
+    def test_snappy_copies(self):
+        # 'abc' literal followed by a copy of 6 bytes at offset 3
+        self.assertEqual(snappy_decompress(b'\x09\x08abc\x09\x03'),
+                         b'abcabcabc')
+        # Copy with a 2 byte offset
+        self.assertEqual(snappy_decompress(b'\x06\x04ab\x0e\x02\x00'),
+                         b'ababab')
+
+    def test_truncated(self):
+        request = write_request(
+            ({'__name__': 'node_load1', 'instance': 'host:9100'},
+             [(1600000000000, 0.5)]))
+        for size in range(len(request)):
+            with self.assertRaises(ValueError):
+                list(decode_write_request(request[:size]))
+
+    def test_truncated_message(self):
+        message = field(1, 2, time_series(
+            {'__name__': 'up'}, [(1600000000000, 1.0)]))
+        for size in range(1, len(message)):
+            with self.assertRaises(ValueError):
+                list(decode_write_request(snappy_compress(message[:size])))
+
+    def test_invalid_snappy(self):
+        for data in (b'', b'\x05', b'\x03\x00a', b'\x03\x05\x05'):
+            with self.assertRaises(ValueError):
+                list(decode_write_request(data))
+
+    def test_unsupported_wire_type(self):
+        with self.assertRaises(ValueError):
+            list(decode_write_request(snappy_compress(varint(1 << 3 | 3))))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+# coding: utf-8
+
+from __future__ import absolute_import
+import unittest
+from unittest import mock
+
+import fdb
+
+from tsfdb_server_v1.controllers.helpers import load_config
+from tsfdb_server_v1.controllers.shard_map import ShardMap, validate_queues
+
+fdb.api_version(620)
+
+
+class TestShardMap(unittest.TestCase):
+    """Versioned number of queues cached by every process"""
+
+    def setUp(self):
+        patcher = mock.patch('tsfdb_server_v1.controllers.shard_map.time',
+                             return_value=1000)
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+        with mock.patch.dict(load_config(), {'QUEUES': -1}):
+            self.shard_map = ShardMap(ttl=30)
+
+    def test_validate_queues(self):
+        for queues in (1, 2, 1000, -1):
+            self.assertEqual(validate_queues(queues), queues)
+        for queues in (0, -2, True, False, '3', 1.5, None):
+            with self.assertRaises(ValueError):
+                validate_queues(queues)
+
+    def test_set_invalid_queues(self):
+        tr = mock.MagicMock(spec=fdb.Transaction)
+        for queues in (0, -2, True):
+            with self.assertRaises(ValueError):
+                self.shard_map.set_queues(tr, queues)
+        tr.__setitem__.assert_not_called()
+
+    def test_set_queues(self):
+        tr = mock.MagicMock(spec=fdb.Transaction)
+        with mock.patch.object(ShardMap, 'read', return_value=(3, 8)):
+            self.assertEqual(self.shard_map.set_queues(tr, 16), (4, 16))
+            tr.__setitem__.assert_called_once_with(
+                self.shard_map.key, fdb.tuple.pack((4, 16)))
+            # Setting the same number of queues keeps the version
+            tr.reset_mock()
+            self.assertEqual(self.shard_map.set_queues(tr, 8), (3, 8))
+            tr.__setitem__.assert_not_called()
+
+    def test_ttl(self):
+        with mock.patch.object(ShardMap, 'read',
+                               return_value=(1, 8)) as read:
+            self.assertEqual(self.shard_map.get(None), (1, 8))
+            self.time.return_value = 1029
+            self.assertEqual(self.shard_map.get(None), (1, 8))
+            self.assertEqual(read.call_count, 1)
+            # Refreshed once the ttl expired
+            read.return_value = (2, 16)
+            self.time.return_value = 1031
+            self.assertEqual(self.shard_map.get(None), (2, 16))
+            self.assertEqual(read.call_count, 2)
+
+    def test_get_queue_id(self):
+        with mock.patch.object(ShardMap, 'read', return_value=(1, 1)):
+            self.assertEqual(self.shard_map.get_queue_id(None, 'm1'), 'q0')
+        self.time.return_value = 2000
+        with mock.patch.object(ShardMap, 'read', return_value=(0, -1)):
+            self.assertEqual(self.shard_map.get_queue_id(None, 'm1'), 'm1')
+
+
+if __name__ == '__main__':
+    unittest.main()
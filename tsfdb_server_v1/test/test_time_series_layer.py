@@ -0,0 +1,129 @@
+# coding: utf-8
+
+from __future__ import absolute_import
+import struct
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import fdb
+
+from tsfdb_server_v1.controllers.block_codec import encode_block, \
+    decode_block
+from tsfdb_server_v1.controllers.time_series_layer import TimeSeriesLayer
+from tsfdb_server_v1.controllers.tsfdb_tuple import key_tuple_minute
+
+fdb.api_version(620)
+
+
+class Value(bytes):
+    """Value read by a transaction, absent if None"""
+
+    def __new__(cls, value):
+        self = super().__new__(cls, value or b'')
+        self.exists = value is not None
+        return self
+
+    def present(self):
+        return self.exists
+
+
+def timestamp(*args):
+    return int(datetime(*args).timestamp())
+
+
+class TestDeleteDatapoints(unittest.TestCase):
+    """Deletion of second datapoints kept in per minute blocks"""
+
+    def setUp(self):
+        self.blocks_dir = fdb.Subspace(('blocks',))
+        self.time_series = TimeSeriesLayer()
+        patcher = mock.patch.object(TimeSeriesLayer, 'open_dir',
+                                    return_value=self.blocks_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.blocks = {}
+        self.tr = mock.MagicMock(spec=fdb.Transaction)
+        self.tr.__getitem__.side_effect = self.get_block
+
+    def get_block(self, key):
+        return Value(self.blocks.get(key))
+
+    def block_key(self, dt):
+        return self.blocks_dir.pack(key_tuple_minute(dt, 'system.load1'))
+
+    def test_delete_from_datetime_min(self):
+        # Retentions delete everything older than the retention period
+        stop = datetime(2020, 9, 13, 12, 26, 40)
+        key = self.block_key(stop)
+        self.blocks[key] = encode_block([
+            [timestamp(2020, 9, 13, 12, 26, 20), 1],
+            [timestamp(2020, 9, 13, 12, 26, 50), 2]])
+        self.time_series.delete_datapoints(
+            self.tr, 'org', 'm1', 'system.load1', datetime.min, stop,
+            'second')
+        start_key = self.blocks_dir.pack(
+            key_tuple_minute(datetime.min, 'system.load1'))
+        self.tr.clear_range.assert_any_call(start_key, key)
+        # The stop block keeps the datapoints after stop
+        block = self.tr.__setitem__.call_args[0]
+        self.assertEqual(block[0], key)
+        self.assertEqual(decode_block(block[1]),
+                         [[timestamp(2020, 9, 13, 12, 26, 50), 2]])
+
+    def test_delete_within_a_minute(self):
+        start = datetime(2020, 9, 13, 12, 26, 10)
+        stop = datetime(2020, 9, 13, 12, 26, 30)
+        key = self.block_key(start)
+        self.blocks[key] = encode_block([
+            [timestamp(2020, 9, 13, 12, 26, 5), 1],
+            [timestamp(2020, 9, 13, 12, 26, 20), 2.5],
+            [timestamp(2020, 9, 13, 12, 26, 45), 3]])
+        self.time_series.delete_datapoints(
+            self.tr, 'org', 'm1', 'system.load1', start, stop, 'second')
+        block = self.tr.__setitem__.call_args[0]
+        self.assertEqual(decode_block(block[1]), [
+            [timestamp(2020, 9, 13, 12, 26, 5), 1],
+            [timestamp(2020, 9, 13, 12, 26, 45), 3]])
+
+
+class TestAggregates(unittest.TestCase):
+    """Folding of the datapoints of a batch into atomic operations"""
+
+    def setUp(self):
+        self.time_series = TimeSeriesLayer()
+        self.datapoints_dir = fdb.Subspace(('minute',))
+        self.tr = mock.MagicMock(spec=fdb.Transaction)
+
+    def write(self, *values):
+        self.tr.reset_mock()
+        aggregates = {}
+        dt = datetime(2020, 9, 13, 12, 26, 40)
+        for value in values:
+            self.time_series.aggregate_datapoint(
+                aggregates, 'm1', 'system.load1', dt, value, ('minute',))
+        self.time_series.write_aggregates(self.tr, 'org', aggregates,
+                                          self.datapoints_dir)
+        return {(self.datapoints_dir.unpack(key)[1], op): value
+                for op in ('add', 'min', 'max')
+                for key, value in (call[0] for call in
+                                   getattr(self.tr, op).call_args_list)}
+
+    def test_aggregates(self):
+        ops = self.write(3, 1.5, -2)
+        self.assertEqual(ops[('count', 'add')], struct.pack('<q', 3))
+        self.assertEqual(ops[('sum', 'add')], struct.pack('<q', 1501))
+        # Atomic min/max compare little endian values as unsigned
+        self.assertEqual(ops[('min', 'min')], struct.pack('<q', 3))
+        self.assertEqual(ops[('max', 'max')], struct.pack('<q', -2))
+
+    def test_sum_overflow(self):
+        # Wraps around like separate atomic adds of the values would
+        ops = self.write(2 ** 62, 2 ** 62, 2 ** 62)
+        self.assertEqual(ops[('sum', 'add')], struct.pack('<q', -2 ** 62))
+        ops = self.write(-2 ** 63, -1)
+        self.assertEqual(ops[('sum', 'add')], struct.pack('<q', 2 ** 63 - 1))
+
+
+if __name__ == '__main__':
+    unittest.main()